@@ -1,15 +1,37 @@
+import asyncio
 import json
 import os
+import sys
+import bisect
+import functools
+import math
+import base64
+import hashlib
 import logging
+import sqlite3
 import threading
 import time
 import shutil
+import copy
+import marshal
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, deque
+from collections.abc import Mapping, MutableMapping, Sequence
+from contextlib import ExitStack, contextmanager
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ChatMemberHandler, MessageHandler, filters, ContextTypes
 
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:  # اختياري: التقارير التحليلية تعمل بدونها (أبطأ)
+    np = None
+    HAS_NUMPY = False
 
 async def safe_edit(query, text, reply_markup=None):
     try:
@@ -39,8 +61,98 @@ os.makedirs(BACKUP_DIR, exist_ok=True)
 BACKUP_INTERVAL = 1800
 _last_backup_time = 0
 
+# ========== محرك التخزين ==========
+# "json": ملفات users.json و data.json (الافتراضي)
+# "sqlite": قاعدة بيانات SQLite بوضع WAL (قراءة/كتابة صف واحد لكل عملية)
+# "sharded": المستخدمون مقسمون على عدة ملفات JSON (data.json كما هو)
+STORAGE_ENGINE = "json"
+SQLITE_FILE = os.path.join(current_dir, "bot.db")
+USERS_SHARD_DIR = os.path.join(current_dir, "users_shards")
+USERS_SHARD_COUNT = 16
+
+# ========== متانة الكتابة ==========
+# كل الحفظ ذري (ملف مؤقت + os.replace)، ومستوى fsync:
+# "always": fsync مع كل كتابة | "batched": fsync جماعي كل FSYNC_BATCH_MS في خيط خلفي
+# "buffered": ذاكرة النظام فقط (يتحمل توقف البوت وليس انقطاع الكهرباء)
+# في "batched" الكتّاب داخل نفس النافذة يتشاركون fsync واحداً: الخيوط (asyncio.to_thread) تنتظر
+# اكتماله، وحلقة الأحداث لا تنتظر أبداً (أقصى فقد عند انقطاع الكهرباء = نافذة واحدة)
+DURABILITY_LEVEL = "buffered"
+FSYNC_BATCH_MS = 20
+
+# ========== اللقطات في الذاكرة ==========
+# كل حفظ يُسجل المسارات التي غيّرها، فتعديلان متزامنان على سجلات مختلفة يُدمجان بدلاً من فقدان أحدهما
+SNAPSHOT_CHANGE_LOG_SIZE = 256  # عدد الإصدارات الأخيرة المحفوظة مساراتها
+SNAPSHOT_COMMIT_RETRIES = 3  # إعادة التعديل على أحدث إصدار عند تضارب نفس السجل
+
+# ========== الكتابة المؤجلة (محرك JSON فقط) ==========
+# التحديثات تُطبق على نسخة في الذاكرة وتُكتب للملفات مرة واحدة لكل فترة
+WRITE_BEHIND_ENABLED = False
+WRITE_BEHIND_INTERVAL = 5  # أقصى مدة (ثواني) قبل كتابة التغييرات
+WRITE_BEHIND_MAX_DIRTY = 100  # كتابة فورية عند تراكم هذا العدد من التحديثات
+
+# ========== سجل الكتابة المسبقة WAL (محرك JSON فقط) ==========
+# كل تحديث يُلحق كسطر مضغوط في WAL، وتُدمج السجلات دورياً في لقطة جديدة
+WAL_ENABLED = False
+WAL_FILE = os.path.join(current_dir, "journal.wal")
+WAL_FSYNC_INTERVAL = 0.2  # ثواني بين كل fsync جماعي
+WAL_COMPACT_INTERVAL = 300  # ثواني بين كل ضغط للسجل
+WAL_COMPACT_MAX_BYTES = 4 * 1024 * 1024  # ضغط فوري عند تجاوز هذا الحجم (بالإضافة للضغط الدوري)
+
+# ========== سجل المعاملات ==========
+# المعاملات تُلحق في ملف منفصل بدلاً من users.json (سجلات المستخدمين تحتفظ بالأرصدة فقط)
+LEDGER_FILE = os.path.join(current_dir, "ledger.jsonl")
+LEDGER_INDEX_FILE = os.path.join(current_dir, "ledger_index.json")
+LEDGER_INDEX_SAVE_EVERY = 200  # حفظ الفهرس بعد هذا العدد من المعاملات
+LEDGER_RETENTION_DAYS = 180  # المعاملات الأقدم تُحذف من السجل (يجب أن تتجاوز مدة فهرس التكرار)
+TRANSACTIONS_PAGE_SIZE = 10
+
+# فهرس منع تكرار المعاملات (معرّف → وقت انتهاء الصلاحية)
+DEDUP_INDEX_FILE = os.path.join(current_dir, "dedup_index.json")
+TRANSACTION_DEDUP_TTL = 7 * 24 * 3600  # مدة تذكّر المعاملة المنفذة (ثواني)
+
+# ========== العدادات اليومية ==========
+DAILY_STATS_FILE = os.path.join(current_dir, "daily_stats.json")
+DAILY_STATS_RETENTION_DAYS = 90
+DAILY_STATS_SAVE_INTERVAL = 60  # ثواني بين كل حفظ
+# مخططات HyperLogLog للنشطين المميزين يومياً (2^الدقة بايت لكل يوم، خطأ تقريبي 1.04/√العدد)
+ACTIVE_SKETCHES_FILE = os.path.join(os.path.dirname(DATA_FILE), "active_sketches.json")
+ACTIVE_SKETCH_PRECISION = 12  # 4096 سجل = 4KB لكل يوم (خطأ ~1.6%)
+ACTIVE_SKETCH_RETENTION_DAYS = 35
+
+# ========== كاش العضوية في القنوات ==========
+# مدة صلاحية نتيجة get_chat_member حسب نوعها (ثواني) - الإيجابية تحدد أقصى تأخير لاكتشاف المغادرة
+MEMBERSHIP_CACHE_TTL_POSITIVE = 300
+MEMBERSHIP_CACHE_TTL_NEGATIVE = 60
+MEMBERSHIP_CACHE_TTL_ERROR = 15
+MEMBERSHIP_CACHE_MAX_ENTRIES = 50000
+# كاش بيانات القنوات (يوزر → معرف/اسم/نوع) - يُحدّث في الخلفية بعد هذه المدة
+CHAT_METADATA_FILE = os.path.join(os.path.dirname(DATA_FILE), "chat_metadata.json")
+CHAT_METADATA_REFRESH_AFTER = 24 * 3600
+CHAT_METADATA_SAVE_INTERVAL = 300  # ثواني بين كل حفظ (فقط إذا تغير الكاش)
+# تحديث متدرج لحالة إشراف البوت: دفعة من أقدم القنوات فحصاً كل فترة (التغييرات الفورية من my_chat_member)
+BOT_ADMIN_REFRESH_INTERVAL = 300
+BOT_ADMIN_REFRESH_BATCH = 10
+
+# ========== الفحص الدوري للاشتراكات ==========
+SUBSCRIPTION_SWEEP_CONCURRENCY = 20  # أقصى عدد فحوص get_chat_member متزامنة
+SUBSCRIPTION_LEAVE_PENALTY = 5  # النقاط المخصومة عند مغادرة قناة قيد التجميع
+NOTIFICATION_SEND_INTERVAL = 0.05  # ثواني بين رسائل طابور الإشعارات (حد تيليجرام ~30 رسالة/ثانية)
+# المغادرة تُكتشف فوراً من تحديثات chat_member، والفحص الدوري مجرد مطابقة لما فات منها
+# (تحديثات ضاعت أثناء توقف البوت أو قنوات فقد فيها الإشراف) - لذلك 15 دقيقة تكفي بدل 30 ثانية
+SUBSCRIPTION_RECONCILE_INTERVAL = 900
+# أحداث المغادرة تُجمع لهذه المدة ثم تُطبق في حفظ واحد خارج حلقة الأحداث (ثواني)
+MEMBERSHIP_EVENT_BATCH_DELAY = 2
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+# ========== التقارير التحليلية ==========
+ANALYTICS_PERCENTILES = (25, 50, 75, 90, 99)
+ANALYTICS_COHORT_WEEKS = 6  # عدد الأسابيع في تقرير الاحتفاظ بالمستخدمين
+
 # إعدادات متقدمة
-CACHE_TTL = 30
+CHANNEL_HISTORY_LIMIT = 50  # آخر N سجل مغادرة/عودة لكل قناة (الإجماليات في عدادات منفصلة)
+TOP_SIZE = 10  # عدد المستخدمين في كل قائمة توب
+SCHEMA_VERSION = 2  # إصدار مخطط السجلات (الترحيل يعمل مرة واحدة عند بدء التشغيل)
+TRANSACTION_IN_FLIGHT_TIMEOUT = 3600  # معاملة قيد التنفيذ لم تُغلق بعد هذه المدة تُعتبر متروكة (ثواني)
 ACTION_COOLDOWNS = {
     "join_channel": 10,
     "verify_channel": 5,
@@ -70,7 +182,46 @@ _file_locks = {
     USERS_FILE: threading.Lock(),
     DATA_FILE: threading.Lock()
 }
-_cache_last_update = {}
+_cache_signatures = {}
+_commit_locks = defaultdict(threading.RLock)  # قفل لكل لقطة: فحص الإصدار والنشر عملية واحدة
+
+# ===================== الوقت =====================
+
+# الأوقات الجديدة تُخزن كثوانٍ صحيحة (epoch)، والسجلات القديمة بهذه الصيغة النصية تُقرأ كما هي
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def now_ts():
+    """الوقت الحالي كثوانٍ صحيحة (صيغة التخزين)"""
+    return int(time.time())
+
+@functools.lru_cache(maxsize=65536)
+def _parse_time_string(value):
+    return int(datetime.strptime(value, TIME_FORMAT).timestamp())
+
+def to_timestamp(value, default=0):
+    """قراءة وقت مخزن (رقم epoch أو نص قديم) كثوانٍ صحيحة"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    if isinstance(value, str) and value:
+        try:
+            return _parse_time_string(value)
+        except ValueError:
+            return default
+    return default
+
+def format_timestamp(value, empty=""):
+    """عرض وقت مخزن بأي صيغة بالصيغة المعتادة"""
+    if isinstance(value, str) or not value:
+        return value or empty
+    return datetime.fromtimestamp(value).strftime(TIME_FORMAT)
+
+def day_of(value):
+    """اليوم (YYYY-MM-DD) لوقت مخزن بأي صيغة"""
+    if isinstance(value, str):
+        return value[:10]
+    if not value:
+        return ""
+    return datetime.fromtimestamp(value).strftime("%Y-%m-%d")
 
 # ===================== مدير Cooldown المحسن =====================
 
@@ -79,7 +230,8 @@ class CooldownManager:
     
     def __init__(self):
         self.cooldowns = defaultdict(dict)
-        self.transaction_ids = set()
+        # المعاملات قيد التنفيذ فقط (معرّف → وقت البدء) - المنفذة سابقاً في فهرس التكرار الدائم
+        self.in_flight = {}
         self.lock = threading.Lock()
     
     def can_proceed(self, user_id, action_type, transaction_id=None):
@@ -87,8 +239,9 @@ class CooldownManager:
         user_id = str(user_id)
         
         with self.lock:
-            # التحقق من تكرار المعاملة
-            if transaction_id and transaction_id in self.transaction_ids:
+            # التحقق من تكرار المعاملة (قيد التنفيذ أو منفذة سابقاً ولو قبل إعادة التشغيل)
+            if transaction_id and (transaction_id in self.in_flight
+                                   or is_duplicate_transaction(transaction_id)):
                 return False, 0, "معاملة مكررة"
             
             current_time = time.time()
@@ -104,23 +257,23 @@ class CooldownManager:
             # تسجيل الوقت والمعاملة
             self.cooldowns[user_id][action_type] = current_time
             if transaction_id:
-                self.transaction_ids.add(transaction_id)
+                self.in_flight[transaction_id] = current_time
             
             return True, 0, "يمكن المتابعة"
     
-    def clear_old_transactions(self):
-        """تنظيف المعاملات القديمة"""
+    def clear_stale_transactions(self):
+        """إزالة المعاملات المتروكة قيد التنفيذ (معالج توقف قبل إغلاقها)"""
         with self.lock:
-            # تنظيف بعد 24 ساعة
-            current_time = time.time()
-            self.transaction_ids = {tid for tid in self.transaction_ids 
-                                  if not tid.startswith('tx_') or 
-                                  current_time - int(tid.split('_')[-1]) / 1000 < 86400}
+            cutoff = time.time() - TRANSACTION_IN_FLIGHT_TIMEOUT
+            stale = [tid for tid, started in self.in_flight.items() if started < cutoff]
+            for transaction_id in stale:
+                del self.in_flight[transaction_id]
+            return len(stale)
     
     def mark_transaction_complete(self, transaction_id):
         """تحديد المعاملة كمكتملة"""
         with self.lock:
-            self.transaction_ids.discard(transaction_id)
+            self.in_flight.pop(transaction_id, None)
 
 cooldown_manager = CooldownManager()
 
@@ -132,461 +285,4377 @@ _verify_locks = {}
 _daily_locks = {}
 _store_locks = {}
 
-# ===================== وظائف التخزين المحسنة =====================
-
-def get_data_with_cache(cache_key, load_func, file_lock, ttl=CACHE_TTL):
-    """تحميل البيانات مع التخزين المؤقت المحسن"""
-    current_time = time.time()
-    
-    with _cache_lock:
-        if (cache_key in _data_cache and 
-            (current_time - _cache_last_update.get(cache_key, 0) < ttl)):
-            return _data_cache[cache_key].copy()
-    
-    with file_lock:
-        data = load_func()
-        
-        with _cache_lock:
-            _data_cache[cache_key] = data.copy()
-            _cache_last_update[cache_key] = current_time
-        
-        return data
+# ===================== الكتابة الذرية والمتانة =====================
 
-def _load_users_from_file():
-    """تحميل المستخدمين من الملف (داخلية)"""
-    if os.path.exists(USERS_FILE):
+def _fsync_directory(directory):
+    """fsync للمجلد حتى تصبح عملية os.replace دائمة"""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class GroupCommitter:
+    """fsync جماعي في خيط خلفي: كل الملفات المكتوبة داخل نفس النافذة الزمنية تُزامن معاً"""
+    
+    def __init__(self, window_ms):
+        self.window = window_ms / 1000
+        self.cond = threading.Condition()
+        self.pending = set()
+        self.batch = 0  # رقم الدفعة المفتوحة حالياً
+        self.done = 0  # كل الدفعات الأقل من هذا الرقم تمت مزامنتها
+        self.errors = {}  # مسار → (رقم الدفعة، الخطأ)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+        self.total_batches = 0
+        self.total_commits = 0
+    
+    def enqueue(self, path):
+        """تسجيل ملف تم استبداله في الدفعة الحالية - يعيد تذكرة انتظار"""
+        self.start()
+        with self.cond:
+            self.pending.add(path)
+            self.total_commits += 1
+            return path, self.batch
+    
+    def wait(self, path, ticket):
+        """انتظار مزامنة الدفعة التي تحتوي الملف (من خيط عامل فقط)"""
+        with self.cond:
+            while self.done <= ticket:
+                self.cond.wait()
+            error = self.errors.get(path)
+        if error is not None and error[0] == ticket:
+            raise error[1]
+    
+    def flush(self):
+        """مزامنة الدفعة الحالية: fsync لكل ملف ثم fsync واحد لكل مجلد"""
+        with self.cond:
+            if not self.pending:
+                return 0
+            pending, self.pending = self.pending, set()
+            covered = self.batch
+            self.batch += 1
+        
+        errors = _sync_files(pending)
+        
+        with self.cond:
+            for path in pending:
+                self.errors.pop(path, None)
+            self.errors.update((path, (covered, error)) for path, error in errors.items())
+            self.done = covered + 1
+            self.total_batches += 1
+            self.cond.notify_all()
+        return len(pending)
+    
+    def _run(self):
+        """حلقة fsync الجماعي"""
+        while not self.stop_event.wait(self.window):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ خطأ في fsync الجماعي: {e}")
+    
+    def start(self):
+        """تشغيل خيط المزامنة عند أول كتابة"""
+        if self.thread is None:
+            with self.thread_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, daemon=True)
+                    self.thread.start()
+
+_group_committer = GroupCommitter(FSYNC_BATCH_MS)
+
+def _sync_files(paths):
+    """fsync للملفات ثم fsync واحد لكل مجلد (يعيد {مسار: خطأ})"""
+    errors = {}
+    directories = set()
+    for path in paths:
         try:
-            with open(USERS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(path, 'rb') as f:
+                os.fsync(f.fileno())
+            directories.add(os.path.dirname(os.path.abspath(path)))
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            logger.error(f"خطأ في تحميل المستخدمين: {e}")
-            return {}
-    return {}
+            logger.error(f"❌ فشل fsync الجماعي لـ {path}: {e}")
+            errors[path] = e
+    
+    for directory in directories:
+        try:
+            _fsync_directory(directory)
+        except OSError as e:
+            logger.error(f"❌ فشل fsync للمجلد {directory}: {e}")
+    return errors
 
-def load_users(force_reload=False):
-    """تحميل بيانات المستخدمين"""
-    if not force_reload:
-        return get_data_with_cache("users", _load_users_from_file, _file_locks[USERS_FILE])
-    else:
-        return _load_users_from_file()
+def _in_event_loop():
+    """هل الاستدعاء من داخل حلقة asyncio (وليس من خيط عامل)؟"""
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
 
-def _load_data_from_file():
-    """تحميل البيانات من الملف (داخلية)"""
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except json.JSONDecodeError as e:
-            logger.error(f"خطأ JSON في ملف البيانات: {e}")
-            return create_initial_data()
-        except Exception as e:
-            logger.error(f"خطأ في تحميل البيانات: {e}")
-            return create_initial_data()
-    return create_initial_data()
+_tmp_counter = 0
+_tmp_counter_lock = threading.Lock()
 
-def load_data(force_reload=False):
-    """تحميل البيانات العامة"""
-    if not force_reload:
-        return get_data_with_cache("data", _load_data_from_file, _file_locks[DATA_FILE])
-    else:
-        return _load_data_from_file()
+def _write_tmp_file(path, payload):
+    """كتابة المحتوى في ملف مؤقت بجانب الملف الأصلي"""
+    global _tmp_counter
+    
+    with _tmp_counter_lock:
+        _tmp_counter += 1
+        tmp_path = f"{path}.{os.getpid()}.{_tmp_counter}.tmp"
+    
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(payload)
+        if DURABILITY_LEVEL == "always":
+            f.flush()
+            os.fsync(f.fileno())
+    return tmp_path
 
-def save_users(users_data, backup=False):
-    """حفظ بيانات المستخدمين"""
-    with _file_locks[USERS_FILE]:
-        try:
-            if backup and os.path.exists(USERS_FILE):
-                backup_file = f"backups/{USERS_FILE}.{datetime.now().strftime('%Y%m%d_%H%M%S')}.bak"
-                try:
-                    shutil.copy2(USERS_FILE, backup_file)
-                except Exception as e:
-                    logger.error(f"خطأ في إنشاء backup: {e}")
-            
-            with open(USERS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(users_data, f, ensure_ascii=False, indent=4)
-            
-            with _cache_lock:
-                _data_cache["users"] = users_data.copy()
-                _cache_last_update["users"] = time.time()
-            
-            return True
-        except Exception as e:
-            logger.error(f"خطأ في حفظ المستخدمين: {e}")
-            return False
+def atomic_write_text(path, payload):
+    """
+    كتابة ذرية: ملف مؤقت ثم os.replace (لا يوجد ملف مقطوع أبداً)
+    
+    Returns:
+        تذكرة انتظار للوضع batched (تُمرر لـ wait_durable خارج قفل الملف)، أو None
+    """
+    tmp_path = _write_tmp_file(path, payload)
+    
+    try:
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    if DURABILITY_LEVEL == "always":
+        _fsync_directory(os.path.dirname(os.path.abspath(path)))
+    elif DURABILITY_LEVEL == "batched":
+        return _group_committer.enqueue(path)
+    return None
 
-def save_data(data, backup=False):
-    """حفظ البيانات العامة"""
-    with _file_locks[DATA_FILE]:
-        try:
-            if backup and os.path.exists(DATA_FILE):
-                backup_file = f"backups/{DATA_FILE}.{datetime.now().strftime('%Y%m%d_%H%M%S')}.bak"
-                try:
-                    shutil.copy2(DATA_FILE, backup_file)
-                except Exception as e:
-                    logger.error(f"خطأ في إنشاء backup للبيانات: {e}")
-            
-            with open(DATA_FILE, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
-            
-            with _cache_lock:
-                _data_cache["data"] = data.copy()
-                _cache_last_update["data"] = time.time()
-            
-            return True
-        except Exception as e:
-            logger.error(f"خطأ في حفظ البيانات: {e}")
-            return False
+def atomic_write_json(path, data, indent=4):
+    """كتابة JSON بشكل ذري"""
+    return atomic_write_text(path, json.dumps(data, ensure_ascii=False, indent=indent, default=to_json_value))
 
-def create_initial_data():
-    """إنشاء البيانات الأولية"""
-    return {
-        "channels": {},
-        "codes": {},
-        "reports": {},
-        "admins": [str(ADMIN_ID)],
-        "banned_users": [],
-        "muted_users": {},
-        "force_sub_channels": [],
-        "stats": {
-            "total_users": 0,
-            "total_points": 0,
-            "total_invites": 0,
-            "total_purchases": 0,
-            "total_joins": 0,
-            "total_reports": 0,
-            "total_daily_gifts": 0,
-            "total_mutes": 0
-        }
-    }
+def wait_durable(ticket):
+    """انتظار fsync الجماعي من الخيوط العاملة - حلقة الأحداث لا تنتظر (لا شيء في الأوضاع الأخرى)"""
+    if ticket is not None and not _in_event_loop():
+        _group_committer.wait(*ticket)
 
-def create_default_user_data():
-    """إنشاء بيانات المستخدم الافتراضية"""
-    return {
-        "points": 0,
-        "invites": 0,
-        "invited_users": [],
-        "bought_channels": {},
-        "joined_channels": {},
-        "username": "",
-        "first_name": "",
-        "last_name": "",
-        "first_join": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "total_earned": 0,
-        "total_spent": 0,
-        "orders": [],
-        "reports_made": 0,
-        "reports_received": 0,
-        "last_active": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "active_subscriptions": [],
-        "daily_gift": {
-            "last_claimed": None,
-            "streak": 0,
-            "total_claimed": 0
-        },
-        "reported_channels": [],
-        "inactive": False,
-        "left_channels": [],
-        "transactions": [],
-        "temp_left_channels": [],  # قنوات غادرها مؤقتاً (قيد التجميع)
-        "permanent_left_channels": [],  # قنوات غادرها نهائياً
-        "left_completed_channels": []  # قنوات غادرها بعد اكتمالها
-    }
+def write_json_file(path, data, indent=4):
+    """كتابة JSON ذرية مع انتظار مستوى المتانة المحدد"""
+    wait_durable(atomic_write_json(path, data, indent))
 
-def ensure_user_data_fields(user_data):
-    """تأكد من وجود جميع الحقول المطلوبة"""
-    default_fields = {
-        "points": 0,
-        "invites": 0,
-        "total_earned": 0,
-        "total_spent": 0,
-        "left_channels": [],
-        "transactions": [],
-        "temp_left_channels": [],
-        "permanent_left_channels": [],
-        "left_completed_channels": []
+def cleanup_stale_tmp_files():
+    """حذف الملفات المؤقتة المتبقية من تشغيل سابق انقطع"""
+    removed = 0
+    for directory in {os.path.dirname(USERS_FILE), USERS_SHARD_DIR}:
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            if name.endswith(".tmp") and ".json." in name:
+                try:
+                    os.remove(os.path.join(directory, name))
+                    removed += 1
+                except OSError:
+                    pass
+    if removed:
+        logger.info(f"🧹 تم حذف {removed} ملف مؤقت متبقي")
+    return removed
+
+# ===================== محرك SQLite =====================
+
+class SQLiteStorage:
+    """محرك تخزين SQLite بوضع WAL - كل عملية على مستخدم تقرأ/تكتب صفاً واحداً"""
+    
+    # مفاتيح data.json التي لها جداول مستقلة (المفتاح -> (الجدول، عمود المعرّف))
+    RECORD_TABLES = {
+        "channels": ("channels", "channel_id"),
+        "codes": ("codes", "code"),
+        "reports": ("reports", "report_id"),
+        "muted_users": ("mutes", "user_id")
     }
     
-    for field, default_value in default_fields.items():
-        if field not in user_data:
-            user_data[field] = default_value
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
     
-    for field, default_value in default_fields.items():
-        if field not in user_data:
-            user_data[field] = default_value
-
-def get_user_data(user_id, force_reload=False):
-    """الحصول على بيانات المستخدم"""
-    users_data = load_users(force_reload)
-    user_id = str(user_id)
+    def _create_tables(self):
+        """إنشاء الجداول إذا لم تكن موجودة"""
+        with self.lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id TEXT PRIMARY KEY,
+                    username TEXT,
+                    points INTEGER DEFAULT 0,
+                    invites INTEGER DEFAULT 0,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS channels (
+                    channel_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS codes (
+                    code TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS reports (
+                    report_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS mutes (
+                    user_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS stats (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+    
+    def _user_row(self, user_id, user_data):
+        """تحويل بيانات المستخدم إلى صف"""
+        return (
+            str(user_id),
+            user_data.get("username", ""),
+            user_data.get("points", 0),
+            user_data.get("invites", 0),
+            json.dumps(user_data, ensure_ascii=False, default=to_json_value)
+        )
     
-    if user_id not in users_data:
-        default_data = create_default_user_data()
-        users_data[user_id] = default_data
-        update_system_stats("total_users", increment=1)
-        save_users(users_data, backup=False)
+    # ---------- المستخدمين ----------
     
-    user_data = users_data[user_id]
-    ensure_user_data_fields(user_data)
+    def get_user(self, user_id):
+        """قراءة مستخدم واحد (None إذا لم يكن موجوداً)"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM users WHERE user_id = ?", (str(user_id),)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
     
-    return user_data.copy()
-
-def update_user_data(user_id, updates, action_type=None, transaction_id=None):
-    """تحديث بيانات المستخدم"""
-    user_id = str(user_id)
+    def put_user(self, user_id, user_data):
+        """كتابة مستخدم واحد"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO users (user_id, username, points, invites, data) VALUES (?, ?, ?, ?, ?)",
+                self._user_row(user_id, user_data)
+            )
     
-    # قفل المستخدم لمنع التضارب
-    if user_id not in _user_locks:
-        _user_locks[user_id] = threading.Lock()
+    def load_all_users(self):
+        """تحميل جميع المستخدمين كقاموس (للفحوصات الشاملة)"""
+        with self.lock:
+            rows = self.conn.execute("SELECT user_id, data FROM users").fetchall()
+        return {user_id: json.loads(data) for user_id, data in rows}
     
-    with _user_locks[user_id]:
-        users_data = load_users(force_reload=True)
+    def save_users(self, changes):
+        """كتابة/حذف المستخدمين المتغيرين فقط في معاملة واحدة ({معرّف: البيانات أو None للحذف})"""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO users (user_id, username, points, invites, data) VALUES (?, ?, ?, ?, ?)",
+                    [self._user_row(uid, udata) for uid, udata in changes.items() if udata is not None]
+                )
+                self.conn.executemany(
+                    "DELETE FROM users WHERE user_id = ?",
+                    [(str(uid),) for uid, udata in changes.items() if udata is None]
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def save_all_users(self, users_data):
+        """استبدال جميع المستخدمين في معاملة واحدة"""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("DELETE FROM users")
+                self.conn.executemany(
+                    "INSERT INTO users (user_id, username, points, invites, data) VALUES (?, ?, ?, ?, ?)",
+                    [self._user_row(uid, udata) for uid, udata in users_data.items()]
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def count_users(self):
+        """عدد المستخدمين"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    
+    # ---------- الإحصائيات ----------
+    
+    def increment_stat(self, stat_key, increment):
+        """زيادة إحصائية واحدة بدون قراءة باقي البيانات"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO stats (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                (stat_key, increment)
+            )
+    
+    # ---------- البيانات العامة ----------
+    
+    def load_data(self):
+        """تجميع data.json من الجداول"""
+        data = create_initial_data()
+        with self.lock:
+            for key, (table, id_column) in self.RECORD_TABLES.items():
+                rows = self.conn.execute(f"SELECT {id_column}, data FROM {table}").fetchall()
+                data[key] = {record_id: json.loads(record) for record_id, record in rows}
+            
+            for key, value in self.conn.execute("SELECT key, value FROM stats").fetchall():
+                data["stats"][key] = value
+            
+            for key, value in self.conn.execute("SELECT key, value FROM meta").fetchall():
+                data[key] = json.loads(value)
+        return data
+    
+    def save_data(self, data, changed=None):
+        """
+        تفكيك data.json إلى الجداول في معاملة واحدة - مع changed ({مسار: قيمة أو _DELETED}
+        من حفظ المحرر) تُكتب/تُحذف صفوف القنوات والأكواد والبلاغات والمكتومين والإحصائيات المتغيرة فقط
+        """
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                if changed is None:
+                    self._replace_data(data)
+                else:
+                    for path, value in changed.items():
+                        self._write_data_path(data, path, value)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def _replace_table(self, table, id_column, records):
+        """استبدال كل صفوف جدول (داخلية - داخل معاملة)"""
+        self.conn.execute(f"DELETE FROM {table}")
+        self.conn.executemany(
+            f"INSERT INTO {table} ({id_column}, data) VALUES (?, ?)",
+            [(str(record_id), json.dumps(record, ensure_ascii=False)) for record_id, record in records.items()]
+        )
+    
+    def _replace_data(self, data):
+        """استبدال كل الجداول (داخلية - داخل معاملة)"""
+        for key, (table, id_column) in self.RECORD_TABLES.items():
+            self._replace_table(table, id_column, data.get(key, {}))
         
-        if user_id not in users_data:
-            users_data[user_id] = create_default_user_data()
+        self.conn.execute("DELETE FROM stats")
+        self.conn.executemany(
+            "INSERT INTO stats (key, value) VALUES (?, ?)",
+            list(data.get("stats", {}).items())
+        )
         
-        # تحديث الحقول
-        for key, value in updates.items():
-            users_data[user_id][key] = value
-        
-        # تحديث وقت النشاط
-        users_data[user_id]["last_active"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        users_data[user_id]["inactive"] = False
-        
-        # تسجيل المعاملة إذا كانت متاحة
-        if action_type and transaction_id:
-            transaction = {
-                "id": transaction_id,
-                "action": action_type,
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "updates": updates
-            }
-            users_data[user_id].setdefault("transactions", []).append(transaction)
+        self.conn.execute("DELETE FROM meta")
+        self.conn.executemany(
+            "INSERT INTO meta (key, value) VALUES (?, ?)",
+            [(key, json.dumps(value, ensure_ascii=False))
+             for key, value in data.items()
+             if key not in self.RECORD_TABLES and key != "stats"]
+        )
+    
+    def _write_data_path(self, data, path, value):
+        """كتابة مسار متغير واحد كصف (داخلية - داخل معاملة)"""
+        key = path[0]
+        
+        if key in self.RECORD_TABLES:
+            table, id_column = self.RECORD_TABLES[key]
+            if len(path) == 1:
+                # الحاوية كلها استُبدلت
+                self._replace_table(table, id_column, {} if value is _DELETED else value)
+            elif value is _DELETED:
+                self.conn.execute(f"DELETE FROM {table} WHERE {id_column} = ?", (str(path[1]),))
+            else:
+                self.conn.execute(
+                    f"INSERT OR REPLACE INTO {table} ({id_column}, data) VALUES (?, ?)",
+                    (str(path[1]), json.dumps(value, ensure_ascii=False))
+                )
         
-        # حفظ مع قفل الملف
-        if save_users(users_data, backup=False):
-            return True
-        return False
-
-def update_system_stats(stat_key, increment=1, points=0):
-    """تحديث إحصائيات النظام"""
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            data = load_data(force_reload=True)
-            stats = data.get("stats", {})
-            
-            if stat_key in stats:
-                stats[stat_key] = stats.get(stat_key, 0) + increment
+        elif key == "stats":
+            if len(path) == 1:
+                self.conn.execute("DELETE FROM stats")
+                if value is not _DELETED:
+                    self.conn.executemany("INSERT INTO stats (key, value) VALUES (?, ?)", list(value.items()))
+            elif value is _DELETED:
+                self.conn.execute("DELETE FROM stats WHERE key = ?", (path[1],))
             else:
-                stats[stat_key] = increment
-            
-            if points > 0:
-                stats["total_points"] = stats.get("total_points", 0) + points
-            
-            data["stats"] = stats
-            
-            if save_data(data, backup=False):
-                return True
-                
-        except Exception as e:
-            logger.error(f"خطأ في تحديث الإحصائيات: {e}")
-            if attempt == max_retries - 1:
-                return False
-            time.sleep(0.1)
+                self.conn.execute("INSERT OR REPLACE INTO stats (key, value) VALUES (?, ?)", (path[1], value))
+        
+        else:
+            # باقي المفاتيح صف واحد لكل مفتاح في meta (القيمة كاملة من اللقطة الجديدة)
+            current = data.get(key, _MISSING)
+            if current is _MISSING:
+                self.conn.execute("DELETE FROM meta WHERE key = ?", (key,))
+            else:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    (key, json.dumps(current, ensure_ascii=False))
+                )
     
-    return False
-
-# ===================== نظام إدارة النقاط المحسن =====================
-
-def safe_add_points(user_id, points, operation="add", action_type=None, transaction_id=None):
-    """إضافة/خصم نقاط - نسخة آمنة (تسمح بالنقاط السالبة)"""
-    user_id = str(user_id)
-    transaction_id = transaction_id or f"tx_{user_id}_{int(time.time() * 1000)}"
+    def is_empty(self):
+        """هل القاعدة فارغة (لم يتم استيراد أي بيانات بعد)"""
+        with self.lock:
+            has_meta = self.conn.execute("SELECT 1 FROM meta LIMIT 1").fetchone()
+        return self.count_users() == 0 and not has_meta
     
-    # التحقق من التكرار باستخدام معرّف المعاملة
-    user_data = get_user_data(user_id, force_reload=True)
-    existing_tx = [t for t in user_data.get("transactions", []) if t.get("id") == transaction_id]
-    if existing_tx:
-        logger.warning(f"المعاملة مكررة: {transaction_id} للمستخدم {user_id}")
-        return False, "معاملة مكررة"
+    def data_version(self):
+        """يتغير فقط عند تعديل القاعدة من اتصال آخر (للتحقق من صلاحية الكاش)"""
+        with self.lock:
+            return self.conn.execute("PRAGMA data_version").fetchone()[0]
+    
+    def checkpoint(self):
+        """دمج ملف WAL في القاعدة الرئيسية (قبل النسخ الاحتياطي)"""
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    
+    def backup_to(self, backup_path):
+        """نسخة احتياطية متسقة باستخدام واجهة backup"""
+        with self.lock:
+            target = sqlite3.connect(backup_path)
+            try:
+                self.conn.backup(target)
+            finally:
+                target.close()
+
+_sqlite_storage = None
+_sqlite_storage_lock = threading.Lock()
+
+def get_sqlite_storage():
+    """الحصول على محرك SQLite (يُنشأ عند أول استخدام)"""
+    global _sqlite_storage
+    
+    if _sqlite_storage is None:
+        with _sqlite_storage_lock:
+            if _sqlite_storage is None:
+                _sqlite_storage = SQLiteStorage(SQLITE_FILE)
+                logger.info(f"🗄️ تم فتح قاعدة SQLite: {SQLITE_FILE}")
+    return _sqlite_storage
+
+def import_json_to_sqlite():
+    """استيراد users.json و data.json إلى SQLite (مرة واحدة)"""
+    storage = get_sqlite_storage()
+    users_data = _load_users_from_file()
+    data = _load_data_from_file()
+    
+    storage.save_all_users(users_data)
+    storage.save_data(data)
+    
+    with _cache_lock:
+        _data_cache.pop("users", None)
+        _data_cache.pop("data", None)
+    
+    logger.info(
+        f"📥 تم استيراد {len(users_data)} مستخدم و {len(data.get('channels', {}))} قناة إلى SQLite"
+    )
+    return len(users_data), len(data.get("channels", {}))
+
+def _update_cached_user(user_id, user_data):
+    """تحديث مستخدم واحد داخل الكاش بدون إعادة تحميل الكل (إصدار جديد من اللقطة)"""
+    user_id = str(user_id)
+    with _commit_locks["users"], _cache_lock:
+        if "users" not in _data_cache:
+            return
+        # إصدار جديد يشارك كل السجلات الأخرى مع السابق (بدون نسخ القاموس)
+        _data_cache["users"] = LayeredDict.of(_data_cache["users"]).with_changes(
+            {user_id: _user_record(user_data)}
+        )
+        _bump_snapshot_version("users", [(user_id,)])
+        # كتابة داخلية: الكاش مُحدث فلا داعي لإعادة القراءة بسبب تغير ملف الجزء
+        _cache_signatures["users"] = _storage_signature("users")
+
+def _update_cached_stat(stat_key, increment):
+    """تحديث إحصائية واحدة داخل الكاش بدون إعادة تجميع البيانات (إصدار جديد من اللقطة)"""
+    with _commit_locks["data"], _cache_lock:
+        if "data" in _data_cache:
+            data = dict(_data_cache["data"])
+            stats = dict(data.get("stats", {}))
+            stats[stat_key] = stats.get(stat_key, 0) + increment
+            data["stats"] = stats
+            _data_cache["data"] = data
+            _bump_snapshot_version("data", [("stats", stat_key)])
+
+# ===================== التخزين المجزأ للمستخدمين =====================
+
+class ShardedUserStore:
+    """المستخدمون موزعون على عدة ملفات حسب hash المعرّف - كل ملف بقفله الخاص"""
+    
+    def __init__(self, directory, shard_count):
+        self.directory = directory
+        self.shard_count = shard_count
+        self.locks = [threading.RLock() for _ in range(shard_count)]
+        self.count_lock = threading.Lock()
+        self.user_count = None  # يُحسب عند أول طلب ثم يُحدّث مع كل كتابة
+        os.makedirs(directory, exist_ok=True)
+    
+    def shard_of(self, user_id):
+        """رقم الجزء الخاص بالمستخدم (crc32 ثابت بين مرات التشغيل)"""
+        return zlib.crc32(str(user_id).encode("utf-8")) % self.shard_count
+    
+    def shard_path(self, index):
+        """مسار ملف الجزء"""
+        return os.path.join(self.directory, f"users_{index:03d}.json")
+    
+    def _read_shard(self, index):
+        """قراءة جزء واحد (داخلية - تتطلب القفل)"""
+        path = self.shard_path(index)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"خطأ في تحميل جزء المستخدمين {path}: {e}")
+            return {}
+    
+    def _write_shard(self, index, users_data):
+        """كتابة جزء واحد بشكل ذري (داخلية - تتطلب القفل)"""
+        return atomic_write_json(self.shard_path(index), users_data)
+    
+    def load_shard(self, index):
+        """تحميل جزء واحد"""
+        with self.locks[index]:
+            return self._read_shard(index)
+    
+    def get_user(self, user_id):
+        """قراءة مستخدم واحد (جزء واحد فقط)"""
+        index = self.shard_of(user_id)
+        with self.locks[index]:
+            return self._read_shard(index).get(str(user_id))
+    
+    def put_user(self, user_id, user_data):
+        """كتابة مستخدم واحد - التكلفة بحجم الجزء وليس بعدد المستخدمين"""
+        self.save_users({user_id: user_data})
+    
+    def save_users(self, changes):
+        """كتابة/حذف المستخدمين المتغيرين فقط ({معرّف: البيانات أو None للحذف}) - الأجزاء المعنية فقط"""
+        by_shard = defaultdict(dict)
+        for user_id, user_data in changes.items():
+            by_shard[self.shard_of(user_id)][str(user_id)] = user_data
+        
+        tickets = []
+        for index, shard_changes in by_shard.items():
+            with self.locks[index]:
+                shard = self._read_shard(index)
+                before = len(shard)
+                for user_id, user_data in shard_changes.items():
+                    if user_data is None:
+                        shard.pop(user_id, None)
+                    else:
+                        shard[user_id] = user_data
+                tickets.append(self._write_shard(index, shard))
+                self._adjust_count(len(shard) - before)
+        
+        # الانتظار خارج أقفال الأجزاء حتى يشارك الكتّاب الآخرون نفس الدفعة
+        for ticket in tickets:
+            wait_durable(ticket)
+    
+    def _adjust_count(self, delta):
+        with self.count_lock:
+            if self.user_count is not None:
+                self.user_count += delta
+    
+    def load_all_users(self):
+        """تحميل كل الأجزاء بالتوازي (للمسح الكامل مثل التوب والإحصائيات)"""
+        users_data = {}
+        with ThreadPoolExecutor(max_workers=min(8, self.shard_count)) as executor:
+            for shard in executor.map(self.load_shard, range(self.shard_count)):
+                users_data.update(shard)
+        return users_data
+    
+    def save_all_users(self, users_data):
+        """إعادة توزيع كل المستخدمين على الأجزاء"""
+        shards = [{} for _ in range(self.shard_count)]
+        for user_id, user_data in users_data.items():
+            shards[self.shard_of(user_id)][str(user_id)] = user_data
+        
+        tickets = []
+        for index, shard in enumerate(shards):
+            with self.locks[index]:
+                tickets.append(self._write_shard(index, shard))
+        
+        with self.count_lock:
+            self.user_count = len(users_data)
+        
+        for ticket in tickets:
+            wait_durable(ticket)
+    
+    def count_users(self):
+        """عدد المستخدمين في كل الأجزاء (عداد محفوظ - الأجزاء تُقرأ مرة واحدة فقط)"""
+        with self.count_lock:
+            if self.user_count is not None:
+                return self.user_count
+        
+        # العد الأول تحت أقفال كل الأجزاء (بنفس ترتيب الكتابة: الجزء ثم العداد)
+        with ExitStack() as stack:
+            for lock in self.locks:
+                stack.enter_context(lock)
+            with self.count_lock:
+                if self.user_count is None:
+                    self.user_count = sum(len(self._read_shard(i)) for i in range(self.shard_count))
+                return self.user_count
+    
+    def is_empty(self):
+        """هل لا توجد أي أجزاء بعد؟"""
+        return not any(os.path.exists(self.shard_path(i)) for i in range(self.shard_count))
+    
+    def signature(self):
+        """بصمة كل الأجزاء (mtime/الحجم/inode) بدون قراءة المحتوى"""
+        return tuple(_file_signature(self.shard_path(i)) for i in range(self.shard_count))
+    
+    def total_size(self):
+        """الحجم الكلي لملفات الأجزاء"""
+        return sum(
+            os.path.getsize(self.shard_path(i))
+            for i in range(self.shard_count)
+            if os.path.exists(self.shard_path(i))
+        )
+    
+    def export_to(self, path):
+        """تصدير كل المستخدمين في ملف JSON واحد (للنسخ الاحتياطي)"""
+        write_json_file(path, self.load_all_users())
+        return path
+
+_sharded_store = None
+_sharded_store_lock = threading.Lock()
+
+def get_sharded_store():
+    """الحصول على مخزن الأجزاء (يُنشأ عند أول استخدام)"""
+    global _sharded_store
+    
+    if _sharded_store is None:
+        with _sharded_store_lock:
+            if _sharded_store is None:
+                _sharded_store = ShardedUserStore(USERS_SHARD_DIR, USERS_SHARD_COUNT)
+                logger.info(f"🧩 تخزين مجزأ: {USERS_SHARD_COUNT} جزء في {USERS_SHARD_DIR}")
+    return _sharded_store
+
+def migrate_users_to_shards():
+    """تقسيم users.json الحالي على ملفات الأجزاء (مرة واحدة)"""
+    users_data = _load_users_from_file()
+    get_sharded_store().save_all_users(users_data)
+    
+    with _cache_lock:
+        _data_cache.pop("users", None)
+    
+    logger.info(f"🧩 تم تقسيم {len(users_data)} مستخدم على {USERS_SHARD_COUNT} جزء")
+    return len(users_data)
+
+def get_user_row_storage():
+    """المحرك الذي يدعم قراءة/كتابة مستخدم واحد (SQLite أو الأجزاء)، أو None لملف JSON"""
+    if STORAGE_ENGINE == "sqlite":
+        return get_sqlite_storage()
+    if STORAGE_ENGINE == "sharded":
+        return get_sharded_store()
+    return None
+
+def get_users_backup_source():
+    """مسار ملف المستخدمين للنسخ الاحتياطي (يُجمع من الأجزاء عند الحاجة)"""
+    if STORAGE_ENGINE == "sharded":
+        return get_sharded_store().export_to(os.path.join(BACKUP_DIR, "users_shards_export.json"))
+    return USERS_FILE
+
+# ===================== الكتابة المؤجلة (write-behind) =====================
+
+class WriteBehindStore:
+    """نسخة في الذاكرة هي المرجع، وتُكتب للملفات على دفعات بدلاً من كل تحديث"""
+    
+    def __init__(self, interval, max_dirty):
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self.lock = threading.RLock()
+        self.state = {}
+        self.dirty = {"users": 0, "data": 0}
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.total_writes = 0
+        self.total_flushes = 0
+    
+    def _source(self, key):
+        """الملف ودالة التحميل لكل مفتاح"""
+        if key == "users":
+            return USERS_FILE, lambda: _user_records(_load_users_from_file())
+        return DATA_FILE, _load_data_from_file
+    
+    def get(self, key):
+        """النسخة المرجعية (تُحمّل من الملف مرة واحدة فقط)"""
+        with self.lock:
+            if key not in self.state:
+                _, loader = self._source(key)
+                self.state[key] = loader()
+            return self.state[key]
+    
+    def put(self, key, value):
+        """استبدال النسخة المرجعية ووضع علامة التغيير"""
+        with self.lock:
+            self.state[key] = value
+            self.touch(key)
+    
+    def replace_records(self, key, changes):
+        """إصدار جديد من النسخة المرجعية بتغيير سجلات محددة فقط (السابق لا يُعدل)"""
+        with self.lock:
+            self.state[key] = LayeredDict.of(self.get(key)).with_changes(changes)
+    
+    def touch(self, key):
+        """وضع علامة التغيير بعد تعديل سجل داخل النسخة المرجعية"""
+        with self.lock:
+            self.dirty[key] += 1
+            self.total_writes += 1
+            
+            if sum(self.dirty.values()) >= self.max_dirty:
+                self.wake_event.set()
+    
+    def collect(self):
+        """تجميد المفاتيح المتغيرة كنصوص JSON وتصفير علامتها - [(المفتاح، عدد التحديثات، المحتوى)]"""
+        payloads = []
+        for key in ("users", "data"):
+            with self.lock:
+                pending = self.dirty[key]
+                if not pending:
+                    continue
+                payload = json.dumps(dict(self.state[key]), ensure_ascii=False, indent=4, default=to_json_value)
+                self.dirty[key] = 0
+            payloads.append((key, pending, payload))
+        return payloads
+    
+    def flush(self, payloads=None):
+        """كتابة المفاتيح المتغيرة فقط للملفات (يرفع أول خطأ بعد إعادة علامة التغيير)"""
+        flushed = 0
+        error = None
+        for key, pending, payload in self.collect() if payloads is None else payloads:
+            file_path, _ = self._source(key)
+            try:
+                with _file_locks[file_path]:
+                    ticket = atomic_write_text(file_path, payload)
+                wait_durable(ticket)
+                flushed += 1
+                logger.debug(f"💾 كتابة مؤجلة: {os.path.basename(file_path)} ({pending} تحديث)")
+            except Exception as e:
+                logger.error(f"❌ خطأ في الكتابة المؤجلة لـ {file_path}: {e}")
+                with self.lock:
+                    self.dirty[key] += pending
+                error = error or e
+        
+        if flushed:
+            self.total_flushes += flushed
+        if error is not None:
+            raise error
+        return flushed
+    
+    def _run(self):
+        """حلقة الكتابة الدورية"""
+        while not self.stop_event.is_set():
+            self.wake_event.wait(self.interval)
+            self.wake_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ خطأ في مدير الكتابة المؤجلة: {e}")
+    
+    def start(self):
+        """تشغيل خيط الكتابة في الخلفية"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+    
+    def stop(self):
+        """إيقاف الخيط مع كتابة آخر التغييرات"""
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"❌ تغييرات مؤجلة لم تُكتب عند الإيقاف: {e}")
+
+_write_behind_store = None
+_write_behind_lock = threading.Lock()
+
+def is_write_behind_active():
+    """الكتابة المؤجلة متاحة فقط مع محرك JSON (وتُستخدم تلقائياً مع WAL)"""
+    return (WRITE_BEHIND_ENABLED or WAL_ENABLED) and STORAGE_ENGINE == "json"
+
+def get_write_behind_store():
+    """الحصول على مخزن الكتابة المؤجلة (يُنشأ ويبدأ عند أول استخدام)"""
+    global _write_behind_store
+    
+    if _write_behind_store is None:
+        with _write_behind_lock:
+            if _write_behind_store is None:
+                store = WriteBehindStore(WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_DIRTY)
+                # مع WAL تتم الكتابة للملفات عبر الضغط الدوري فقط
+                if WRITE_BEHIND_ENABLED:
+                    store.start()
+                    logger.info(
+                        f"⏱️ الكتابة المؤجلة مفعلة: كل {WRITE_BEHIND_INTERVAL} ثانية "
+                        f"أو {WRITE_BEHIND_MAX_DIRTY} تحديث"
+                    )
+                _write_behind_store = store
+    return _write_behind_store
+
+def stop_write_behind():
+    """إيقاف مدير الكتابة المؤجلة بعد كتابة كل التغييرات"""
+    global _write_behind_store, _wal
+    
+    if _wal is not None and _write_behind_store is not None:
+        try:
+            compact_wal()
+        except Exception as e:
+            # السجلات باقية في WAL وتُستعاد عند التشغيل التالي
+            logger.error(f"❌ فشل ضغط WAL عند الإيقاف: {e}")
+        _wal.close()
+        _wal = None
+    
+    with _write_behind_lock:
+        store = _write_behind_store
+        _write_behind_store = None
+    
+    if store is None:
+        return False
+    store.stop()
+    return True
+
+def flush_pending_writes():
+    """كتابة أي تغييرات معلقة فوراً (عند الإغلاق أو قبل النسخ الاحتياطي)"""
+    persist_bot_admin_states()
+    if _ledger is not None:
+        _ledger.save_index()
+    if _dedup_index is not None:
+        _dedup_index.save()
+    daily_counters.save()
+    active_sketches.save()
+    chat_metadata.save()
+    
+    flushed = 0
+    if _write_behind_store is not None:
+        try:
+            if _wal is not None:
+                flushed = compact_wal()
+            else:
+                flushed = _write_behind_store.flush()
+        except Exception as e:
+            logger.error(f"❌ خطأ في كتابة التغييرات المعلقة: {e}")
+    
+    # مزامنة الدفعة الجماعية المفتوحة بدون انتظار نافذتها
+    _group_committer.flush()
+    return flushed
+
+def persist_bot_admin_states():
+    """نقل حالات إشراف البوت المعلقة إلى اللقطة قبل تفريغها على القرص"""
+    try:
+        bot_admin_registry.persist()
+    except Exception as e:
+        logger.error(f"❌ فشل حفظ حالات إشراف البوت: {e}")
+
+def save_on_shutdown():
+    """
+    حفظ كل ما هو معلق عند الإيقاف العادي - run_polling يعالج الإشارات بنفسه،
+    فمعالج SIGINT (flush_pending_writes) لا يُضمن تشغيله
+    """
+    persist_bot_admin_states()
+    # كتابة التغييرات المؤجلة قبل الخروج
+    if stop_write_behind():
+        logger.info("💾 تم حفظ جميع التغييرات المؤجلة")
+    close_ledger()
+    daily_counters.save()
+    active_sketches.save()
+    chat_metadata.save()
+
+# ===================== سجل الكتابة المسبقة (WAL) =====================
+
+# حقول عداد القناة التي تُسجل في WAL عند الانضمام/المغادرة
+CHANNEL_COUNTER_FIELDS = (
+    "current", "completed", "completed_at", "last_activity",
+    "uncompleted_at", "uncompleted_reason",
+    "total_joins", "total_leaves", "total_returns"
+)
+
+# سجلات القناة المحدودة وعداداتها الإجمالية
+CHANNEL_HISTORY_TOTALS = {"leave_history": "total_leaves", "return_history": "total_returns"}
+
+def normalize_channel_history(channel):
+    """
+    تحويل القناة للصيغة الحالية: joined_users قاموس حسب المستخدم، والسجلات محدودة
+    (CHANNEL_HISTORY_LIMIT) مع عدادات إجمالية جارية - القوائم القديمة تُحوّل كما هي
+    """
+    joined_users = channel.get("joined_users")
+    if not isinstance(joined_users, dict):
+        joined_users = joined_users or []
+        channel.setdefault("total_joins", len(joined_users))
+        channel["joined_users"] = {
+            str(entry.get("user_id", "")): {k: v for k, v in entry.items() if k != "user_id"}
+            for entry in joined_users
+        }
+    else:
+        channel.setdefault("total_joins", len(joined_users))
+    
+    for field, total_field in CHANNEL_HISTORY_TOTALS.items():
+        history = channel.get(field) or []
+        channel.setdefault(total_field, len(history))
+        if len(history) > CHANNEL_HISTORY_LIMIT:
+            channel[field] = history[-CHANNEL_HISTORY_LIMIT:]
+    return channel
+
+def append_channel_history(channel, field, entry):
+    """إضافة سجل إلى سجل قناة محدود (حلقي) - الأقدم يُحذف"""
+    history = channel.setdefault(field, [])
+    history.append(entry)
+    if len(history) > CHANNEL_HISTORY_LIMIT:
+        del history[:len(history) - CHANNEL_HISTORY_LIMIT]
+
+class WriteAheadLog:
+    """سجل إلحاقي مضغوط للتغييرات مع fsync جماعي"""
+    
+    def __init__(self, path, fsync_interval):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.lock = threading.RLock()
+        self.file = open(path, 'a', encoding='utf-8')
+        self.size = os.path.getsize(path)  # بالبايت - حدود السجلات المدمجة في لقطة
+        self.pending_sync = False
+        self.records = 0
+        self.total_syncs = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def append(self, record):
+        """إلحاق سجل واحد (سطر JSON) - الـ fsync يتم جماعياً"""
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=to_json_value) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            self.size += len(line.encode("utf-8"))
+            self.pending_sync = True
+            self.records += 1
+    
+    def sync(self):
+        """fsync واحد لكل التغييرات المتراكمة منذ آخر مرة"""
+        with self.lock:
+            if not self.pending_sync:
+                return False
+            os.fsync(self.file.fileno())
+            self.pending_sync = False
+            self.total_syncs += 1
+            return True
+    
+    def _run(self):
+        """حلقة fsync الجماعي"""
+        while not self.stop_event.wait(self.fsync_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"❌ خطأ في fsync لسجل WAL: {e}")
+    
+    def read_records(self):
+        """قراءة كل السجلات (يتجاهل السطر الأخير إذا كان مقطوعاً)"""
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning(f"⚠️ سطر WAL تالف تم تجاهله: {line_number}")
+        return records
+    
+    def discard_prefix(self, offset, count):
+        """حذف السجلات حتى offset (المدمجة في لقطة مكتوبة) مع إبقاء ما أُلحق بعدها"""
+        with self.lock:
+            self.file.flush()
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                tail = f.read()
+            
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            self.file.close()
+            os.replace(tmp_path, self.path)
+            self.file = open(self.path, 'a', encoding='utf-8')
+            
+            self.size = len(tail)
+            self.records = max(0, self.records - count)
+            self.pending_sync = False
+    
+    def close(self):
+        """إيقاف خيط fsync وإغلاق الملف"""
+        self.stop_event.set()
+        self.thread.join(timeout=5)
+        with self.lock:
+            if self.pending_sync:
+                os.fsync(self.file.fileno())
+            self.file.close()
+
+_wal = None
+_wal_lock = threading.Lock()
+
+def is_wal_active():
+    """سجل WAL متاح فقط مع محرك JSON"""
+    return WAL_ENABLED and STORAGE_ENGINE == "json"
+
+def get_wal():
+    """الحصول على سجل WAL (يُفتح عند أول استخدام)"""
+    global _wal
+    
+    if _wal is None:
+        with _wal_lock:
+            if _wal is None:
+                _wal = WriteAheadLog(WAL_FILE, WAL_FSYNC_INTERVAL)
+    return _wal
+
+# ترتيب الكتابة المسبقة: السجل في WAL أولاً، ثم نشر الإصدار الجديد في الذاكرة، ثم الضغط
+# (compact_wal_if_needed) - فشل الإلحاق لا يترك حالة غير مسجلة ظاهرة للقراء.
+# الإلحاق والنشر عملية واحدة أمام الضغط (_wal_publish_lock بعد قفل اللقطة): لو التُقط موقع WAL
+# بينهما لحُذف سجل لا تحتويه اللقطة المكتوبة وضاع عند الانقطاع
+_wal_publish_lock = threading.RLock()
+
+@contextmanager
+def wal_commit(cache_key):
+    """قفل اللقطة ثم قفل النشر: كل ما يُلحق في WAL داخله يُنشر قبل أي ضغط"""
+    with _commit_locks[cache_key], _wal_publish_lock:
+        yield
+
+def wal_log_change(key, record):
+    """تسجيل تغيير في WAL ووضع علامة على النسخة في الذاكرة (قبل نشره)"""
+    get_wal().append(record)
+    get_write_behind_store().touch(key)
+
+def wal_log_snapshot_changes(cache_key, changed):
+    """سجل WAL لكل مسار غيّره حفظ المحرر (استبدال أو حذف - آمن عند التكرار)"""
+    wal = get_wal()
+    for path, value in changed.items():
+        record = {"t": "p", "k": cache_key, "p": list(path)}
+        if value is _DELETED:
+            record["d"] = 1
+        else:
+            record["v"] = value
+        wal.append(record)
+
+def publish_write_behind_changes(cache_key, changes):
+    """
+    نشر إصدار جديد من النسخة المرجعية بتغيير {مسار: قيمة} فقط (بعد تسجيله في WAL) -
+    الإصدار السابق لا يُعدل، فالقراء الذين يحملونه لا يرون التغيير تحته
+    """
+    store = get_write_behind_store()
+    with _commit_locks[cache_key], store.lock:
+        value = _apply_snapshot_changes(cache_key, store.get(cache_key), changes)
+        store.put(cache_key, value)
+        with _cache_lock:
+            _bump_snapshot_version(cache_key, changes)
+    
+    if cache_key == "users":
+        _sync_user_indexes(value, changes)
+    else:
+        channel_username_index.sync(value)
+    return value
+
+def _apply_wal_record(users_data, data, record):
+    """تطبيق سجل WAL واحد على البيانات (آمن عند التكرار)"""
+    kind = record.get("t")
+    
+    if kind == "u":
+        user_data = users_data.setdefault(record["id"], create_default_user_data())
+        user_data.update(record.get("set", {}))
+        
+        # سجلات WAL قديمة كانت تحمل المعاملة داخلها
+        transaction = record.get("tx")
+        if transaction and not get_ledger().has(transaction.get("id")):
+            get_ledger().append(record["id"], transaction)
+    
+    elif kind == "p":
+        node = users_data if record.get("k") == "users" else data
+        path = record["p"]
+        for key in path[:-1]:
+            child = node.get(key)
+            if not isinstance(child, dict):
+                child = node[key] = {}
+            node = child
+        if record.get("d"):
+            node.pop(path[-1], None)
+        else:
+            node[path[-1]] = record["v"]
+    
+    elif kind == "c":
+        channel = data.get("channels", {}).get(record["id"])
+        if channel is None:
+            return False
+        
+        # رقم تسلسل لكل قناة: سجل موجود في اللقطة مسبقاً لا يُعاد تطبيقه (الإضافات ليست آمنة للتكرار)
+        sequence = record.get("n")
+        if sequence is not None:
+            if sequence <= channel.get("wal_seq", 0):
+                return True
+            channel["wal_seq"] = sequence
+        
+        normalize_channel_history(channel)
+        channel.update(record.get("set", {}))
+        
+        for field, entry in record.get("push", {}).items():
+            if field == "joined_users":
+                # سجلات WAL قديمة (قائمة)
+                entry = dict(entry)
+                record.setdefault("join", {})[str(entry.pop("user_id", ""))] = entry
+            else:
+                append_channel_history(channel, field, entry)
+        
+        channel["joined_users"].update(record.get("join", {}))
+        
+        pull_user = record.get("pull_user")
+        if pull_user:
+            channel["joined_users"].pop(pull_user, None)
+    
+    elif kind == "s":
+        data.setdefault("stats", {}).update(record.get("set", {}))
+    
+    else:
+        return False
+    
+    return True
+
+def compact_wal():
+    """
+    دمج WAL في لقطة جديدة من users.json و data.json ثم حذف السجلات المدمجة -
+    يرفع الخطأ (ويبقى WAL كما هو) إذا فشلت كتابة اللقطة
+    """
+    wal = get_wal()
+    store = get_write_behind_store()
+    
+    # الموقع والمحتوى معاً تحت قفل النشر: كل سجل قبل الموقع منشور في المحتوى المجمد
+    with _wal_publish_lock:
+        with wal.lock:
+            folded, offset = wal.records, wal.size
+        payloads = store.collect()
+    
+    # الكتابة خارج الأقفال حتى لا يتوقف الإلحاق: ما يُلحق أثناءها يبقى في الذيل،
+    # وإعادة تطبيقه على لقطة تحتويه آمنة
+    store.flush(payloads)
+    wal.discard_prefix(offset, folded)
+    
+    if folded:
+        logger.info(f"🗜️ تم ضغط {folded} سجل WAL في لقطة جديدة")
+    return folded
+
+def compact_wal_if_needed():
+    """ضغط WAL فوراً إذا تجاوز WAL_COMPACT_MAX_BYTES (الخطأ يُسجل فقط - السجلات باقية)"""
+    if get_wal().size < WAL_COMPACT_MAX_BYTES:
+        return 0
+    try:
+        return compact_wal()
+    except Exception as e:
+        logger.error(f"❌ فشل ضغط WAL بعد تجاوز الحد: {e}")
+        return 0
+
+def recover_from_wal():
+    """تحميل آخر لقطة ثم إعادة تطبيق ذيل WAL (عند بدء التشغيل)"""
+    wal = get_wal()
+    store = get_write_behind_store()
+    records = wal.read_records()
+    
+    if not records:
+        return 0
+    
+    # السجلات تُطبق على نسخ خاصة ثم تُنشر كإصدار جديد (مرة واحدة عند بدء التشغيل)
+    with _commit_locks["users"], _commit_locks["data"], store.lock:
+        users_data = to_json_value(dict(store.get("users")))
+        data = _fast_copy(store.get("data"))
+        applied = sum(1 for record in records if _apply_wal_record(users_data, data, record))
+        users_data = _user_records(users_data)
+        store.put("users", users_data)
+        store.put("data", data)
+        with _cache_lock:
+            _bump_snapshot_version("users")
+            _bump_snapshot_version("data")
+    _sync_user_indexes(users_data)
+    channel_username_index.sync(data)
+    
+    logger.info(f"♻️ تمت إعادة تطبيق {applied}/{len(records)} سجل من WAL")
+    try:
+        compact_wal()
+    except Exception as e:
+        logger.error(f"❌ فشل ضغط WAL بعد الاستعادة (السجلات باقية فيه): {e}")
+    return applied
+
+def save_channel_counter_change(channel_id, channel, push=None, pull_user=None, join=None):
+    """حفظ تغيير عداد القناة (سجل خاص) - سجل مضغوط في WAL بدلاً من إعادة كتابة data.json"""
+    if not is_wal_active():
+        editor = SnapshotEditor("data")
+        if channel_id not in editor.root.get("channels", {}):
+            return False
+        editor.container("channels")[channel_id] = channel
+        try:
+            return editor.commit()
+        except SnapshotConflict as e:
+            logger.warning(f"🔀 {e} - لم يُحفظ عداد القناة {channel_id}")
+            return False
+    
+    try:
+        # الرقم التسلسلي والإلحاق والنشر تحت نفس القفل حتى تبقى السجلات بترتيب الإصدارات
+        with wal_commit("data"):
+            current = get_write_behind_store().get("data").get("channels", {}).get(channel_id)
+            if current is None:
+                return False
+            channel["wal_seq"] = max(channel.get("wal_seq", 0), current.get("wal_seq", 0)) + 1
+            
+            record = {
+                "t": "c",
+                "id": channel_id,
+                "n": channel["wal_seq"],
+                "set": {field: channel[field] for field in CHANNEL_COUNTER_FIELDS if field in channel}
+            }
+            if push:
+                record["push"] = push
+            if join:
+                record["join"] = join
+            if pull_user:
+                record["pull_user"] = str(pull_user)
+            
+            wal_log_change("data", record)
+            publish_write_behind_changes("data", {("channels", channel_id): channel})
+    except Exception as e:
+        logger.error(f"❌ خطأ في تسجيل تغيير القناة {channel_id} في WAL: {e}")
+        return False
+    
+    compact_wal_if_needed()
+    return True
+
+async def periodic_wal_compaction(context: ContextTypes.DEFAULT_TYPE):
+    """ضغط دوري لسجل WAL"""
+    try:
+        compact_wal()
+    except Exception as e:
+        logger.error(f"❌ خطأ في ضغط سجل WAL: {e}")
+
+# ===================== سجل المعاملات (ledger) =====================
+
+class TransactionLedger:
+    """
+    سجل إلحاقي لكل المعاملات مع فهرس (مستخدم → مواقع السجلات) و (معرّف → موقع) -
+    ملف الفهرس أسطر JSON: كل حفظ يُلحق ما أُضيف بعد الحفظ السابق فقط
+    """
+    
+    def __init__(self, path, index_path):
+        self.path = path
+        self.index_path = index_path
+        self.lock = threading.RLock()
+        self.user_offsets = defaultdict(list)
+        self.tx_offsets = {}  # بترتيب الإضافة = بترتيب الموقع في السجل
+        self.size = 0
+        self.unsaved = 0
+        self.pending_users = defaultdict(list)
+        self.pending_tx = {}
+        self.rewrite_index = False  # إعادة كتابة كاملة (بعد التقليم أو فهرس تالف)
+        self.pruned_offset = 0  # ما قبله حُذفت معرّفاته من فهرس المعرّفات (لا يُمسح مجدداً)
+        
+        self._load_index()
+        self.file = open(path, 'ab')
+    
+    def _reset_index(self):
+        self.user_offsets, self.tx_offsets, self.size = defaultdict(list), {}, 0
+        self.rewrite_index = True
+    
+    def _load_index(self):
+        """تحميل الفهرس المحفوظ ثم فهرسة ما أُضيف بعده فقط"""
+        file_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            # حفظ انقطع في المنتصف - ما بعده يُعاد مسحه من السجل
+                            logger.warning("⚠️ سطر فهرس معاملات مقطوع - سيُعاد بناء الباقي من السجل")
+                            self.rewrite_index = True
+                            break
+                        for user_id, offsets in entry.get("users", {}).items():
+                            self.user_offsets[user_id].extend(offsets)
+                        self.tx_offsets.update(entry.get("tx", {}))
+                        self.size = entry.get("size", self.size)
+                if self.size > file_size:
+                    self._reset_index()
+            except Exception as e:
+                logger.error(f"❌ فهرس سجل المعاملات تالف - ستتم إعادة بنائه: {e}")
+                self._reset_index()
+        
+        if self.size < file_size:
+            self._scan_from(self.size)
+    
+    def _scan_from(self, offset):
+        """فهرسة السجلات من موقع معين (يحذف سطراً أخيراً مقطوعاً)"""
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    # كتابة انقطعت في المنتصف - السجل غير مكتمل
+                    logger.warning(f"⚠️ حذف سجل معاملة مقطوع عند الموقع {offset}")
+                    with open(self.path, 'r+b') as truncate_file:
+                        truncate_file.truncate(offset)
+                    break
+                try:
+                    record = json.loads(line)
+                    self._index_record(record, offset)
+                except json.JSONDecodeError:
+                    logger.warning(f"⚠️ سجل معاملة تالف عند الموقع {offset}")
+                offset += len(line)
+        
+        self.size = offset
+        self.unsaved += 1
+    
+    def _index_record(self, record, offset):
+        user_id = str(record.get("user"))
+        self.user_offsets[user_id].append(offset)
+        self.pending_users[user_id].append(offset)
+        if record.get("id"):
+            self.tx_offsets[record["id"]] = offset
+            self.pending_tx[record["id"]] = offset
+    
+    def append(self, user_id, transaction):
+        """إلحاق معاملة واحدة"""
+        record = dict(transaction)
+        record["user"] = str(user_id)
+        line = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        
+        with self.lock:
+            offset = self.size
+            self.file.write(line)
+            self.file.flush()
+            if DURABILITY_LEVEL == "always":
+                os.fsync(self.file.fileno())
+            elif DURABILITY_LEVEL == "batched":
+                _group_committer.enqueue(self.path)
+            
+            self.size += len(line)
+            self._index_record(record, offset)
+            self.unsaved += 1
+            
+            if self.unsaved >= LEDGER_INDEX_SAVE_EVERY:
+                self.save_index()
+        return offset
+    
+    def extend(self, entries):
+        """إلحاق عدة معاملات (مستخدم، معاملة) بكتابة واحدة ومزامنة واحدة"""
+        records, lines = [], []
+        for user_id, transaction in entries:
+            record = dict(transaction)
+            record["user"] = str(user_id)
+            records.append(record)
+            lines.append((json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8"))
+        if not records:
+            return
+        
+        with self.lock:
+            self.file.write(b"".join(lines))
+            self.file.flush()
+            if DURABILITY_LEVEL == "always":
+                os.fsync(self.file.fileno())
+            elif DURABILITY_LEVEL == "batched":
+                _group_committer.enqueue(self.path)
+            
+            for record, line in zip(records, lines):
+                self._index_record(record, self.size)
+                self.size += len(line)
+            self.unsaved += len(records)
+            
+            if self.unsaved >= LEDGER_INDEX_SAVE_EVERY:
+                self.save_index()
+    
+    def records_from(self, offset):
+        """قراءة السجلات المضافة بعد موقع معين"""
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+    
+    def has(self, transaction_id):
+        """هل المعاملة مسجلة من قبل؟"""
+        return transaction_id in self.tx_offsets
+    
+    def count(self, user_id):
+        """عدد معاملات المستخدم"""
+        return len(self.user_offsets.get(str(user_id), []))
+    
+    def _read_at(self, f, offset):
+        f.seek(offset)
+        return json.loads(f.readline())
+    
+    def get(self, transaction_id):
+        """قراءة معاملة واحدة بالمعرّف"""
+        offset = self.tx_offsets.get(transaction_id)
+        if offset is None:
+            return None
+        with open(self.path, 'rb') as f:
+            return self._read_at(f, offset)
+    
+    def page(self, user_id, page=0, per_page=10):
+        """صفحة من معاملات المستخدم (الأحدث أولاً) - تُقرأ السجلات المطلوبة فقط"""
+        offsets = self.user_offsets.get(str(user_id), [])
+        end = len(offsets) - page * per_page
+        start = max(0, end - per_page)
+        if end <= 0:
+            return []
+        
+        with open(self.path, 'rb') as f:
+            return [self._read_at(f, offset) for offset in reversed(offsets[start:end])]
+    
+    def _offset_before(self, cutoff, offset=0):
+        """
+        أول موقع سجل وقته ≥ cutoff - مسح خطي من offset يتوقف عند أول سجل حديث
+        (السجلات تُلحق بترتيب زمني، فالتكلفة بحجم الجزء القديم فقط)
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    recorded_at = to_timestamp(json.loads(line).get("timestamp"), cutoff)
+                except json.JSONDecodeError:
+                    recorded_at = 0
+                if recorded_at >= cutoff:
+                    break
+                offset += len(line)
+        return offset
+    
+    def prune_tx_index(self, max_age):
+        """
+        حذف معرّفات المعاملات الأقدم من max_age من فهرس المعرّفات (السجل نفسه وصفحات
+        المستخدمين لا تتغير) - مسح خطي يبدأ من حيث توقف التقليم السابق
+        """
+        cutoff = time.time() - max_age
+        with self.lock:
+            self.pruned_offset = self._offset_before(cutoff, min(self.pruned_offset, self.size))
+            
+            # المعرّفات مرتبة بالموقع: الحذف يتوقف عند أول معرّف بعد الحد
+            pruned = []
+            for transaction_id, offset in self.tx_offsets.items():
+                if offset >= self.pruned_offset:
+                    break
+                pruned.append(transaction_id)
+            
+            for transaction_id in pruned:
+                del self.tx_offsets[transaction_id]
+                self.pending_tx.pop(transaction_id, None)
+            if pruned:
+                self.rewrite_index = True
+                self.unsaved += 1
+        return len(pruned)
+    
+    def compact(self, max_age):
+        """
+        حذف المعاملات الأقدم من max_age من السجل نفسه: نسخ الجزء الحديث إلى ملف جديد
+        واستبداله ذرياً، ثم إزاحة مواقع الفهرس بنفس المقدار (بدون إعادة قراءة السجل)
+        """
+        cutoff = time.time() - max_age
+        with self.lock:
+            cut = self._offset_before(cutoff)
+            if not cut:
+                return 0
+            
+            temp_path = self.path + ".tmp"
+            with open(self.path, 'rb') as source, open(temp_path, 'wb') as target:
+                source.seek(cut)
+                shutil.copyfileobj(source, target)
+                target.flush()
+                os.fsync(target.fileno())
+            
+            self.file.close()
+            os.replace(temp_path, self.path)
+            self.file = open(self.path, 'ab')
+            
+            # انقطاع قبل حفظ الفهرس: حجمه المحفوظ أكبر من الملف فيُعاد بناؤه عند التشغيل
+            removed = 0
+            user_offsets = defaultdict(list)
+            for user_id, offsets in self.user_offsets.items():
+                kept = [offset - cut for offset in offsets if offset >= cut]
+                removed += len(offsets) - len(kept)
+                if kept:
+                    user_offsets[user_id] = kept
+            self.user_offsets = user_offsets
+            self.tx_offsets = {
+                transaction_id: offset - cut for transaction_id, offset in self.tx_offsets.items() if offset >= cut
+            }
+            self.size -= cut
+            self.pruned_offset = max(0, self.pruned_offset - cut)
+            self.pending_users, self.pending_tx = defaultdict(list), {}
+            self.rewrite_index = True
+            self.unsaved += 1
+            self.save_index()
+        return removed
+    
+    def save_index(self):
+        """حفظ الفهرس حتى لا يُعاد مسح السجل كاملاً عند التشغيل (إلحاق الجديد فقط)"""
+        with self.lock:
+            if not self.unsaved:
+                return
+            
+            if self.rewrite_index:
+                index = {"size": self.size, "users": self.user_offsets, "tx": self.tx_offsets}
+                payload = json.dumps(index, ensure_ascii=False, separators=(",", ":")) + "\n"
+                wait_durable(atomic_write_text(self.index_path, payload))
+                self.rewrite_index = False
+            else:
+                delta = {"size": self.size, "users": self.pending_users, "tx": self.pending_tx}
+                with open(self.index_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(delta, ensure_ascii=False, separators=(",", ":")) + "\n")
+                    f.flush()
+                    if DURABILITY_LEVEL == "always":
+                        os.fsync(f.fileno())
+                    elif DURABILITY_LEVEL == "batched":
+                        _group_committer.enqueue(self.index_path)
+            
+            self.pending_users = defaultdict(list)
+            self.pending_tx = {}
+            self.unsaved = 0
+    
+    def close(self):
+        with self.lock:
+            self.save_index()
+            self.file.close()
+
+_ledger = None
+_ledger_lock = threading.RLock()
+
+def get_ledger():
+    """الحصول على سجل المعاملات (يُفتح عند أول استخدام)"""
+    global _ledger
+    
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                _ledger = TransactionLedger(LEDGER_FILE, LEDGER_INDEX_FILE)
+    return _ledger
+
+def close_ledger():
+    """حفظ فهرس السجل وفهرس منع التكرار وإغلاقهما (عند الإغلاق)"""
+    global _ledger, _dedup_index
+    
+    with _ledger_lock:
+        if _dedup_index is not None:
+            _dedup_index.save()
+        ledger, _ledger, _dedup_index = _ledger, None, None
+    if ledger is not None:
+        ledger.close()
+
+class TransactionDedupIndex:
+    """فهرس المعاملات المنفذة: معرّف → {نوع العملية: وقت الانتهاء}
+    
+    فحص التكرار O(1) لا يعتمد على حجم سجل المستخدم، والفهرس يُحفظ على القرص
+    ويُكمل عند التشغيل من سجل المعاملات (ما أُضيف بعد آخر حفظ).
+    """
+    
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.ledger_size = 0
+        self.dirty = False
+        
+        self._load()
+    
+    def _load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+                self.entries = saved.get("entries", {})
+                self.ledger_size = saved.get("ledger_size", 0)
+            except Exception as e:
+                logger.error(f"❌ فهرس منع التكرار تالف - ستتم إعادة بنائه من سجل المعاملات: {e}")
+        
+        # إكمال الفهرس من المعاملات المسجلة بعد آخر حفظ
+        ledger = get_ledger()
+        if self.ledger_size > ledger.size:
+            self.entries, self.ledger_size = {}, 0
+        
+        now = time.time()
+        for record in ledger.records_from(self.ledger_size):
+            recorded_at = to_timestamp(record.get("timestamp"), now)
+            if recorded_at + self.ttl > now and record.get("id"):
+                self.entries.setdefault(record["id"], {})[record.get("action") or ""] = recorded_at + self.ttl
+                self.dirty = True
+        self.ledger_size = ledger.size
+    
+    def contains(self, transaction_id, action_type=None):
+        """هل نُفذت المعاملة (بهذا النوع، أو بأي نوع إن لم يُحدد)؟"""
+        actions = self.entries.get(transaction_id)
+        if not actions:
+            return False
+        
+        now = time.time()
+        if action_type is None:
+            return any(expires > now for expires in actions.values())
+        return actions.get(action_type, 0) > now
+    
+    def add(self, transaction_id, action_type):
+        """تسجيل معاملة منفذة"""
+        with self.lock:
+            self.entries.setdefault(transaction_id, {})[action_type] = time.time() + self.ttl
+            self.dirty = True
+    
+    def purge_expired(self):
+        """حذف المعاملات المنتهية الصلاحية"""
+        now = time.time()
+        with self.lock:
+            expired = [
+                transaction_id for transaction_id, actions in self.entries.items()
+                if all(expires <= now for expires in actions.values())
+            ]
+            for transaction_id in expired:
+                del self.entries[transaction_id]
+            if expired:
+                self.dirty = True
+        return len(expired)
+    
+    def save(self):
+        """حفظ الفهرس (فقط إذا تغير)"""
+        with self.lock:
+            if not self.dirty:
+                return
+            # حجم السجل يُقرأ بعد الإضافات: كل ما قبله موجود في الفهرس
+            snapshot = {"ledger_size": get_ledger().size, "entries": dict(self.entries)}
+            self.dirty = False
+        write_json_file(self.path, snapshot, indent=None)
+
+_dedup_index = None
+
+def get_dedup_index():
+    """الحصول على فهرس منع التكرار (يُحمّل عند أول استخدام)"""
+    global _dedup_index
+    
+    if _dedup_index is None:
+        with _ledger_lock:
+            if _dedup_index is None:
+                _dedup_index = TransactionDedupIndex(DEDUP_INDEX_FILE, TRANSACTION_DEDUP_TTL)
+    return _dedup_index
+
+def is_duplicate_transaction(transaction_id, action_type=None):
+    """فحص O(1) لتكرار معاملة"""
+    return bool(transaction_id) and get_dedup_index().contains(transaction_id, action_type)
+
+def record_transactions(entries):
+    """
+    تسجيل معاملات محفوظة: فهرس التكرار ثم سجل المعاملات بكتابة واحدة -
+    entries قائمة (مستخدم، معرّف، إجراء، تحديثات)
+    """
+    if not entries:
+        return
+    timestamp = now_ts()
+    dedup_index = get_dedup_index()
+    for _, transaction_id, action_type, _ in entries:
+        dedup_index.add(transaction_id, action_type)
+    get_ledger().extend(
+        (user_id, {"id": transaction_id, "action": action_type, "timestamp": timestamp, "updates": updates})
+        for user_id, transaction_id, action_type, updates in entries
+    )
+
+def migrate_transactions_to_ledger():
+    """نقل قوائم transactions القديمة من سجلات المستخدمين إلى سجل المعاملات (مرة واحدة)"""
+    ledger = get_ledger()
+    editor = SnapshotEditor("users")
+    moved = 0
+    
+    for user_id, user_view in editor.view().items():
+        if "transactions" not in user_view:
+            continue
+        
+        for transaction in user_view["transactions"]:
+            transaction_id = transaction.get("id")
+            if transaction_id and ledger.has(transaction_id):
+                continue
+            ledger.append(user_id, transaction.copy())
+            moved += 1
+        
+        del editor.container(user_id)["transactions"]
+    
+    if editor.changed:
+        editor.commit()
+        ledger.save_index()
+        logger.info(f"📒 تم نقل {moved} معاملة إلى سجل المعاملات")
+    return moved
+
+# ===================== اللقطات ذات الإصدارات =====================
+
+_MISSING = object()
+_DELETED = object()  # علامة حذف مفتاح داخل طبقة التغييرات
+
+class LayeredDict(Mapping):
+    """
+    قاموس ثابت = قاعدة مشتركة + طبقة تغييرات صغيرة: إصدار جديد بتغيير سجل واحد يكلف
+    حجم الطبقة (≤ √N) وليس عدد السجلات، والطبقة تُدمج في قاعدة جديدة عندما تكبر
+    """
+    
+    __slots__ = ("base", "layer", "_len")
+    
+    def __init__(self, base, layer=None, length=None):
+        self.base = base
+        self.layer = {} if layer is None else layer
+        self._len = len(base) if length is None else length
+    
+    @classmethod
+    def of(cls, mapping):
+        """تغليف قاموس عادي (يصبح ملكاً للقطة) أو إعادته كما هو"""
+        return mapping if isinstance(mapping, LayeredDict) else cls(mapping)
+    
+    def __getitem__(self, key):
+        value = self.layer.get(key, _MISSING)
+        if value is _MISSING:
+            return self.base[key]
+        if value is _DELETED:
+            raise KeyError(key)
+        return value
+    
+    def get(self, key, default=None):
+        value = self.layer.get(key, _MISSING)
+        if value is _MISSING:
+            return self.base.get(key, default)
+        return default if value is _DELETED else value
+    
+    def __contains__(self, key):
+        value = self.layer.get(key, _MISSING)
+        if value is _MISSING:
+            return key in self.base
+        return value is not _DELETED
+    
+    def __iter__(self):
+        layer = self.layer
+        if not layer:
+            yield from self.base
+            return
+        for key in self.base:
+            if layer.get(key) is not _DELETED:
+                yield key
+        for key, value in layer.items():
+            if value is not _DELETED and key not in self.base:
+                yield key
+    
+    def __len__(self):
+        return self._len
+    
+    def __repr__(self):
+        return f"LayeredDict({len(self)} عنصر, طبقة {len(self.layer)})"
+    
+    def with_changes(self, changes):
+        """إصدار جديد بعد تطبيق {مفتاح: قيمة أو _DELETED} - هذا الإصدار لا يتغير"""
+        layer = dict(self.layer)
+        length = self._len
+        for key, value in changes.items():
+            present = key in self
+            if value is _DELETED:
+                if not present:
+                    continue
+                length -= 1
+                if key in self.base:
+                    layer[key] = _DELETED
+                else:
+                    layer.pop(key, None)
+            else:
+                if not present:
+                    length += 1
+                layer[key] = value
+        
+        if len(layer) > max(64, math.isqrt(len(self.base))):
+            # دمج الطبقة: O(N) مرة كل √N تغيير = O(√N) لكل كتابة في المتوسط
+            base = dict(self.base)
+            for key, value in layer.items():
+                if value is _DELETED:
+                    base.pop(key, None)
+                else:
+                    base[key] = value
+            return LayeredDict(base)
+        return LayeredDict(self.base, layer, length)
+
+class _ChangeMap(LayeredDict, MutableMapping):
+    """جذر قابل للتعديل داخل المحرر فوق لقطة (بدون نسخها) - يسجل المفاتيح المتغيرة فقط"""
+    
+    __slots__ = ()
+    
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._len += 1
+        self.layer[key] = value
+    
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._len -= 1
+        self.layer[key] = _DELETED
+
+class SnapshotConflict(Exception):
+    """تعديل متزامن لنفس السجل - يجب إعادة التعديل على أحدث إصدار"""
+
+class ReadOnlyDict(Mapping):
+    """عرض للقراءة فقط فوق قاموس داخل اللقطة - بدون نسخ"""
+    
+    __slots__ = ("_data", "version")
+    
+    def __init__(self, data, version=None):
+        self._data = data
+        self.version = version
+    
+    def __getitem__(self, key):
+        return _read_only(self._data[key])
+    
+    def __contains__(self, key):
+        return key in self._data
+    
+    def __iter__(self):
+        return iter(self._data)
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __repr__(self):
+        return f"ReadOnlyDict({self._data!r})"
+    
+    def copy(self):
+        """نسخة خاصة قابلة للتعديل"""
+        return _fast_copy(self._data)
+
+class ReadOnlyList(Sequence):
+    """عرض للقراءة فقط فوق قائمة داخل اللقطة - بدون نسخ"""
+    
+    __slots__ = ("_data",)
+    
+    def __init__(self, data):
+        self._data = data
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ReadOnlyList(self._data[index])
+        return _read_only(self._data[index])
+    
+    def __contains__(self, value):
+        return value in self._data
+    
+    def __iter__(self):
+        return map(_read_only, self._data)
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __eq__(self, other):
+        if isinstance(other, ReadOnlyList):
+            other = other._data
+        return self._data == other
+    
+    def __repr__(self):
+        return f"ReadOnlyList({self._data!r})"
+    
+    def copy(self):
+        """نسخة خاصة قابلة للتعديل"""
+        return _fast_copy(self._data)
+
+def _read_only(value):
+    """تغليف القواميس والقوائم (والسجلات المضغوطة) بعرض للقراءة فقط"""
+    if isinstance(value, (dict, SlotRecord)):
+        return ReadOnlyDict(value)
+    if isinstance(value, (list, MembershipSet)):
+        return ReadOnlyList(value)
+    return value
+
+def _fast_copy(value):
+    """نسخة عميقة سريعة (JSON عبر marshal، والسجلات المضغوطة عبر نسخها الخاص)"""
+    if isinstance(value, (SlotRecord, MembershipSet)):
+        return value.copy()
+    if isinstance(value, LayeredDict):
+        value = dict(value)
+    try:
+        return marshal.loads(marshal.dumps(value))
+    except ValueError:
+        # حاوية تحتوي سجلات مضغوطة (مثل joined_channels)
+        if isinstance(value, dict):
+            return {key: _fast_copy(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [_fast_copy(item) for item in value]
+        return copy.deepcopy(value)
+
+def _shallow_copy(value):
+    """نسخة سطحية لحاوية داخل اللقطة (قاموس، قائمة، سجل مضغوط أو مجموعة عضوية)"""
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, SlotRecord):
+        return value.shallow_copy()
+    if isinstance(value, MembershipSet):
+        return value.copy()
+    return list(value)
+
+_snapshot_versions = defaultdict(int)
+# (الإصدار، المسارات المتغيرة أو None لتغيير كامل) لآخر الإصدارات - لدمج التعديلات المتزامنة
+_snapshot_changes = defaultdict(lambda: deque(maxlen=SNAPSHOT_CHANGE_LOG_SIZE))
+
+def _file_signature(path):
+    """بصمة رخيصة للملف بدون قراءة محتواه"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def _storage_signature(cache_key):
+    """بصمة مصدر البيانات الحالي - تتغير فقط إذا تغير المصدر فعلاً"""
+    if STORAGE_ENGINE == "sqlite":
+        return ("sqlite", get_sqlite_storage().data_version())
+    if cache_key == "users" and STORAGE_ENGINE == "sharded":
+        return get_sharded_store().signature()
+    return _file_signature(USERS_FILE if cache_key == "users" else DATA_FILE)
+
+def _bump_snapshot_version(cache_key, changed=None):
+    """رفع إصدار اللقطة وتسجيل مساراتها المتغيرة (None = كل شيء) - يُستدعى تحت _cache_lock"""
+    _snapshot_versions[cache_key] += 1
+    version = _snapshot_versions[cache_key]
+    _snapshot_changes[cache_key].append((version, None if changed is None else frozenset(changed)))
+    return version
+
+def _changes_since(cache_key, version):
+    """كل المسارات المتغيرة بعد إصدار معين، أو None إذا كان بينها تغيير كامل أو خرج من السجل"""
+    with _cache_lock:
+        current = _snapshot_versions[cache_key]
+        newer = [changed for v, changed in _snapshot_changes[cache_key] if v > version]
+    
+    if len(newer) != current - version or None in newer:
+        return None
+    return frozenset().union(*newer)
+
+def _paths_overlap(paths, other_paths):
+    """هل يتقاطع مساران (أحدهما نفس الآخر أو جزء منه)؟"""
+    prefixes = {path[:i] for path in other_paths for i in range(1, len(path))}
+    return any(
+        path in prefixes or any(path[:i] in other_paths for i in range(1, len(path) + 1))
+        for path in paths
+    )
+
+def _apply_snapshot_changes(cache_key, snapshot, changes):
+    """لقطة جديدة = اللقطة + {مسار: قيمة أو _DELETED} - تُنسخ فقط الحاويات على المسارات المتغيرة"""
+    if cache_key == "users":
+        # سجلات المستخدمين في اللقطة دائماً UserRecord (JSON الخام يُحوّل عند النشر)
+        return LayeredDict.of(snapshot).with_changes({
+            path[0]: value if value is _DELETED else _to_user_record(value) for path, value in changes.items()
+        })
+    
+    root = dict(snapshot)
+    copied = set()
+    for path, value in changes.items():
+        node = root
+        for key in path[:-1]:
+            child = node.get(key)
+            if id(child) not in copied:
+                child = dict(child) if isinstance(child, dict) else {}
+                copied.add(id(child))
+                node[key] = child
+            node = child
+        if value is _DELETED:
+            node.pop(path[-1], None)
+        else:
+            node[path[-1]] = value
+    return root
+
+def _publish_snapshot(cache_key, value, signature, changed=None):
+    """نشر لقطة جديدة - لا تُعدل بعد النشر، فقط تُستبدل بإصدار أحدث"""
+    with _cache_lock:
+        _data_cache[cache_key] = value
+        _cache_signatures[cache_key] = signature
+        generation = _bump_snapshot_version(cache_key, changed)
+    
+    if cache_key == "users":
+        _sync_user_indexes(value, changed)
+    else:
+        channel_username_index.sync(value)
+    return generation
+
+def _sync_user_indexes(users_data, changed=None):
+    """مزامنة فهارس المستخدمين مع لقطة جديدة: المعرّفات المتغيرة فقط، أو فحص كامل (تحميل/ترحيل)"""
+    user_ids = None if changed is None else {path[0] for path in changed}
+    channel_user_index.sync(users_data, user_ids)
+    username_index.sync(users_data, user_ids)
+    user_columns.sync(users_data, user_ids)
+
+def get_snapshot_version(cache_key):
+    """رقم إصدار اللقطة الحالية (يزيد مع كل حفظ)"""
+    return _snapshot_versions[cache_key]
+
+class SnapshotEditor:
+    """
+    تعديل لقطة بالنسخ عند الكتابة: تُنسخ فقط العناصر على المسار المعدل،
+    والباقي مشترك مع اللقطة السابقة (التي لا تتغير) - الحفظ يطبق المسارات المتغيرة
+    فقط على أحدث إصدار، وتعديل متزامن لنفس المسار يرفع SnapshotConflict
+    """
+    
+    def __init__(self, cache_key, force_reload=True):
+        self.cache_key = cache_key
+        # اللقطة ورقم إصدارها معاً (كل حفظ يمر بنفس القفل)
+        with _commit_locks[cache_key]:
+            self.root = _ChangeMap(_get_snapshot(cache_key, force_reload))
+            self.base_version = get_snapshot_version(cache_key)
+        self.changed = False
+        self._private = {id(self.root)}
+        self._owned = [self.root]  # الاحتفاظ بالمراجع حتى لا يُعاد استخدام id
+        self._origins = {}  # id(نسخة سطحية) → الأصل في اللقطة
+    
+    def view(self):
+        """عرض للقراءة فقط للحالة الحالية داخل المحرر"""
+        return ReadOnlyDict(self.root, self.base_version)
+    
+    def _own(self, value):
+        self._private.add(id(value))
+        self._owned.append(value)
+        return value
+    
+    def container(self, *path):
+        """قاموس/قائمة خاصة على المسار لإضافة أو حذف مفاتيح (نسخ سطحي)"""
+        node = self.root
+        for key in path:
+            child = node[key]
+            if id(child) not in self._private:
+                original = child
+                child = self._own(_shallow_copy(child))
+                self._origins[id(child)] = original
+                node[key] = child
+            node = child
+        self.changed = True
+        return node
+    
+    def edit(self, *path):
+        """سجل خاص قابل للتعديل على المسار (نسخ عميق للسجل فقط)"""
+        parent = self.container(*path[:-1])
+        record = parent[path[-1]]
+        if id(record) not in self._private:
+            record = _fast_copy(record)
+            # كل ما بداخل النسخة العميقة خاص أيضاً
+            stack = [record]
+            while stack:
+                item = stack.pop()
+                self._own(item)
+                children = item.values() if isinstance(item, Mapping) else item
+                stack.extend(c for c in children if isinstance(c, (dict, list, SlotRecord, MembershipSet)))
+            parent[path[-1]] = record
+        return record
+    
+    def _collect_changes(self, root):
+        """
+        المسارات المتغيرة: مفاتيح الجذر (معرّف المستخدم)، وللبيانات مفاتيح الحاويات
+        المنسوخة سطحياً أيضاً (قناة، إحصائية، مكتوم) حتى لا تتضارب تعديلات مختلفة فيها
+        """
+        changes = {}
+        for key, value in root.layer.items():
+            original = self._origins.get(id(value), _MISSING)
+            if self.cache_key == "data" and isinstance(value, dict) and isinstance(original, dict):
+                for sub_key in value.keys() | original.keys():
+                    new_item = value.get(sub_key, _DELETED)
+                    old_item = original.get(sub_key, _DELETED)
+                    if new_item is not old_item and new_item != old_item:
+                        changes[(key, sub_key)] = new_item
+            else:
+                changes[(key,)] = value
+        return changes
+    
+    def commit(self, backup=False):
+        """حفظ ونشر الإصدار الجديد (بدون نسخ كامل) - يرفع SnapshotConflict عند تضارب نفس المسار"""
+        if not self.changed:
+            return True
+        
+        root, self.root = self.root, None
+        changes = self._collect_changes(root)
+        if not changes:
+            return True
+        
+        with _commit_locks[self.cache_key]:
+            latest = _get_snapshot(self.cache_key)
+            if get_snapshot_version(self.cache_key) != self.base_version:
+                concurrent = _changes_since(self.cache_key, self.base_version)
+                if concurrent is None or _paths_overlap(changes, concurrent):
+                    raise SnapshotConflict(f"اللقطة {self.cache_key} تغيرت في نفس المسارات أثناء التعديل")
+                logger.debug(f"🔀 دمج {len(changes)} تغيير على أحدث إصدار من {self.cache_key}")
+            
+            snapshot = _apply_snapshot_changes(self.cache_key, latest, changes)
+            if self.cache_key == "users":
+                return _save_users_snapshot(snapshot, backup, changed=changes)
+            return _save_data_snapshot(snapshot, backup, changed=changes)
+
+@contextmanager
+def edit_snapshot(cache_key, backup=False):
+    """واجهة الكتابة: with edit_snapshot("data") as editor: editor.edit("channels", cid)[...] = ..."""
+    editor = SnapshotEditor(cache_key)
+    yield editor
+    if editor.root is not None:
+        editor.commit(backup)
+
+# ===================== وظائف التخزين المحسنة =====================
+
+def get_data_with_cache(cache_key, load_func, file_lock):
+    """اللقطة الحالية بدون نسخ - تُعاد القراءة فقط إذا تغيرت بصمة الملف (لا تُعدل)"""
+    with _cache_lock:
+        cached = _data_cache.get(cache_key)
+        known_signature = _cache_signatures.get(cache_key)
+    
+    if cached is not None and _storage_signature(cache_key) == known_signature:
+        return cached
+    
+    with _commit_locks[cache_key], file_lock:
+        # البصمة قبل القراءة: أي تغيير أثناء القراءة يُكتشف في المرة التالية
+        signature = _storage_signature(cache_key)
+        data = load_func()
+        _publish_snapshot(cache_key, data, signature)
+        return data
+
+def _load_users_from_file():
+    """تحميل المستخدمين من الملف (داخلية)"""
+    if os.path.exists(USERS_FILE):
+        try:
+            with open(USERS_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"خطأ في تحميل المستخدمين: {e}")
+            return {}
+    return {}
+
+def _load_users_from_storage():
+    """تحميل المستخدمين من محرك التخزين الحالي كسجلات UserRecord (داخلية)"""
+    storage = get_user_row_storage()
+    if storage is not None:
+        return _user_records(storage.load_all_users())
+    return _user_records(_load_users_from_file())
+
+def _load_data_from_file():
+    """تحميل البيانات من الملف (داخلية)"""
+    if os.path.exists(DATA_FILE):
+        try:
+            with open(DATA_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except json.JSONDecodeError as e:
+            logger.error(f"خطأ JSON في ملف البيانات: {e}")
+            return create_initial_data()
+        except Exception as e:
+            logger.error(f"خطأ في تحميل البيانات: {e}")
+            return create_initial_data()
+    return create_initial_data()
+
+def _load_data_from_storage():
+    """تحميل البيانات من محرك التخزين الحالي (داخلية)"""
+    if STORAGE_ENGINE == "sqlite":
+        return get_sqlite_storage().load_data()
+    return _load_data_from_file()
+
+def _get_snapshot(cache_key, force_reload=False):
+    """اللقطة الخام الحالية (داخلية - للقراءة فقط)"""
+    if is_write_behind_active():
+        # مع الكتابة المؤجلة النسخة في الذاكرة هي المرجع (السجلات تُستبدل ولا تُعدل)
+        return get_write_behind_store().get(cache_key)
+    
+    if cache_key == "users":
+        load_func, file_lock = _load_users_from_storage, _file_locks[USERS_FILE]
+    else:
+        load_func, file_lock = _load_data_from_storage, _file_locks[DATA_FILE]
+    
+    # force_reload لم يعد يتطلب قراءة القرص: البصمة تُفحص مع كل قراءة
+    return get_data_with_cache(cache_key, load_func, file_lock)
+
+def get_users_view(force_reload=False):
+    """المستخدمون للقراءة فقط - O(1) بدون نسخ"""
+    return ReadOnlyDict(_get_snapshot("users", force_reload), get_snapshot_version("users"))
+
+def get_data_view(force_reload=False):
+    """البيانات العامة للقراءة فقط - O(1) بدون نسخ"""
+    return ReadOnlyDict(_get_snapshot("data", force_reload), get_snapshot_version("data"))
+
+def load_users(force_reload=False):
+    """نسخة JSON خاصة قابلة للتعديل من المستخدمين (للقراءة فقط استخدم get_users_view)"""
+    return to_json_value(dict(_get_snapshot("users", force_reload)))
+
+def load_data(force_reload=False):
+    """نسخة خاصة قابلة للتعديل من البيانات (للقراءة فقط استخدم get_data_view)"""
+    return _fast_copy(_get_snapshot("data", force_reload))
+
+def save_users(users_data, backup=False):
+    """حفظ بيانات المستخدمين"""
+    # المتصل قد يستمر في تعديل القاموس بعد الحفظ، لذا تُنشر نسخة
+    return _save_users_snapshot(_fast_copy(users_data), backup)
+
+def _save_users_snapshot(users_data, backup=False, changed=None):
+    """حفظ ونشر لقطة مستخدمين جديدة (داخلية - الكائن يصبح ملكاً للقطة)"""
+    if changed is None:
+        # حفظ كامل (ترحيل/إصلاح) قد يحمل JSON خاماً
+        users_data = _user_records(users_data)
+    
+    if is_write_behind_active():
+        wal_active = is_wal_active()
+        with wal_commit("users"):
+            if wal_active and changed is not None:
+                # حفظ المحرر: سجل لكل مسار متغير في WAL قبل نشر الإصدار
+                try:
+                    wal_log_snapshot_changes("users", changed)
+                except Exception as e:
+                    logger.error(f"❌ فشل تسجيل الحفظ في WAL: {e}")
+                    return False
+            
+            get_write_behind_store().put("users", users_data)
+            with _cache_lock:
+                _bump_snapshot_version("users", changed)
+        _sync_user_indexes(users_data, changed)
+        
+        if wal_active:
+            if changed is not None:
+                # الضغط عند تجاوز الحجم أو دورياً
+                compact_wal_if_needed()
+            else:
+                # حفظ كامل (مسارات غير متكررة) = لقطة جديدة مباشرة
+                try:
+                    compact_wal()
+                except Exception as e:
+                    logger.error(f"❌ فشل تسجيل الحفظ في WAL: {e}")
+                    return False
+        return True
+    
+    with _file_locks[USERS_FILE]:
+        try:
+            storage = get_user_row_storage()
+            if storage is not None:
+                if changed is None:
+                    storage.save_all_users(users_data)
+                else:
+                    # المستخدمون المتغيرون فقط بدلاً من حذف وإعادة إدراج الكل
+                    storage.save_users({
+                        path[0]: None if value is _DELETED else value for path, value in changed.items()
+                    })
+                _publish_snapshot("users", users_data, _storage_signature("users"), changed)
+                return True
+            
+            if backup and os.path.exists(USERS_FILE):
+                backup_file = os.path.join(
+                    BACKUP_DIR, f"{os.path.basename(USERS_FILE)}.{datetime.now().strftime('%Y%m%d_%H%M%S')}.bak"
+                )
+                try:
+                    shutil.copy2(USERS_FILE, backup_file)
+                except Exception as e:
+                    logger.error(f"خطأ في إنشاء backup: {e}")
+            
+            ticket = atomic_write_json(USERS_FILE, dict(users_data))
+            _publish_snapshot("users", users_data, _storage_signature("users"), changed)
+        except Exception as e:
+            logger.error(f"خطأ في حفظ المستخدمين: {e}")
+            return False
+    
+    # انتظار fsync الجماعي خارج القفل حتى يشارك الكتّاب الآخرون نفس الدفعة
+    try:
+        wait_durable(ticket)
+        return True
+    except Exception as e:
+        logger.error(f"خطأ في حفظ المستخدمين: {e}")
+        return False
+
+def save_data(data, backup=False):
+    """حفظ البيانات العامة"""
+    # المتصل قد يستمر في تعديل القاموس بعد الحفظ، لذا تُنشر نسخة
+    return _save_data_snapshot(_fast_copy(data), backup)
+
+def _save_data_snapshot(data, backup=False, changed=None):
+    """حفظ ونشر لقطة بيانات جديدة (داخلية - الكائن يصبح ملكاً للقطة)"""
+    if is_write_behind_active():
+        wal_active = is_wal_active()
+        with wal_commit("data"):
+            if wal_active and changed is not None:
+                # حفظ المحرر: سجل لكل مسار متغير في WAL قبل نشر الإصدار
+                try:
+                    wal_log_snapshot_changes("data", changed)
+                except Exception as e:
+                    logger.error(f"❌ فشل تسجيل الحفظ في WAL: {e}")
+                    return False
+            
+            get_write_behind_store().put("data", data)
+            with _cache_lock:
+                _bump_snapshot_version("data", changed)
+        channel_username_index.sync(data)
+        
+        if wal_active:
+            if changed is not None:
+                # الضغط عند تجاوز الحجم أو دورياً
+                compact_wal_if_needed()
+            else:
+                # حفظ كامل (مسارات غير متكررة) = لقطة جديدة مباشرة
+                try:
+                    compact_wal()
+                except Exception as e:
+                    logger.error(f"❌ فشل تسجيل الحفظ في WAL: {e}")
+                    return False
+        return True
+    
+    with _file_locks[DATA_FILE]:
+        try:
+            if STORAGE_ENGINE == "sqlite":
+                # الصفوف المتغيرة فقط عند حفظ المحرر، واستبدال كامل لحفظ save_data
+                get_sqlite_storage().save_data(data, changed)
+                _publish_snapshot("data", data, _storage_signature("data"), changed)
+                return True
+            
+            if backup and os.path.exists(DATA_FILE):
+                backup_file = os.path.join(
+                    BACKUP_DIR, f"{os.path.basename(DATA_FILE)}.{datetime.now().strftime('%Y%m%d_%H%M%S')}.bak"
+                )
+                try:
+                    shutil.copy2(DATA_FILE, backup_file)
+                except Exception as e:
+                    logger.error(f"خطأ في إنشاء backup للبيانات: {e}")
+            
+            ticket = atomic_write_json(DATA_FILE, data)
+            _publish_snapshot("data", data, _storage_signature("data"), changed)
+        except Exception as e:
+            logger.error(f"خطأ في حفظ البيانات: {e}")
+            return False
+    
+    # انتظار fsync الجماعي خارج القفل حتى يشارك الكتّاب الآخرون نفس الدفعة
+    try:
+        wait_durable(ticket)
+        return True
+    except Exception as e:
+        logger.error(f"خطأ في حفظ البيانات: {e}")
+        return False
+
+def create_initial_data():
+    """إنشاء البيانات الأولية"""
+    return {
+        "channels": {},
+        "codes": {},
+        "reports": {},
+        "admins": [str(ADMIN_ID)],
+        "banned_users": [],
+        "muted_users": {},
+        "force_sub_channels": [],
+        "schema_version": SCHEMA_VERSION,
+        "users_schema_version": SCHEMA_VERSION,
+        "stats": {
+            "total_users": 0,
+            "total_points": 0,
+            "total_invites": 0,
+            "total_purchases": 0,
+            "total_joins": 0,
+            "total_reports": 0,
+            "total_daily_gifts": 0,
+            "total_mutes": 0
+        }
+    }
+
+def create_default_user_data():
+    """إنشاء بيانات المستخدم الافتراضية"""
+    return {
+        "points": 0,
+        "invites": 0,
+        "invited_users": [],
+        "bought_channels": {},
+        "joined_channels": {},
+        "username": "",
+        "first_name": "",
+        "last_name": "",
+        "first_join": now_ts(),
+        "total_earned": 0,
+        "total_spent": 0,
+        "orders": [],
+        "reports_made": 0,
+        "reports_received": 0,
+        "last_active": now_ts(),
+        "active_subscriptions": [],
+        "daily_gift": {
+            "last_claimed": None,
+            "streak": 0,
+            "total_claimed": 0
+        },
+        "reported_channels": [],
+        "inactive": False,
+        "left_channels": [],
+        "temp_left_channels": [],  # قنوات غادرها مؤقتاً (قيد التجميع)
+        "permanent_left_channels": [],  # قنوات غادرها نهائياً
+        "left_completed_channels": []  # قنوات غادرها بعد اكتمالها
+    }
+
+# ===================== السجلات المضغوطة =====================
+
+class MembershipSet:
+    """مجموعة معرفات مرتبة - عضوية O(1) مع واجهة القائمة المستخدمة (append/remove/+)"""
+    
+    __slots__ = ("_items",)
+    
+    def __init__(self, items=()):
+        self._items = dict.fromkeys(items)
+    
+    def __contains__(self, item):
+        return item in self._items
+    
+    def __iter__(self):
+        return iter(self._items)
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def __getitem__(self, index):
+        return list(self._items)[index]
+    
+    def __eq__(self, other):
+        if isinstance(other, MembershipSet):
+            return list(self._items) == list(other._items)
+        if isinstance(other, (list, tuple)):
+            return list(self._items) == list(other)
+        return NotImplemented
+    
+    def __add__(self, other):
+        return list(self._items) + list(other)
+    
+    def __repr__(self):
+        return f"MembershipSet({list(self._items)!r})"
+    
+    def append(self, item):
+        self._items[item] = None
+    
+    add = append
+    
+    def remove(self, item):
+        try:
+            del self._items[item]
+        except KeyError:
+            raise ValueError(f"{item!r} not in MembershipSet") from None
+    
+    def discard(self, item):
+        self._items.pop(item, None)
+    
+    def copy(self):
+        return MembershipSet(self._items)
+    
+    def to_json(self):
+        return list(self._items)
+
+class SlotRecord(MutableMapping):
+    """
+    أساس السجلات المضغوطة: الحقول المعروفة في __slots__ وغير المعروفة في extra -
+    واجهة القاموس كما هي، والتحويل من/إلى JSON بلا فقد
+    """
+    
+    __slots__ = ("extra",)
+    FIELDS = ()
+    CONVERTERS = {}  # حقل -> دالة تحويل من JSON
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._FIELD_SET = frozenset(cls.FIELDS)
+    
+    def __init__(self, **fields):
+        self.extra = None
+        for key, value in fields.items():
+            self[key] = value
+    
+    @classmethod
+    def from_json(cls, raw):
+        record = cls.__new__(cls)
+        record.extra = None
+        converters = cls.CONVERTERS
+        for key, value in raw.items():
+            converter = converters.get(key)
+            if converter is not None and value is not None:
+                value = converter(value)
+            record._set(key, value)
+        return record
+    
+    def to_json(self):
+        return {key: to_json_value(value) for key, value in self.items()}
+    
+    def copy(self):
+        """نسخة عميقة خاصة (بدون المرور بـ JSON)"""
+        record = type(self).__new__(type(self))
+        record.extra = None
+        for key, value in self.items():
+            if value is not None and not isinstance(value, (str, int, float, bool)):
+                value = _fast_copy(value)
+            record._set(key, value)
+        return record
+    
+    def shallow_copy(self):
+        """نسخة سطحية - القيم الداخلية مشتركة (لمحرر اللقطات)"""
+        record = type(self).__new__(type(self))
+        record.extra = None
+        for key, value in self.items():
+            record._set(key, value)
+        return record
+    
+    def __getitem__(self, key):
+        if key in self._FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+    
+    def __setitem__(self, key, value):
+        # القيم الخام (قائمة/قاموس) تُحوّل لنوع الحقل حتى يبقى السجل متسقاً
+        if isinstance(value, (list, dict)):
+            converter = self.CONVERTERS.get(key)
+            if converter is not None:
+                value = converter(value)
+        self._set(key, value)
+    
+    def _set(self, key, value):
+        if key in self._FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+    
+    def __delitem__(self, key):
+        if key in self._FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self.extra is None:
+            raise KeyError(key)
+        else:
+            del self.extra[key]
+    
+    def __contains__(self, key):
+        if key in self._FIELD_SET:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+    
+    def __iter__(self):
+        for field in self.FIELDS:
+            if hasattr(self, field):
+                yield field
+        if self.extra:
+            yield from self.extra
+    
+    def __len__(self):
+        return sum(1 for _ in self)
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+def to_json_value(value):
+    """تحويل قيمة قد تحتوي سجلات مضغوطة إلى صيغة JSON الخام للتخزين"""
+    if isinstance(value, (SlotRecord, MembershipSet)):
+        return value.to_json()
+    if isinstance(value, (ReadOnlyDict, ReadOnlyList)):
+        return to_json_value(value._data)
+    if isinstance(value, dict):
+        return {key: to_json_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_json_value(item) for item in value]
+    return value
+
+class DailyGiftRecord(SlotRecord):
+    """سجل الهدية اليومية"""
+    FIELDS = ("last_claimed", "streak", "total_claimed")
+    __slots__ = FIELDS
+
+class JoinInfoRecord(SlotRecord):
+    """سجل انضمام المستخدم لقناة"""
+    FIELDS = (
+        "channel_username", "joined_at", "verified", "points_earned", "left", "round",
+        "reactivated_at", "channel_reactivated", "join_round", "verified_at",
+        "transaction_id", "last_verified", "status", "join_type", "left_at",
+        "left_completed", "completed_round", "completed_at", "previous_versions",
+    )
+    __slots__ = FIELDS
+
+def _join_info_records(joined_channels):
+    return {
+        channel_id: JoinInfoRecord.from_json(join_info)
+        if isinstance(join_info, Mapping) and not isinstance(join_info, JoinInfoRecord) else join_info
+        for channel_id, join_info in joined_channels.items()
+    }
+
+class UserRecord(SlotRecord):
+    """سجل المستخدم - حقول العضوية كمجموعات MembershipSet"""
+    FIELDS = (
+        "points", "invites", "invited_users", "bought_channels", "joined_channels",
+        "username", "first_name", "last_name", "first_join", "total_earned", "total_spent",
+        "orders", "reports_made", "reports_received", "last_active", "active_subscriptions",
+        "daily_gift", "reported_channels", "inactive", "left_channels", "temp_left_channels",
+        "permanent_left_channels", "left_completed_channels",
+    )
+    __slots__ = FIELDS
+    CONVERTERS = {
+        "invited_users": MembershipSet,
+        "active_subscriptions": MembershipSet,
+        "reported_channels": MembershipSet,
+        "left_channels": MembershipSet,
+        "temp_left_channels": MembershipSet,
+        "permanent_left_channels": MembershipSet,
+        "left_completed_channels": MembershipSet,
+        "joined_channels": _join_info_records,
+        "daily_gift": DailyGiftRecord.from_json,
+    }
+
+def _to_user_record(user_data):
+    """سجل المستخدم كما سيُخزّن في اللقطة (JSON الخام يُحوّل بلا نسخ)"""
+    if isinstance(user_data, UserRecord):
+        return user_data
+    return UserRecord.from_json(user_data)
+
+def _user_record(user_data):
+    """نسخة UserRecord خاصة من سجل في اللقطة أو JSON خام"""
+    if isinstance(user_data, UserRecord):
+        return user_data.copy()
+    return UserRecord.from_json(_fast_copy(user_data))
+
+def _user_records(users):
+    """تحويل قاموس مستخدمين (JSON خام) إلى سجلات UserRecord في مكانه"""
+    for user_id, user_data in users.items():
+        if not isinstance(user_data, UserRecord):
+            users[user_id] = UserRecord.from_json(user_data)
+    return users
+
+class ChannelRecord(SlotRecord):
+    """سجل القناة - joined_users والسجلات تبقى كما هي (مرجع بدون نسخ)"""
+    FIELDS = (
+        "username", "owner", "required", "current", "completed", "joined_users",
+        "created_at", "completed_at", "reuse_count", "reactivated_at", "admin_added",
+        "leave_history", "return_history", "total_joins", "total_leaves", "total_returns",
+    )
+    __slots__ = FIELDS
+
+# ===================== ترحيل المخطط =====================
+# users.json قاموس (معرف -> سجل) فقط، لذا يُحفظ إصداره بجانب إصدار البيانات في data.json -
+# وملف مستخدمين مستعاد وحده يُكشف من شكل سجلاته (_users_shape_version)
+
+def _timestamp_field(container, field):
+    """تحويل حقل وقت قديم (نص) إلى epoch في مكانه"""
+    value = container.get(field)
+    if isinstance(value, str):
+        container[field] = to_timestamp(value) if value else None
+
+def _migrate_users_v1(users):
+    """v1: إكمال الحقول الناقصة مرة واحدة + تحويل الأوقات النصية إلى epoch"""
+    defaults = create_default_user_data()
+    defaults["first_join"] = defaults["last_active"] = 0
+    
+    for user_data in users.values():
+        for field, default_value in defaults.items():
+            if field not in user_data:
+                user_data[field] = _fast_copy(default_value)
+        
+        _timestamp_field(user_data, "first_join")
+        _timestamp_field(user_data, "last_active")
+        if isinstance(user_data["daily_gift"], dict):
+            _timestamp_field(user_data["daily_gift"], "last_claimed")
+        for join_info in user_data["joined_channels"].values():
+            if isinstance(join_info, dict):
+                _timestamp_field(join_info, "joined_at")
+                _timestamp_field(join_info, "reactivated_at")
+
+def _migrate_data_v1(data):
+    """v1: إكمال المفاتيح العامة + تحويل الأوقات النصية + صيغة سجلات القنوات"""
+    initial = create_initial_data()
+    for field, default_value in initial.items():
+        data.setdefault(field, default_value)
+    for field, default_value in initial["stats"].items():
+        data["stats"].setdefault(field, default_value)
+    
+    for mute_info in data["muted_users"].values():
+        if isinstance(mute_info, dict):
+            _timestamp_field(mute_info, "until")
+    
+    for channel in data["channels"].values():
+        normalize_channel_history(channel)
+        _timestamp_field(channel, "reactivated_at")
+        for entry in channel["joined_users"].values():
+            _timestamp_field(entry, "joined_at")
+
+def _timestamp_fields(container, *fields):
+    for field in fields:
+        if field in container:
+            _timestamp_field(container, field)
+
+def _migrate_users_v2(users):
+    """v2: باقي أوقات سجلات المستخدمين (المغادرة، الاكتمال، التحقق، الطلبات) إلى epoch"""
+    for user_data in users.values():
+        for join_info in user_data.get("joined_channels", {}).values():
+            if not isinstance(join_info, dict):
+                continue
+            _timestamp_fields(join_info, "left_at", "completed_at", "verified_at", "last_verified")
+            for version in join_info.get("previous_versions", []):
+                _timestamp_fields(version, "old_joined_at", "old_reactivated_at", "archived_at")
+        for entry in user_data.get("join_history", []):
+            _timestamp_fields(entry, "joined_at", "reactivated_at")
+        for order in user_data.get("orders", []):
+            _timestamp_fields(order, "created_at")
+
+def _migrate_data_v2(data):
+    """v2: أوقات القنوات وسجلاتها والكتم والبلاغات والأكواد إلى epoch"""
+    for channel in data["channels"].values():
+        _timestamp_fields(channel, "created_at", "completed_at", "last_activity", "uncompleted_at")
+        for entry in channel.get("leave_history", []):
+            _timestamp_fields(entry, "left_at")
+        for entry in channel.get("return_history", []):
+            _timestamp_fields(entry, "returned_at", "previous_leave")
+    for mute_info in data["muted_users"].values():
+        if isinstance(mute_info, dict):
+            _timestamp_fields(mute_info, "muted_at")
+    for field in ("reports", "codes"):
+        for record in data.get(field, {}).values():
+            if isinstance(record, dict):
+                _timestamp_fields(record, "created_at")
+
+# (الإصدار الهدف، ترحيل المستخدمين، ترحيل البيانات) - بالترتيب
+SCHEMA_MIGRATIONS = [
+    (1, _migrate_users_v1, _migrate_data_v1),
+    (2, _migrate_users_v2, _migrate_data_v2),
+]
+
+def _has_text_time(container, *fields):
+    return isinstance(container, Mapping) and any(isinstance(container.get(field), str) for field in fields)
+
+def _users_shape_version(users):
+    """
+    أعلى إصدار تطابقه سجلات المستخدمين فعلاً (من اللقطة بدون نسخ) - حقول ناقصة أو
+    أوقات v1 نصية = 0، أوقات v2 نصية = 1
+    """
+    required = tuple(create_default_user_data())
+    version = SCHEMA_VERSION
+    for user_data in users.values():
+        if any(field not in user_data for field in required):
+            return 0
+        if _has_text_time(user_data, "first_join", "last_active") or \
+                _has_text_time(user_data["daily_gift"], "last_claimed"):
+            return 0
+        
+        v2_entries = [(entry, ("joined_at", "reactivated_at")) for entry in user_data.get("join_history") or []]
+        v2_entries += [(order, ("created_at",)) for order in user_data.get("orders") or []]
+        for join_info in user_data["joined_channels"].values():
+            if not isinstance(join_info, Mapping):
+                continue
+            if _has_text_time(join_info, "joined_at", "reactivated_at"):
+                return 0
+            v2_entries.append((join_info, ("left_at", "completed_at", "verified_at", "last_verified")))
+            v2_entries += [
+                (old, ("old_joined_at", "old_reactivated_at", "archived_at"))
+                for old in join_info.get("previous_versions") or []
+            ]
+        if any(_has_text_time(entry, *fields) for entry, fields in v2_entries):
+            version = 1
+    return version
+
+def migrate_schema():
+    """
+    ترقية كل السجلات إلى SCHEMA_VERSION مرة واحدة ثم إعادة الكتابة مرة واحدة -
+    القراءات بعدها لا ترقّع الحقول
+    """
+    data = load_data(force_reload=True)
+    data_version = data.get("schema_version", 0)
+    users_version = data.get("users_schema_version", 0)
+    if users_version >= SCHEMA_VERSION:
+        # الإصدار المختوم في data.json لا يضمن users.json (قد يُستعاد وحده)
+        users_version = _users_shape_version(get_users_view(force_reload=True))
+    if data_version >= SCHEMA_VERSION and users_version >= SCHEMA_VERSION:
+        return False
+    
+    if users_version < SCHEMA_VERSION:
+        users = load_users(force_reload=True)
+        for version, migrate_users, _ in SCHEMA_MIGRATIONS:
+            if version > users_version:
+                migrate_users(users)
+        # المستخدمون أولاً: انقطاع بين الكتابتين يعيد الترحيل (آمن للتكرار)
+        if not _save_users_snapshot(users, backup=True):
+            raise RuntimeError("فشل حفظ المستخدمين بعد الترحيل")
+        logger.info(f"🧬 تم ترحيل {len(users)} مستخدم من الإصدار {users_version} إلى {SCHEMA_VERSION}")
+    
+    for version, _, migrate_data in SCHEMA_MIGRATIONS:
+        if version > data_version:
+            migrate_data(data)
+    data["schema_version"] = SCHEMA_VERSION
+    data["users_schema_version"] = SCHEMA_VERSION
+    if not _save_data_snapshot(data, backup=True):
+        raise RuntimeError("فشل حفظ البيانات بعد الترحيل")
+    logger.info(f"🧬 تم ترحيل البيانات من الإصدار {data_version} إلى {SCHEMA_VERSION}")
+    return True
+
+def get_user_data(user_id, force_reload=False):
+    """الحصول على بيانات المستخدم"""
+    user_id = str(user_id)
+    
+    storage = get_user_row_storage()
+    if storage is not None:
+        # قراءة مستخدم واحد فقط (صف SQLite أو جزء واحد)
+        user_data = storage.get_user(user_id)
+        
+        if user_data is None:
+            user_data = create_default_user_data()
+            storage.put_user(user_id, user_data)
+            _update_cached_user(user_id, user_data)
+            update_system_stats("total_users", increment=1)
+            daily_counters.record_new_user()
+            active_sketches.add(user_id)
+            user_columns.mark_dirty(user_id)
+        
+        return UserRecord.from_json(user_data)
+    
+    users_snapshot = _get_snapshot("users", force_reload)
+    
+    if user_id not in users_snapshot:
+        default_data = create_default_user_data()
+        update_system_stats("total_users", increment=1)
+        daily_counters.record_new_user()
+        active_sketches.add(user_id)
+        user_columns.mark_dirty(user_id)
+        
+        if is_wal_active():
+            with wal_commit("users"):
+                wal_log_change("users", {"t": "u", "id": user_id, "set": default_data})
+                _replace_write_behind_user(user_id, _fast_copy(default_data))
+            compact_wal_if_needed()
+        else:
+            with edit_snapshot("users") as editor:
+                editor.container()[user_id] = _fast_copy(default_data)
+        
+        user_data = default_data
+    else:
+        # نسخة خاصة من سجل المستخدم فقط (اللقطة تحمل UserRecord) - تعديلها لا يمس اللقطة
+        return _user_record(users_snapshot[user_id])
+    
+    return UserRecord.from_json(user_data)
+
+def _replace_write_behind_user(user_id, user_data):
+    """استبدال سجل مستخدم في النسخة المرجعية للكتابة المؤجلة (إصدار جديد بدون نسخ الكل)"""
+    with _commit_locks["users"]:
+        get_write_behind_store().replace_records("users", {user_id: _to_user_record(user_data)})
+        with _cache_lock:
+            _bump_snapshot_version("users", [(user_id,)])
+
+def update_user_data(user_id, updates, action_type=None, transaction_id=None):
+    """تحديث بيانات المستخدم"""
+    user_id = str(user_id)
+    
+    # قفل المستخدم لمنع التضارب
+    if user_id not in _user_locks:
+        _user_locks[user_id] = threading.Lock()
+    
+    # القيم قد تأتي من سجلات مضغوطة (get_user_data) - التخزين بصيغة JSON الخام
+    updates = {key: to_json_value(value) for key, value in updates.items()}
+    
+    with _user_locks[user_id]:
+        # معاملة منفذة سابقاً بنفس الإجراء لا تُطبق مرة أخرى (قبل أي تعديل)
+        if action_type and is_duplicate_transaction(transaction_id, action_type):
+            logger.warning(f"⚠️ معاملة مكررة مرفوضة: {transaction_id} ({action_type})")
+            return False
+        
+        storage = get_user_row_storage()
+        for attempt in range(SNAPSHOT_COMMIT_RETRIES):
+            if storage is not None:
+                # قراءة وكتابة المستخدم فقط (صف SQLite أو جزء واحد)
+                user_data = storage.get_user(user_id) or create_default_user_data()
+            else:
+                # نسخة خاصة من سجل هذا المستخدم فقط - باقي السجلات مشتركة مع اللقطة الحالية
+                editor = SnapshotEditor("users")
+                if user_id not in editor.view():
+                    editor.container()[user_id] = create_default_user_data()
+                user_data = editor.edit(user_id)
+            
+            # تحديث الحقول
+            for key, value in updates.items():
+                user_data[key] = value
+            
+            # تحديث وقت النشاط (علامة عدم النشاط لا تُعد نشاطاً)
+            previous_active = user_data.get("last_active", "")
+            if action_type != "inactive_mark":
+                user_data["last_active"] = now_ts()
+                user_data["inactive"] = False
+            
+            if storage is not None or is_wal_active():
+                break
+            
+            # نشر لقطة جديدة بدون نسخ كل المستخدمين (تعديل متزامن لنفس المستخدم = إعادة المحاولة)
+            try:
+                saved = editor.commit()
+                break
+            except SnapshotConflict as e:
+                logger.warning(f"🔀 {e} - إعادة تحديث المستخدم {user_id} ({attempt + 1})")
+                saved = False
+        
+        if storage is not None:
+            try:
+                storage.put_user(user_id, user_data)
+                _update_cached_user(user_id, user_data)
+                saved = True
+            except Exception as e:
+                logger.error(f"خطأ في حفظ المستخدم {user_id} ({STORAGE_ENGINE}): {e}")
+                saved = False
+        
+        elif is_wal_active():
+            # سجل مضغوط واحد بدلاً من إعادة كتابة users.json
+            try:
+                record = {"t": "u", "id": user_id, "set": dict(updates)}
+                record["set"]["last_active"] = user_data["last_active"]
+                record["set"]["inactive"] = user_data["inactive"]
+                
+                with wal_commit("users"):
+                    wal_log_change("users", record)
+                    _replace_write_behind_user(user_id, user_data)
+                saved = True
+            except Exception as e:
+                logger.error(f"خطأ في تسجيل تحديث المستخدم {user_id} في WAL: {e}")
+                saved = False
+            if saved:
+                compact_wal_if_needed()
+        
+        if saved and action_type != "inactive_mark":
+            daily_counters.record_activity(previous_active)
+            active_sketches.add(user_id)
+            channel_user_index.update_user(user_id, user_data)
+        if saved:
+            user_columns.mark_dirty(user_id)
+        if saved and "username" in updates:
+            username_index.set(user_id, updates["username"])
+        
+        # تسجيل المعاملة في فهرس التكرار ثم في سجل المعاملات (خارج سجل المستخدم)
+        if saved and action_type and transaction_id:
+            try:
+                record_transactions([(user_id, transaction_id, action_type, updates)])
+            except Exception as e:
+                logger.error(f"خطأ في تسجيل المعاملة {transaction_id}: {e}")
+        
+        return saved
+
+def update_system_stats(stat_key, increment=1, points=0):
+    """تحديث إحصائيات النظام"""
+    if STORAGE_ENGINE == "sqlite":
+        # تحديث صف الإحصائية فقط
+        try:
+            storage = get_sqlite_storage()
+            storage.increment_stat(stat_key, increment)
+            _update_cached_stat(stat_key, increment)
+            if points > 0:
+                storage.increment_stat("total_points", points)
+                _update_cached_stat("total_points", points)
+            return True
+        except Exception as e:
+            logger.error(f"خطأ في تحديث الإحصائيات: {e}")
+            return False
+    
+    if is_wal_active():
+        # القيم الجديدة من أحدث إصدار تحت القفل، ثم السجل في WAL، ثم النشر
+        try:
+            with wal_commit("data"):
+                stats = get_write_behind_store().get("data").get("stats", {})
+                changed = {stat_key: stats.get(stat_key, 0) + increment}
+                if points > 0:
+                    changed["total_points"] = stats.get("total_points", 0) + points
+                
+                wal_log_change("data", {"t": "s", "set": changed})
+                publish_write_behind_changes("data", {("stats", key): value for key, value in changed.items()})
+        except Exception as e:
+            logger.error(f"خطأ في تحديث الإحصائيات: {e}")
+            return False
+        
+        compact_wal_if_needed()
+        return True
+    
+    max_retries = 3
+    for attempt in range(max_retries):
+        try:
+            editor = SnapshotEditor("data")
+            if "stats" not in editor.view():
+                editor.container()["stats"] = {}
+            stats = editor.container("stats")
+            
+            if stat_key in stats:
+                stats[stat_key] = stats.get(stat_key, 0) + increment
+            else:
+                stats[stat_key] = increment
+            
+            if points > 0:
+                stats["total_points"] = stats.get("total_points", 0) + points
+            
+            if editor.commit():
+                return True
+                
+        except Exception as e:
+            logger.error(f"خطأ في تحديث الإحصائيات: {e}")
+            if attempt == max_retries - 1:
+                return False
+            time.sleep(0.1)
+    
+    return False
+
+# ===================== نظام إدارة النقاط المحسن =====================
+
+class PointsBatch:
+    """
+    تغييرات نقاط تُطبق على سجلات محررة ثم تُسجل معاً بعد حفظ واحد: فحص التكرار،
+    الرصيد، سجل المعاملات، العدادات اليومية والإحصائيات - مسار واحد لكل تغييرات النقاط
+    """
+    
+    def __init__(self):
+        self.entries = []  # (مستخدم، معرّف، إجراء، تحديثات)
+        self.issued = 0
+        self.spent = 0
+        self.transaction_ids = set()
+    
+    @property
+    def net(self):
+        return self.issued - self.spent
+    
+    def apply(self, user_id, user_data, points, operation="add", action_type=None, transaction_id=None, **details):
+        """تعديل رصيد سجل (بدون حفظ) - يعيد التحديثات أو None لمعاملة مكررة"""
+        user_id = str(user_id)
+        action_type = action_type or ("add_points" if operation == "add" else "subtract_points")
+        transaction_id = transaction_id or f"tx_{user_id}_{int(time.time() * 1000)}"
+        
+        if transaction_id in self.transaction_ids or is_duplicate_transaction(transaction_id, action_type):
+            logger.warning(f"المعاملة مكررة: {transaction_id} للمستخدم {user_id}")
+            return None
+        
+        if operation == "add":
+            updates = {
+                "points": user_data.get("points", 0) + points,
+                "total_earned": user_data.get("total_earned", 0) + points
+            }
+            self.issued += points
+        else:
+            # ✅ **الإصلاح: السماح بالنقاط السالبة**
+            updates = {
+                "points": user_data.get("points", 0) - points,  # يمكن أن تكون سالبة
+                "total_spent": user_data.get("total_spent", 0) + points
+            }
+            self.spent += points
+        
+        for key, value in updates.items():
+            user_data[key] = value
+        self.transaction_ids.add(transaction_id)
+        self.entries.append((user_id, transaction_id, action_type, dict(updates, **details)))
+        return updates
+    
+    def record(self, update_stats=True):
+        """بعد نجاح الحفظ: فهرس التكرار وسجل المعاملات ثم العدادات (والإحصائيات إن طُلبت)"""
+        try:
+            record_transactions(self.entries)
+        except Exception as e:
+            logger.error(f"خطأ في تسجيل {len(self.entries)} معاملة نقاط: {e}")
+        
+        if self.issued:
+            daily_counters.bump("points_issued", self.issued)
+        if self.spent:
+            daily_counters.bump("points_spent", self.spent)
+        if update_stats and self.net:
+            update_system_stats("total_points", points=self.net)
+
+def safe_add_points(user_id, points, operation="add", action_type=None, transaction_id=None):
+    """إضافة/خصم نقاط - نسخة آمنة (تسمح بالنقاط السالبة)"""
+    user_id = str(user_id)
+    
+    # قفل للمستخدم لمنع التضارب
+    user_lock_key = f"points_{user_id}"
+    _point_locks.setdefault(user_lock_key, threading.Lock())
+    
+    with _point_locks[user_lock_key]:
+        user_data = get_user_data(user_id, force_reload=True)
+        current_points = user_data.get("points", 0)
+        
+        # التحقق من التكرار (O(1) من فهرس المعاملات) ثم تعديل الرصيد
+        batch = PointsBatch()
+        updates = batch.apply(user_id, user_data, points, operation, action_type, transaction_id)
+        if updates is None:
+            return False, "معاملة مكررة"
+        
+        # المعاملة تُسجل عبر الدفعة (سجل المعاملات وفهرس التكرار) وليس عبر update_user_data
+        if update_user_data(user_id, updates):
+            batch.record(update_stats=action_type != "stats_update")
+            
+            if operation == "add":
+                return True, "تمت الإضافة بنجاح"
+            logger.info(f"💸 خصم {points} نقطة من {user_id}: {current_points} → {updates['points']}")
+            return True, "تم الخصم بنجاح"
+        
+        return False, "خطأ غير معروف"
+
+# ===================== نظام الكتم =====================
+
+def is_muted(user_id):
+    """التحقق مما إذا كان المستخدم مكتوماً"""
+    data = get_data_view()
+    user_id = str(user_id)
+    
+    if user_id in data.get("muted_users", {}):
+        mute_data = data["muted_users"][user_id]
+        mute_until = mute_data.get("until")
+        
+        if mute_until:
+            try:
+                if now_ts() < to_timestamp(mute_until):
+                    return True, format_timestamp(mute_until)
+                else:
+                    with edit_snapshot("data") as editor:
+                        editor.container("muted_users").pop(user_id, None)
+                    return False, None
+            except Exception as e:
+                logger.error(f"خطأ في معالجة وقت الكتم: {e}")
+                return False, None
+        return True, "دائم"
+    
+    return False, None
+
+def add_muted_user(user_id, mute_duration=None, reason=""):
+    """إضافة مستخدم مكتوم"""
+    user_id = str(user_id)
+    
+    mute_info = {
+        "muted_at": now_ts(),
+        "reason": reason,
+        "muted_by": ADMIN_ID
+    }
+    
+    if mute_duration:
+        mute_info["until"] = now_ts() + int(mute_duration)
+        mute_info["duration"] = mute_duration
+    
+    with edit_snapshot("data") as editor:
+        editor.container("muted_users")[user_id] = mute_info
+        stats = editor.container("stats")
+        stats["total_mutes"] = stats.get("total_mutes", 0) + 1
+    
+    return mute_info
+
+def remove_muted_user(user_id):
+    """إزالة مستخدم من قائمة المكتومين"""
+    user_id = str(user_id)
+    editor = SnapshotEditor("data")
+    
+    if user_id in editor.root.get("muted_users", {}):
+        del editor.container("muted_users")[user_id]
+        if editor.commit():
+            return True
+    
+    return False
+
+def cleanup_expired_mutes(context: ContextTypes.DEFAULT_TYPE = None):
+    """تنظيف الكتم المنتهي"""
+    try:
+        data = get_data_view()
+        muted_users = data.get("muted_users", {})
+        expired_users = []
+        
+        if isinstance(muted_users, Mapping):
+            now = now_ts()
+            for user_id, mute_data in muted_users.items():
+                mute_until = mute_data.get("until")
+                if mute_until and now >= to_timestamp(mute_until, now):
+                    expired_users.append(user_id)
+        
+        removed_count = len(expired_users)
+        if removed_count > 0:
+            with edit_snapshot("data") as editor:
+                muted = editor.container("muted_users")
+                for user_id in expired_users:
+                    muted.pop(user_id, None)
+            logger.info(f"🧹 تم تنظيف {removed_count} مستخدم منتهي الكتم")
+    
+    except Exception as e:
+        logger.error(f"خطأ في cleanup_expired_mutes: {e}")
+
+def format_time(seconds):
+    """تحويل الثواني إلى نص مقروء"""
+    if seconds == 0:
+        return "دائم"
+    
+    days = seconds // (24 * 3600)
+    seconds %= (24 * 3600)
+    hours = seconds // 3600
+    seconds %= 3600
+    minutes = seconds // 60
+    seconds %= 60
+    
+    result = []
+    if days > 0:
+        result.append(f"{days} يوم")
+    if hours > 0:
+        result.append(f"{hours} ساعة")
+    if minutes > 0:
+        result.append(f"{minutes} دقيقة")
+    if seconds > 0:
+        result.append(f"{seconds} ثانية")
+    
+    return " و ".join(result) if result else "0 ثانية"
+
+# ===================== فهارس البحث =====================
+
+class UsernameIndex:
+    """فهرس اليوزر (بحروف موحدة) → معرّف المستخدم"""
+    
+    def __init__(self):
+        self.by_username = {}
+        self.by_user = {}
+        self.records = {}  # آخر كائن مفهرس لكل مستخدم (للمقارنة بالهوية)
+        self.built = False
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def normalize(username):
+        return (username or "").replace("@", "").strip().casefold()
+    
+    def rebuild(self, users_data):
+        """إعادة بناء الفهرس من كل المستخدمين (اللقطة الخام)"""
+        by_username, by_user = {}, {}
+        for uid, user_data in users_data.items():
+            key = self.normalize(user_data.get("username", ""))
+            if key:
+                by_username[key] = uid
+                by_user[uid] = key
+        
+        with self.lock:
+            self.by_username, self.by_user = by_username, by_user
+            self.records = dict(users_data)
+            self.built = True
+        return len(by_username)
+    
+    def sync(self, users_data, user_ids=None):
+        """
+        مزامنة مع لقطة جديدة: المعرّفات المتغيرة فقط إن عُرفت (O(المتغير))،
+        وإلا يُعاد فهرسة السجلات التي تغير كائنها (فحص كامل بعد تحميل أو ترحيل)
+        """
+        if not self.built:
+            return
+        records = self.records
+        if user_ids is None:
+            user_ids = set(users_data)
+            user_ids.update(uid for uid in records if uid not in users_data)
+        
+        for user_id in user_ids:
+            user_data = users_data.get(user_id)
+            if user_data is None:
+                if records.pop(user_id, None) is not None:
+                    self.set(user_id, "")
+            elif records.get(user_id) is not user_data:
+                records[user_id] = user_data
+                self.set(user_id, user_data.get("username", ""))
+    
+    def set(self, user_id, username):
+        """تحديث يوزر مستخدم واحد"""
+        user_id = str(user_id)
+        key = self.normalize(username)
+        
+        with self.lock:
+            old_key = self.by_user.pop(user_id, None)
+            if old_key and self.by_username.get(old_key) == user_id:
+                del self.by_username[old_key]
+            if key:
+                self.by_username[key] = user_id
+                self.by_user[user_id] = key
+    
+    def get(self, username):
+        if not self.built:
+            self.rebuild(_get_snapshot("users", force_reload=False))
+        return self.by_username.get(self.normalize(username))
+    
+    def count(self):
+        """عدد المستخدمين الذين لديهم يوزر"""
+        if not self.built:
+            self.rebuild(_get_snapshot("users", force_reload=False))
+        return len(self.by_user)
+
+username_index = UsernameIndex()
+
+# قوائم المستخدم التي تشير إلى قنوات
+CHANNEL_REFERENCE_FIELDS = (
+    "active_subscriptions", "joined_channels", "temp_left_channels",
+    "permanent_left_channels", "left_channels", "left_completed_channels"
+)
+
+class ChannelUserIndex:
+    """فهرس عكسي: معرّف القناة → المستخدمون الذين تشير قوائمهم إليها"""
+    
+    def __init__(self):
+        self.users_by_channel = defaultdict(set)
+        self.left_completed_by_channel = defaultdict(set)
+        self.channels_by_user = {}
+        self.records = {}
+        self.built = False
+        self.lock = threading.RLock()
+    
+    @staticmethod
+    def _references(user_data):
+        channels = set()
+        for field in CHANNEL_REFERENCE_FIELDS:
+            channels.update(user_data.get(field) or ())
+        
+        left_completed = {
+            channel_id for channel_id, join_info in (user_data.get("joined_channels") or {}).items()
+            if join_info.get("left_completed", False)
+        }
+        return channels, left_completed
+    
+    def _unlink(self, user_id):
+        channels, left_completed = self.channels_by_user.pop(user_id, (set(), set()))
+        for channel_id in channels:
+            self.users_by_channel[channel_id].discard(user_id)
+            if not self.users_by_channel[channel_id]:
+                del self.users_by_channel[channel_id]
+        for channel_id in left_completed:
+            self.left_completed_by_channel[channel_id].discard(user_id)
+            if not self.left_completed_by_channel[channel_id]:
+                del self.left_completed_by_channel[channel_id]
+    
+    def _link(self, user_id, user_data):
+        channels, left_completed = self._references(user_data)
+        self.channels_by_user[user_id] = (channels, left_completed)
+        self.records[user_id] = user_data
+        for channel_id in channels:
+            self.users_by_channel[channel_id].add(user_id)
+        for channel_id in left_completed:
+            self.left_completed_by_channel[channel_id].add(user_id)
+    
+    def _relink(self, user_id, user_data):
+        """تعديل روابط مستخدم بالفرق فقط: القنوات التي أُضيفت أو أُزيلت من قوائمه"""
+        old_channels, old_left_completed = self.channels_by_user.get(user_id, (set(), set()))
+        channels, left_completed = self._references(user_data)
+        self.channels_by_user[user_id] = (channels, left_completed)
+        self.records[user_id] = user_data
+        
+        for index, old, new in (
+            (self.users_by_channel, old_channels, channels),
+            (self.left_completed_by_channel, old_left_completed, left_completed),
+        ):
+            for channel_id in old - new:
+                index[channel_id].discard(user_id)
+                if not index[channel_id]:
+                    del index[channel_id]
+            for channel_id in new - old:
+                index[channel_id].add(user_id)
+    
+    def update_user(self, user_id, user_data):
+        """إعادة فهرسة مستخدم واحد بعد تغيير قوائمه"""
+        user_id = str(user_id)
+        with self.lock:
+            if not self.built:
+                return
+            self._relink(user_id, user_data)
+    
+    def sync(self, users_data, user_ids=None):
+        """
+        مزامنة مع لقطة جديدة: المعرّفات المتغيرة فقط إن عُرفت، وإلا كل السجلات
+        التي تغير كائنها - وكل مستخدم يُعدل بفرق قنواته فقط
+        """
+        with self.lock:
+            if not self.built:
+                return
+            if user_ids is None:
+                user_ids = set(users_data)
+                user_ids.update(uid for uid in self.records if uid not in users_data)
+            
+            for user_id in user_ids:
+                user_data = users_data.get(user_id)
+                if user_data is None:
+                    if self.records.pop(user_id, None) is not None:
+                        self._unlink(user_id)
+                elif self.records.get(user_id) is not user_data:
+                    self._relink(user_id, user_data)
+    
+    def _ensure_built(self):
+        with self.lock:
+            if self.built:
+                return
+            users_data = _get_snapshot("users", force_reload=False)
+            for user_id, user_data in users_data.items():
+                self._link(user_id, user_data)
+            self.built = True
+    
+    def users_of(self, channel_id):
+        """المستخدمون المرتبطون بقناة"""
+        self._ensure_built()
+        with self.lock:
+            return set(self.users_by_channel.get(channel_id, ()))
+    
+    def left_completed_users(self):
+        """(قناة، مستخدمون) لكل قناة عليها علامات left_completed"""
+        self._ensure_built()
+        with self.lock:
+            return [(channel_id, set(users)) for channel_id, users in self.left_completed_by_channel.items()]
+
+channel_user_index = ChannelUserIndex()
+
+class ChannelUsernameIndex:
+    """فهرس (يوزر القناة الموحد، المالك) → {معرّف القناة: مكتملة؟}"""
+    
+    def __init__(self):
+        self.by_key = defaultdict(dict)
+        self.by_username = defaultdict(set)
+        self.records = {}
+        self.built = False
+        self.lock = threading.RLock()
+    
+    @staticmethod
+    def key_of(channel):
+        return UsernameIndex.normalize(channel.get("username", "")), str(channel.get("owner", ""))
+    
+    def _unlink(self, channel_id):
+        _, key = self.records.pop(channel_id)
+        self.by_key[key].pop(channel_id, None)
+        if not self.by_key[key]:
+            del self.by_key[key]
+        self.by_username[key[0]].discard(channel_id)
+        if not self.by_username[key[0]]:
+            del self.by_username[key[0]]
+    
+    def _link(self, channel_id, channel):
+        key = self.key_of(channel)
+        self.records[channel_id] = (channel, key)
+        self.by_key[key][channel_id] = channel.get("completed", False)
+        self.by_username[key[0]].add(channel_id)
+    
+    def sync(self, data):
+        """مزامنة مع لقطة بيانات جديدة (تُعاد فهرسة القنوات التي تغير كائنها فقط)"""
+        with self.lock:
+            if not self.built:
+                return
+            channels = data.get("channels", {})
+            for channel_id, channel in channels.items():
+                indexed = self.records.get(channel_id)
+                if indexed is not None and indexed[0] is channel:
+                    continue
+                if indexed is not None:
+                    self._unlink(channel_id)
+                self._link(channel_id, channel)
+            for channel_id in [cid for cid in self.records if cid not in channels]:
+                self._unlink(channel_id)
+    
+    def _ensure_built(self):
+        with self.lock:
+            if not self.built:
+                self.built = True
+                self.sync(_get_snapshot("data", force_reload=False))
+    
+    def find(self, channels, username, owner=None, completed=None):
+        """معرّفات القنوات لهذا اليوزر (ولهذا المالك/الحالة إن حُددا) - تُطابق مع البيانات الحالية"""
+        self._ensure_built()
+        name = UsernameIndex.normalize(username)
+        
+        with self.lock:
+            if owner is None:
+                candidates = list(self.by_username.get(name, ()))
+            else:
+                candidates = list(self.by_key.get((name, str(owner)), ()))
+        
+        # الحالة تُقرأ من القناة نفسها (قد تتغير في مكانها عبر عدادات WAL)
+        result = []
+        for channel_id in candidates:
+            channel = channels.get(channel_id)
+            if channel is None or UsernameIndex.normalize(channel.get("username", "")) != name:
+                continue
+            if owner is not None and str(channel.get("owner", "")) != str(owner):
+                continue
+            if completed is not None and channel.get("completed", False) != completed:
+                continue
+            result.append(channel_id)
+        return result
+
+channel_username_index = ChannelUsernameIndex()
+
+class Leaderboard:
+    """ترتيب تنازلي لعمود واحد يُحدث تدريجياً (قائمة مرتبة + bisect) بدلاً من فرز كل المستخدمين"""
+    
+    def __init__(self, field):
+        self.field = field
+        self.scores = {}
+        self.ranking = []  # (-القيمة، المعرّف)
+        self.total = 0  # مجموع القيم
+        self.positive = 0  # عدد المستخدمين بقيمة أكبر من صفر
+        self.version = 0  # يزيد فقط عندما يتغير ترتيب داخل نافذة التوب
+        self.watch = TOP_SIZE
+        self.lock = threading.Lock()
+    
+    def rebuild(self, scores):
+        """إعادة البناء من كل القيم {معرّف: قيمة}"""
+        ranking = sorted((-value, uid) for uid, value in scores.items())
+        
+        with self.lock:
+            self.scores, self.ranking = dict(scores), ranking
+            self.total = sum(scores.values())
+            self.positive = sum(1 for value in scores.values() if value > 0)
+            self.version += 1
+    
+    def _remove(self, user_id):
+        value = self.scores.pop(user_id)
+        self.total -= value
+        self.positive -= value > 0
+        position = bisect.bisect_left(self.ranking, (-value, user_id))
+        del self.ranking[position]
+        return position
+    
+    def set(self, user_id, value):
+        """تحديث قيمة مستخدم واحد: حذف ثم إدراج بـ bisect"""
+        with self.lock:
+            if self.scores.get(user_id, _MISSING) == value:
+                return
+            
+            old_position = self._remove(user_id) if user_id in self.scores else len(self.ranking)
+            new_position = bisect.bisect_left(self.ranking, (-value, user_id))
+            self.ranking.insert(new_position, (-value, user_id))
+            self.scores[user_id] = value
+            self.total += value
+            self.positive += value > 0
+            
+            if min(old_position, new_position) < self.watch:
+                self.version += 1
+    
+    def discard(self, user_id):
+        """حذف مستخدم من الترتيب"""
+        with self.lock:
+            if user_id in self.scores and self._remove(user_id) < self.watch:
+                self.version += 1
+    
+    def top(self, n, exclude=()):
+        """أعلى n مستخدم (مع استثناء معرّفات معينة) - O(n)"""
+        with self.lock:
+            self.watch = n + len(exclude)
+            result = []
+            for negative_value, user_id in self.ranking:
+                if user_id in exclude:
+                    continue
+                result.append((user_id, -negative_value))
+                if len(result) == n:
+                    break
+            return self.version, result
+
+def detach_channel_from_users(editor, channel_id):
+    """حذف القناة من قوائم المستخدمين المرتبطين بها فقط (عبر الفهرس العكسي)"""
+    cleaned_users = 0
+    users_view = editor.view()
+    
+    for user_id in channel_user_index.users_of(channel_id):
+        user_view = users_view.get(user_id)
+        if user_view is None:
+            continue
+        
+        try:
+            fields = [f for f in CHANNEL_REFERENCE_FIELDS if channel_id in (user_view.get(f) or ())]
+            if not fields:
+                continue
+            
+            user_info = editor.edit(user_id)
+            for field in fields:
+                if field == "joined_channels":
+                    del user_info[field][channel_id]
+                else:
+                    user_info[field] = [c for c in user_info[field] if c != channel_id]
+            cleaned_users += 1
+        except Exception as e:
+            logger.error(f"خطأ في تنظيف بيانات المستخدم {user_id}: {e}")
+    
+    return cleaned_users
+
+# ===================== العدادات اليومية =====================
+
+class DailyCounters:
+    """
+    عدادات مجمعة لكل يوم {"YYYY-MM-DD": {العداد: القيمة}} تُحدث عند الكتابة
+    وتُحفظ دورياً، فشاشات الإحصائيات تقرأ أرقاماً جاهزة بدلاً من المرور على كل المستخدمين.
+    """
+    
+    def __init__(self, path, retention_days):
+        self.path = path
+        self.retention_days = retention_days
+        self.days = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.days = json.load(f)
+            except Exception as e:
+                logger.error(f"❌ ملف العدادات اليومية تالف ({e}) - استخدم --rebuild-daily-stats")
+    
+    @staticmethod
+    def today():
+        return datetime.now().strftime("%Y-%m-%d")
+    
+    def bump(self, counter, amount=1, day=None):
+        """زيادة عداد اليوم"""
+        day = day or self.today()
+        with self.lock:
+            bucket = self.days.setdefault(day, {})
+            bucket[counter] = bucket.get(counter, 0) + amount
+            self.dirty = True
+    
+    def record_new_user(self):
+        """مستخدم جديد (ونشط اليوم)"""
+        day = self.today()
+        with self.lock:
+            bucket = self.days.setdefault(day, {})
+            for counter in ("new_users", "active_users"):
+                bucket[counter] = bucket.get(counter, 0) + 1
+            self.dirty = True
+    
+    def record_activity(self, previous_last_active):
+        """نشاط مستخدم: يُحسب مرة واحدة في اليوم (من قيمة last_active السابقة)"""
+        day = self.today()
+        previous_day = day_of(previous_last_active)
+        if previous_day == day:
+            return
+        
+        self.bump("active_users", day=day)
+    
+    def day(self, days_ago=0):
+        """عدادات يوم واحد"""
+        day = (datetime.now() - timedelta(days=days_ago)).strftime("%Y-%m-%d")
+        return dict(self.days.get(day, {}))
+    
+    def total(self, counter, from_days_ago=0, to_days_ago=0):
+        """مجموع عداد على مدى أيام (0 = اليوم)"""
+        now = datetime.now()
+        return sum(
+            self.days.get((now - timedelta(days=offset)).strftime("%Y-%m-%d"), {}).get(counter, 0)
+            for offset in range(from_days_ago, to_days_ago + 1)
+        )
+    
+    def rebuild(self, users_data):
+        """إعادة البناء من first_join / last_active (لا يمكن استرجاع النقاط والانضمامات السابقة)"""
+        days = {}
+        
+        def add(day, counter):
+            if len(day) == 10 and day[4] == "-":
+                bucket = days.setdefault(day, {})
+                bucket[counter] = bucket.get(counter, 0) + 1
+        
+        for user_data in users_data.values():
+            add(day_of(user_data.get("first_join")), "new_users")
+            add(day_of(user_data.get("last_active")), "active_users")
+        
+        with self.lock:
+            # الاحتفاظ بالعدادات التي لا تُستنتج من سجلات المستخدمين
+            for day, bucket in self.days.items():
+                for counter in ("points_issued", "points_spent", "joins", "daily_gifts"):
+                    if counter in bucket:
+                        days.setdefault(day, {})[counter] = bucket[counter]
+            self.days = days
+            self.dirty = True
+        self.save()
+        return len(days)
+    
+    def save(self):
+        """حفظ العدادات (بعد حذف الأيام الأقدم من مدة الاحتفاظ)"""
+        cutoff = (datetime.now() - timedelta(days=self.retention_days)).strftime("%Y-%m-%d")
+        with self.lock:
+            if not self.dirty:
+                return
+            for day in [d for d in self.days if d < cutoff]:
+                del self.days[day]
+            snapshot = {day: dict(bucket) for day, bucket in self.days.items()}
+            self.dirty = False
+        write_json_file(self.path, snapshot, indent=None)
+
+daily_counters = DailyCounters(DAILY_STATS_FILE, DAILY_STATS_RETENTION_DAYS)
+
+class HyperLogLog:
+    """مخطط HyperLogLog لعدّ العناصر المميزة تقريبياً بذاكرة ثابتة (2^p بايت)"""
+    
+    __slots__ = ("p", "m", "registers")
+    
+    def __init__(self, p, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+    
+    def add(self, item):
+        value = int.from_bytes(hashlib.blake2b(str(item).encode(), digest_size=8).digest(), "big")
+        index = value >> (64 - self.p)
+        rest = value & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+    
+    def merge(self, other):
+        """دمج مخطط آخر (الحد الأقصى لكل سجل)"""
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+    
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        
+        # تصحيح النطاق الصغير (العد الخطي)
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+class ActiveUserSketches:
+    """مخطط HyperLogLog لكل يوم للمستخدمين النشطين - الأسبوع/الشهر = دمج 7/30 مخطط"""
+    
+    def __init__(self, path, precision, retention_days):
+        self.path = path
+        self.precision = precision
+        self.retention_days = retention_days
+        self.days = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+                if saved.get("p") == precision:
+                    self.days = {
+                        day: HyperLogLog(precision, base64.b64decode(registers))
+                        for day, registers in saved.get("days", {}).items()
+                    }
+            except Exception as e:
+                logger.error(f"❌ ملف مخططات النشاط تالف: {e}")
+    
+    def add(self, user_id, day=None):
+        """تسجيل نشاط مستخدم في مخطط اليوم"""
+        day = day or DailyCounters.today()
+        with self.lock:
+            sketch = self.days.get(day)
+            if sketch is None:
+                sketch = self.days[day] = HyperLogLog(self.precision)
+            if sketch.add(user_id):
+                self.dirty = True
+    
+    def count(self, from_days_ago=0, to_days_ago=0):
+        """عدد النشطين المميزين (تقريبي) على مدى أيام (0 = اليوم)"""
+        now = datetime.now()
+        merged = HyperLogLog(self.precision)
+        with self.lock:
+            for offset in range(from_days_ago, to_days_ago + 1):
+                sketch = self.days.get((now - timedelta(days=offset)).strftime("%Y-%m-%d"))
+                if sketch is not None:
+                    merged.merge(sketch)
+        return merged.count()
+    
+    def rebuild(self, users_data):
+        """إعادة البناء من last_active (يُعرف آخر يوم نشاط فقط لكل مستخدم)"""
+        for user_id, user_data in users_data.items():
+            day = day_of(user_data.get("last_active"))
+            if len(day) == 10 and day[4] == "-":
+                self.add(user_id, day)
+        self.save()
+    
+    def save(self):
+        cutoff = (datetime.now() - timedelta(days=self.retention_days)).strftime("%Y-%m-%d")
+        with self.lock:
+            if not self.dirty:
+                return
+            for day in [d for d in self.days if d < cutoff]:
+                del self.days[day]
+            snapshot = {
+                "p": self.precision,
+                "days": {
+                    day: base64.b64encode(bytes(sketch.registers)).decode("ascii")
+                    for day, sketch in self.days.items()
+                }
+            }
+            self.dirty = False
+        write_json_file(self.path, snapshot, indent=None)
+
+active_sketches = ActiveUserSketches(ACTIVE_SKETCHES_FILE, ACTIVE_SKETCH_PRECISION, ACTIVE_SKETCH_RETENTION_DAYS)
+
+async def save_daily_stats(context: ContextTypes.DEFAULT_TYPE):
+    """حفظ دوري للعدادات اليومية ومخططات النشاط"""
+    try:
+        daily_counters.save()
+        active_sketches.save()
+    except Exception as e:
+        logger.error(f"❌ خطأ في حفظ العدادات اليومية: {e}")
+
+# ===================== اللقطة العمودية للتحليلات =====================
+
+class UserColumns:
+    """
+    أعمدة متوازية (array) لحقول المستخدمين الرقمية - تُحدّث تدريجياً من المستخدمين
+    المتغيرين فقط، والتقارير مرور واحد على الأعمدة (عمليات متجهة عبر NumPy إن توفرت).
+    عمودا النقاط والدعوات لهما ترتيب تدريجي (التوب) يُغذى من نفس الصفوف المتغيرة
+    """
+    
+    COLUMNS = ("points", "invites", "total_earned", "total_spent", "first_join", "last_active")
+    TIME_COLUMNS = ("first_join", "last_active")
+    RANKED_COLUMNS = ("points", "invites")
+    
+    def __init__(self):
+        self.user_ids = []
+        self.positions = {}
+        self.records = {}
+        self.columns = {name: array("q") for name in self.COLUMNS}
+        self.rankings = {name: Leaderboard(name) for name in self.RANKED_COLUMNS}
+        self.size = 0
+        self.version = 0  # يزيد مع كل صف متغير (صلاحية الأعمدة المرتبة)
+        self.sorted_columns = {}  # عمود -> (الإصدار، القيم مرتبة)
+        self.dirty = set()
+        self.built = False
+        self.source_changed = False  # لقطة كاملة جديدة: مقارنة هوية كل السجلات عند القراءة القادمة
+        self.lock = threading.RLock()
+    
+    def _row(self, user_data):
+        values = []
+        for name in self.COLUMNS:
+            value = user_data.get(name, 0)
+            if name in self.TIME_COLUMNS:
+                value = to_timestamp(value)
+            elif not isinstance(value, (int, float)):
+                value = 0
+            values.append(int(value))
+        return values
+    
+    def _write(self, user_id, user_data, rank=True):
+        position = self.positions.get(user_id)
+        is_new = position is None
+        if is_new:
+            position = self.size
+            for column in self.columns.values():
+                column.append(0)
+            self.positions[user_id] = position
+            self.user_ids.append(user_id)
+            self.size += 1
+        
+        for name, value in zip(self.COLUMNS, self._row(user_data)):
+            column = self.columns[name]
+            if rank and name in self.rankings and (is_new or column[position] != value):
+                self.rankings[name].set(user_id, value)
+            column[position] = value
+        self.records[user_id] = user_data
+        self.version += 1
+    
+    def _drop(self, user_id):
+        """حذف صف بنقل الصف الأخير مكانه - O(1)"""
+        position = self.positions.pop(user_id)
+        del self.records[user_id]
+        for ranking in self.rankings.values():
+            ranking.discard(user_id)
+        last = self.size - 1
+        if position != last:
+            moved = self.user_ids[last]
+            self.user_ids[position] = moved
+            self.positions[moved] = position
+            for column in self.columns.values():
+                column[position] = column[last]
+        self.user_ids.pop()
+        for column in self.columns.values():
+            column.pop()
+        self.size = last
+        self.version += 1
+    
+    def _apply(self, users_data, user_ids):
+        """تحديث صفوف معرّفات محددة من اللقطة (تحت القفل)"""
+        for user_id in user_ids:
+            user_data = users_data.get(user_id)
+            if user_data is None:
+                if user_id in self.positions:
+                    self._drop(user_id)
+            elif self.records.get(user_id) is not user_data:
+                self._write(user_id, user_data)
+    
+    def rebuild(self, users_data):
+        """بناء كل الأعمدة والترتيبات من كل المستخدمين (عند التشغيل أو أول قراءة)"""
+        with self.lock:
+            self.user_ids, self.positions, self.records = [], {}, {}
+            self.columns = {name: array("q") for name in self.COLUMNS}
+            self.size = 0
+            for user_id, user_data in users_data.items():
+                self._write(user_id, user_data, rank=False)
+            for name, ranking in self.rankings.items():
+                ranking.rebuild(dict(zip(self.user_ids, self.columns[name])))
+            self.dirty = set()
+            self.source_changed = False
+            self.built = True
+            self.version += 1
+        return self.size
+    
+    def mark_dirty(self, user_id):
+        with self.lock:
+            self.dirty.add(str(user_id))
     
-    # قفل للمستخدم لمنع التضارب
-    user_lock_key = f"points_{user_id}"
-    _point_locks.setdefault(user_lock_key, threading.Lock())
+    def sync(self, users_data, user_ids=None):
+        """لقطة جديدة نُشرت: الصفوف المتغيرة تُحدّث فوراً، وبدون معرّفات تُؤجل مقارنة كاملة لأول قراءة"""
+        with self.lock:
+            if not self.built:
+                return
+            if user_ids is None:
+                self.source_changed = True
+            else:
+                self._apply(users_data, user_ids)
     
-    with _point_locks[user_lock_key]:
-        user_data = get_user_data(user_id, force_reload=True)
-        current_points = user_data.get("points", 0)
+    def _catch_up(self):
+        """تطبيق التغييرات المعلقة (المعرّفات المعلّمة أو لقطة كاملة جديدة)"""
+        # اللقطة تُقرأ قبل القفل: قراءتها قد تنشر إصداراً يعود إلى sync
+        users_data = _get_snapshot("users", force_reload=False)
         
-        if operation == "add":
-            new_points = current_points + points
-            total_earned = user_data.get("total_earned", 0) + points
-            
-            updates = {
-                "points": new_points,
-                "total_earned": total_earned
-            }
-            
-            if update_user_data(user_id, updates, action_type or "add_points", transaction_id):
-                # تحديث الإحصائيات مرة واحدة فقط
-                if action_type != "stats_update":
-                    update_system_stats("total_points", points=points)
-                return True, "تمت الإضافة بنجاح"
-                
-        elif operation == "subtract":
-            # ✅ **الإصلاح: السماح بالنقاط السالبة**
-            new_points = current_points - points
-            total_spent = user_data.get("total_spent", 0) + points
+        with self.lock:
+            if not self.built:
+                self.rebuild(users_data)
+                return
+            if self.source_changed:
+                self.source_changed = False
+                records = self.records
+                self.dirty.update(uid for uid, user_data in users_data.items() if records.get(uid) is not user_data)
+                self.dirty.update(uid for uid in records if uid not in users_data)
             
-            updates = {
-                "points": new_points,  # يمكن أن تكون سالبة
-                "total_spent": total_spent
+            dirty, self.dirty = self.dirty, set()
+            self._apply(users_data, dirty)
+    
+    def refresh(self):
+        """تطبيق التغييرات المعلقة ثم إرجاع نسخة من الأعمدة بالحجم الفعلي"""
+        self._catch_up()
+        with self.lock:
+            return {name: column[:] for name, column in self.columns.items()}
+    
+    def top(self, name, n, exclude=()):
+        """(الإصدار، أعلى n) لعمود مرتب - O(n) بعد تطبيق الصفوف المتغيرة فقط"""
+        self._catch_up()
+        return self.rankings[name].top(n, exclude)
+    
+    def summary(self):
+        """عدد المستخدمين ومجاميع الأعمدة المرتبة (محفوظة تدريجياً - بدون مرور على الصفوف)"""
+        self._catch_up()
+        with self.lock:
+            result = {"users": self.size}
+            for name, ranking in self.rankings.items():
+                result[f"total_{name}"] = ranking.total
+                result[f"with_{name}"] = ranking.positive
+            return result
+    
+    # ---------- التقارير ----------
+    
+    @staticmethod
+    def _vector(column):
+        """عرض NumPy فوق array بدون نسخ"""
+        return np.frombuffer(column, dtype=np.int64)
+    
+    @staticmethod
+    def _bucket_counts(values, edges):
+        """عدد القيم في كل مجال: [..edges[0]) [edges[0]..edges[1]) ... [edges[-1]..)"""
+        if HAS_NUMPY:
+            indexes = np.searchsorted(np.asarray(edges), values, side="right")
+            return [int(count) for count in np.bincount(indexes, minlength=len(edges) + 1)]
+        counts = [0] * (len(edges) + 1)
+        for value in values:
+            counts[bisect.bisect_right(edges, value)] += 1
+        return counts
+    
+    def sorted_column(self, name):
+        """قيم العمود مرتبة - تُرتب مرة واحدة لكل إصدار من الأعمدة"""
+        self._catch_up()
+        with self.lock:
+            cached = self.sorted_columns.get(name)
+            if cached is not None and cached[0] == self.version:
+                return cached[1]
+            column = self.columns[name]
+            ordered = np.sort(self._vector(column)) if HAS_NUMPY else sorted(column)
+            self.sorted_columns[name] = (self.version, ordered)
+            return ordered
+    
+    def percentiles(self, name, percentiles=ANALYTICS_PERCENTILES):
+        """نسب مئوية لعمود (طريقة الرتبة الأقرب)"""
+        ordered = self.sorted_column(name)
+        count = len(ordered)
+        if not count:
+            return {p: 0 for p in percentiles}
+        return {p: int(ordered[max(0, math.ceil(p / 100 * count) - 1)]) for p in percentiles}
+    
+    def distribution(self, name, edges):
+        values = self.refresh()[name]
+        return self._bucket_counts(self._vector(values) if HAS_NUMPY else values, edges)
+    
+    def balance(self):
+        """المكتسب مقابل المصروف (مرور واحد على العمودين)"""
+        columns = self.refresh()
+        earned, spent = columns["total_earned"], columns["total_spent"]
+        if HAS_NUMPY:
+            earned, spent = self._vector(earned), self._vector(spent)
+            total_earned, total_spent = int(earned.sum()), int(spent.sum())
+            overspent = int(np.count_nonzero(spent > earned))
+            never_spent = int(np.count_nonzero((spent == 0) & (earned > 0)))
+        else:
+            total_earned = total_spent = overspent = never_spent = 0
+            for e, s in zip(earned, spent):
+                total_earned += e
+                total_spent += s
+                if s > e:
+                    overspent += 1
+                elif s == 0 and e > 0:
+                    never_spent += 1
+        return {
+            "users": len(earned),
+            "total_earned": total_earned,
+            "total_spent": total_spent,
+            "spend_ratio": total_spent / total_earned if total_earned else 0.0,
+            "overspent": overspent,
+            "never_spent": never_spent,
+        }
+    
+    def activity_buckets(self, now=None):
+        """آخر نشاط: اليوم / الأسبوع / الشهر / أقدم"""
+        now = now or now_ts()
+        last_active = self.refresh()["last_active"]
+        ages = now - self._vector(last_active) if HAS_NUMPY else [now - value for value in last_active]
+        return self._bucket_counts(ages, [24 * 3600, 7 * 24 * 3600, 30 * 24 * 3600])
+    
+    def cohort_retention(self, weeks=ANALYTICS_COHORT_WEEKS, now=None):
+        """لكل أسبوع انضمام: عدد المنضمين ومن نشط منهم خلال آخر 7 أيام"""
+        now = now or now_ts()
+        week = 7 * 24 * 3600
+        columns = self.refresh()
+        first_join, last_active = columns["first_join"], columns["last_active"]
+        
+        if HAS_NUMPY:
+            first_join, last_active = self._vector(first_join), self._vector(last_active)
+            cohort = (now - first_join) // week
+            valid = (first_join > 0) & (cohort >= 0) & (cohort < weeks)
+            active = last_active[valid] >= now - week
+            sizes = np.bincount(cohort[valid], minlength=weeks)
+            retained = np.bincount(cohort[valid][active], minlength=weeks)
+            return [(index, int(sizes[index]), int(retained[index])) for index in range(weeks)]
+        
+        sizes, retained = [0] * weeks, [0] * weeks
+        for joined, active_at in zip(first_join, last_active):
+            index = (now - joined) // week
+            if joined > 0 and 0 <= index < weeks:
+                sizes[index] += 1
+                retained[index] += active_at >= now - week
+        return [(index, sizes[index], retained[index]) for index in range(weeks)]
+
+user_columns = UserColumns()
+
+# ===================== كاش العضوية =====================
+
+class MembershipCache:
+    """
+    كاش نتائج الاشتراك حسب (القناة، المستخدم) بمدد صلاحية منفصلة للنتيجة
+    الإيجابية والسلبية والخطأ (None)، مع عدادات إصابة
+    """
+    
+    def __init__(self, ttl_positive, ttl_negative, ttl_error, max_entries):
+        self.ttls = {True: ttl_positive, False: ttl_negative, None: ttl_error}
+        self.max_entries = max_entries
+        self.entries = {}  # (القناة، المستخدم) -> (النتيجة، وقت الانتهاء)
+        self.hits = defaultdict(int)  # حسب النتيجة
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def key_of(channel_username, user_id):
+        return UsernameIndex.normalize(channel_username), str(user_id)
+    
+    def get(self, channel_username, user_id):
+        """(موجود، النتيجة) - النتائج المنتهية تُحذف"""
+        key = self.key_of(channel_username, user_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self.hits[entry[0]] += 1
+                    return True, entry[0]
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+    
+    def put(self, channel_username, user_id, result):
+        ttl = self.ttls[result]
+        if ttl <= 0:
+            return
+        key = self.key_of(channel_username, user_id)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (result, time.monotonic() + ttl)
+            if len(self.entries) > self.max_entries:
+                self._evict()
+    
+    def _evict(self):
+        now = time.monotonic()
+        for key in [key for key, (_, expires) in self.entries.items() if expires <= now]:
+            del self.entries[key]
+        # الأقدم إدخالاً أولاً (القاموس يحفظ ترتيب الإدخال)
+        overflow = len(self.entries) - self.max_entries
+        for key in list(self.entries)[:max(0, overflow)]:
+            del self.entries[key]
+    
+    def observe(self, channel_username, user_id, is_member):
+        """البوت رأى انضماماً أو مغادرة بنفسه - النتيجة المخزنة تُستبدل فوراً"""
+        self.put(channel_username, user_id, bool(is_member))
+    
+    def invalidate(self, channel_username, user_id=None):
+        """حذف نتيجة مستخدم، أو كل نتائج القناة إذا لم يُحدد مستخدم"""
+        with self.lock:
+            if user_id is not None:
+                self.entries.pop(self.key_of(channel_username, user_id), None)
+                return
+            channel = self.key_of(channel_username, 0)[0]
+            for key in [key for key in self.entries if key[0] == channel]:
+                del self.entries[key]
+    
+    def stats(self):
+        with self.lock:
+            hits = sum(self.hits.values())
+            total = hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "positive_hits": self.hits[True],
+                "negative_hits": self.hits[False],
+                "error_hits": self.hits[None],
             }
-            
-            if update_user_data(user_id, updates, action_type or "subtract_points", transaction_id):
-                logger.info(f"💸 خصم {points} نقطة من {user_id}: {current_points} → {new_points}")
-                
-                # ✅ **إصلاح إحصائيات النقاط السالبة**
-                if points > 0 and action_type != "stats_update":
-                    # عند الخصم، نخصم النقاط من الإحصائيات الإجمالية
-                    update_system_stats("total_points", points=-points)
-                
-                return True, "تم الخصم بنجاح"
-        
-        return False, "خطأ غير معروف"
 
-# ===================== نظام الكتم =====================
+membership_cache = MembershipCache(
+    MEMBERSHIP_CACHE_TTL_POSITIVE, MEMBERSHIP_CACHE_TTL_NEGATIVE,
+    MEMBERSHIP_CACHE_TTL_ERROR, MEMBERSHIP_CACHE_MAX_ENTRIES
+)
 
-def is_muted(user_id):
-    """التحقق مما إذا كان المستخدم مكتوماً"""
-    data = load_data()
-    user_id = str(user_id)
+class ChatMetadataCache:
+    """
+    يوزر القناة → (المعرف، الاسم، النوع) - محفوظ على القرص، get_chat فقط عند أول
+    استخدام، والتحديث بعد التقادم يتم في الخلفية دون انتظار
+    """
     
-    if user_id in data.get("muted_users", {}):
-        mute_data = data["muted_users"][user_id]
-        mute_until = mute_data.get("until")
+    def __init__(self, path, refresh_after):
+        self.path = path
+        self.refresh_after = refresh_after
+        self.entries = {}
+        self.refreshing = set()
+        self.tasks = set()  # مراجع مهام التحديث حتى لا تُجمع قبل انتهائها
+        self.dirty = False
+        self.lock = threading.Lock()
         
-        if mute_until:
+        if os.path.exists(path):
             try:
-                mute_until_time = datetime.strptime(mute_until, "%Y-%m-%d %H:%M:%S")
-                if datetime.now() < mute_until_time:
-                    return True, mute_until
-                else:
-                    del data["muted_users"][user_id]
-                    save_data(data)
-                    return False, None
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
             except Exception as e:
-                logger.error(f"خطأ في معالجة وقت الكتم: {e}")
-                return False, None
-        return True, "دائم"
-    
-    return False, None
-
-def add_muted_user(user_id, mute_duration=None, reason=""):
-    """إضافة مستخدم مكتوم"""
-    data = load_data()
-    user_id = str(user_id)
-    
-    mute_info = {
-        "muted_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "reason": reason,
-        "muted_by": ADMIN_ID
-    }
-    
-    if mute_duration:
-        mute_until = datetime.now() + timedelta(seconds=mute_duration)
-        mute_info["until"] = mute_until.strftime("%Y-%m-%d %H:%M:%S")
-        mute_info["duration"] = mute_duration
+                logger.error(f"❌ ملف كاش القنوات تالف ({e}) - سيُعاد جلب القنوات عند الحاجة")
+    
+    @staticmethod
+    def key_of(channel_username):
+        return UsernameIndex.normalize(channel_username)
+    
+    async def _fetch(self, bot, key):
+        chat = await bot.get_chat(chat_id=f"@{key}")
+        entry = {
+            "id": chat.id,
+            "title": chat.title or "",
+            "type": str(chat.type),
+            "resolved_at": now_ts()
+        }
+        with self.lock:
+            self.entries[key] = entry
+            self.dirty = True
+        return entry
     
-    data["muted_users"][user_id] = mute_info
-    data["stats"]["total_mutes"] = data["stats"].get("total_mutes", 0) + 1
-    save_data(data)
+    async def _refresh(self, bot, key):
+        try:
+            await self._fetch(bot, key)
+        except Exception as e:
+            logger.warning(f"⚠️ فشل تحديث بيانات القناة @{key}: {e}")
+        finally:
+            self.refreshing.discard(key)
+    
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"❌ خطأ غير متوقع في تحديث بيانات القناة: {task.exception()}")
+    
+    async def resolve(self, bot, channel_username):
+        """بيانات القناة (ترفع استثناء get_chat إذا لم تكن في الكاش وفشل جلبها)"""
+        key = self.key_of(channel_username)
+        entry = self.entries.get(key)
+        if entry is None:
+            return await self._fetch(bot, key)
+        
+        if now_ts() - entry.get("resolved_at", 0) > self.refresh_after and key not in self.refreshing:
+            self.refreshing.add(key)
+            task = asyncio.get_running_loop().create_task(self._refresh(bot, key))
+            self.tasks.add(task)
+            task.add_done_callback(self._task_done)
+        return entry
+    
+    def invalidate(self, channel_username):
+        with self.lock:
+            if self.entries.pop(self.key_of(channel_username), None) is not None:
+                self.dirty = True
     
-    return mute_info
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            snapshot = dict(self.entries)
+            self.dirty = False
+        write_json_file(self.path, snapshot, indent=None)
 
-def remove_muted_user(user_id):
-    """إزالة مستخدم من قائمة المكتومين"""
-    data = load_data()
-    user_id = str(user_id)
-    
-    if user_id in data.get("muted_users", {}):
-        del data["muted_users"][user_id]
-        if save_data(data):
-            return True
-    
-    return False
+chat_metadata = ChatMetadataCache(CHAT_METADATA_FILE, CHAT_METADATA_REFRESH_AFTER)
 
-def cleanup_expired_mutes(context: ContextTypes.DEFAULT_TYPE = None):
-    """تنظيف الكتم المنتهي"""
+async def save_chat_metadata(context: ContextTypes.DEFAULT_TYPE):
+    """حفظ دوري لكاش بيانات القنوات (يتغير نادراً - مهمة مستقلة عن العدادات اليومية)"""
     try:
-        data = load_data()
-        muted_users = data.get("muted_users", {})
-        removed_count = 0
-        
-        if isinstance(muted_users, dict):
-            for user_id, mute_data in list(muted_users.items()):
-                mute_until = mute_data.get("until")
-                if mute_until:
-                    try:
-                        mute_until_time = datetime.strptime(mute_until, "%Y-%m-%d %H:%M:%S")
-                        if datetime.now() >= mute_until_time:
-                            del data["muted_users"][user_id]
-                            removed_count += 1
-                    except Exception as e:
-                        logger.error(f"خطأ في تنظيف الكتم: {e}")
-        
-        if removed_count > 0:
-            save_data(data)
-            logger.info(f"🧹 تم تنظيف {removed_count} مستخدم منتهي الكتم")
-    
+        chat_metadata.save()
     except Exception as e:
-        logger.error(f"خطأ في cleanup_expired_mutes: {e}")
+        logger.error(f"❌ خطأ في حفظ كاش بيانات القنوات: {e}")
 
-def format_time(seconds):
-    """تحويل الثواني إلى نص مقروء"""
-    if seconds == 0:
-        return "دائم"
+# ===================== سجل إشراف البوت =====================
+
+# أخطاء تعني أن البوت ليس مشرفاً فعلاً (غيرها أخطاء مؤقتة لا تغير الحالة)
+BOT_NOT_ADMIN_ERRORS = ("chat not found", "forbidden", "kicked", "not enough rights", "inaccessible")
+
+class BotAdminRegistry:
+    """
+    حالة إشراف البوت لكل قناة (حسب اليوزر) - تُغذى من تحديثات my_chat_member ومن
+    تحديث دوري متدرج، وتُحفظ في حقلي bot_is_admin / last_admin_check في سجلات القنوات
+    """
     
-    days = seconds // (24 * 3600)
-    seconds %= (24 * 3600)
-    hours = seconds // 3600
-    seconds %= 3600
-    minutes = seconds // 60
-    seconds %= 60
+    def __init__(self):
+        self.entries = {}  # يوزر موحد -> (مشرف؟، وقت آخر فحص)
+        self.pending = {}  # حالات لم تُكتب في سجلات القنوات بعد
+        self.lock = threading.Lock()
     
-    result = []
-    if days > 0:
-        result.append(f"{days} يوم")
-    if hours > 0:
-        result.append(f"{hours} ساعة")
-    if minutes > 0:
-        result.append(f"{minutes} دقيقة")
-    if seconds > 0:
-        result.append(f"{seconds} ثانية")
+    @staticmethod
+    def key_of(channel_username):
+        return UsernameIndex.normalize(channel_username)
+    
+    def _from_records(self, key):
+        """الحالة المحفوظة في سجلات القنوات (الأحدث فحصاً)"""
+        channels = _get_snapshot("data", force_reload=False).get("channels", {})
+        best = None
+        for channel_id in channel_username_index.find(channels, key):
+            channel = channels[channel_id]
+            if "bot_is_admin" in channel:
+                checked_at = to_timestamp(channel.get("last_admin_check"))
+                if best is None or checked_at > best[1]:
+                    best = (bool(channel["bot_is_admin"]), checked_at)
+        return best
+    
+    def get(self, channel_username):
+        """(مشرف؟، وقت آخر فحص) أو None إذا لم تُعرف الحالة بعد"""
+        key = self.key_of(channel_username)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            entry = self._from_records(key)
+            if entry is not None:
+                with self.lock:
+                    entry = self.entries.setdefault(key, entry)
+        return entry
+    
+    def record(self, channel_username, is_admin):
+        key = self.key_of(channel_username)
+        entry = (bool(is_admin), now_ts())
+        with self.lock:
+            previous = self.entries.get(key)
+            self.entries[key] = entry
+            self.pending[key] = entry
+        if previous is not None and previous[0] != entry[0]:
+            logger.info(f"🛡️ تغيرت صلاحية البوت في @{key}: {'مشرف' if entry[0] else 'ليس مشرفاً'}")
+    
+    async def is_admin(self, bot, channel_username):
+        """قراءة من السجل - فحص مباشر فقط إذا كانت القناة غير معروفة"""
+        entry = self.get(channel_username)
+        if entry is not None:
+            return entry[0]
+        return await check_bot_is_admin(bot, channel_username)
+    
+    def refresh_candidates(self):
+        """يوزرات القنوات النشطة والإجبارية - الأقدم فحصاً أولاً"""
+        data = get_data_view()
+        usernames = {self.key_of(username) for username in data.get("force_sub_channels", [])}
+        for channel in data.get("channels", {}).values():
+            if not channel.get("completed", False) and channel.get("username"):
+                usernames.add(self.key_of(channel["username"]))
+        usernames.discard("")
+        
+        def checked_at(key):
+            entry = self.get(key)
+            return entry[1] if entry is not None else 0
+        
+        return sorted(usernames, key=checked_at)
+    
+    def persist(self):
+        """كتابة الحالات المعلقة في سجلات القنوات (حفظ واحد)"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        
+        updated = 0
+        with edit_snapshot("data") as editor:
+            channels = editor.view().get("channels", {})
+            for key, (is_admin, checked_at) in pending.items():
+                for channel_id in channel_username_index.find(channels, key):
+                    channel = editor.edit("channels", channel_id)
+                    channel["bot_is_admin"] = is_admin
+                    channel["last_admin_check"] = checked_at
+                    updated += 1
+        return updated
+
+bot_admin_registry = BotAdminRegistry()
+
+async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تغيرت صلاحيات البوت في قناة (إضافة/ترقية/إزالة) - تحديث سجل الإشراف فوراً"""
+    change = update.my_chat_member
+    if change is None or not change.chat.username:
+        return
     
-    return " و ".join(result) if result else "0 ثانية"
+    is_admin = change.new_chat_member.status in ("administrator", "creator")
+    bot_admin_registry.record(change.chat.username, is_admin)
+    try:
+        bot_admin_registry.persist()
+    except Exception as e:
+        logger.error(f"❌ خطأ في حفظ صلاحية البوت في @{change.chat.username}: {e}")
+
+async def refresh_bot_admin_status(context: ContextTypes.DEFAULT_TYPE):
+    """تحديث متدرج لحالة إشراف البوت: دفعة صغيرة من أقدم القنوات فحصاً في كل مرة"""
+    try:
+        for channel_username in bot_admin_registry.refresh_candidates()[:BOT_ADMIN_REFRESH_BATCH]:
+            await check_bot_is_admin(context.bot, channel_username)
+        bot_admin_registry.persist()
+    except Exception as e:
+        logger.error(f"❌ خطأ في تحديث حالة إشراف البوت: {e}")
 
 # ===================== وظائف مساعدة محسنة =====================
 
 def is_admin(user_id):
     """التحقق مما إذا كان المستخدم أدمن"""
-    data = load_data()
+    data = get_data_view()
     return str(user_id) in data.get("admins", [str(ADMIN_ID)])
 
 def is_banned(user_id):
     """التحقق مما إذا كان المستخدم محظور"""
-    data = load_data()
+    data = get_data_view()
     return str(user_id) in data.get("banned_users", [])
 
 def find_user_by_username(username):
-    """الببحث عن مستخدم باليوزر"""
-    users_data = load_users()
-    username = username.replace("@", "").lower()
-    
-    for uid, user_data in users_data.items():
-        if user_data.get("username", "").lower() == username:
-            return uid
-    return None
+    """الببحث عن مستخدم باليوزر (من فهرس اليوزرات)"""
+    return username_index.get(username)
 
 async def send_to_admin(bot, message):
     """إرسال رسالة للمالك"""
@@ -595,26 +4664,34 @@ async def send_to_admin(bot, message):
     except Exception as e:
         logger.error(f"Error sending to admin: {e}")
 
-async def check_channel_subscription(bot, user_id, channel_username):
-    """التحقق من اشتراك المستخدم في قناة"""
+async def check_channel_subscription(bot, user_id, channel_username, fresh=False):
+    """التحقق من اشتراك المستخدم في قناة (من الكاش ما لم يُطلب فحص جديد fresh)"""
+    if not fresh:
+        found, result = membership_cache.get(channel_username, user_id)
+        if found:
+            return result
+    
+    result = await _fetch_channel_subscription(bot, user_id, channel_username)
+    membership_cache.put(channel_username, user_id, result)
+    return result
+
+async def _fetch_channel_subscription(bot, user_id, channel_username):
     try:
         channel_username = channel_username.replace("@", "").strip()
         
         try:
-            chat = await bot.get_chat(chat_id=f"@{channel_username}")
+            chat = await chat_metadata.resolve(bot, channel_username)
         except Exception as chat_error:
             logger.error(f"خطأ في جلب معلومات القناة: {chat_error}")
             return None
         
         try:
             member = await bot.get_chat_member(
-                chat_id=chat.id,
+                chat_id=chat["id"],
                 user_id=user_id
             )
             
-            valid_statuses = ["member", "administrator", "creator"]
-            
-            if member.status in valid_statuses:
+            if member.status in MEMBER_STATUSES:
                 return True
             else:
                 return False
@@ -627,6 +4704,8 @@ async def check_channel_subscription(bot, user_id, channel_username):
             elif "forbidden" in error_text or "kicked" in error_text:
                 return None
             else:
+                if "chat not found" in error_text:
+                    chat_metadata.invalidate(channel_username)
                 logger.error(f"خطأ في التحقق من العضوية: {member_error}")
                 return None
                 
@@ -635,26 +4714,35 @@ async def check_channel_subscription(bot, user_id, channel_username):
         return None
 
 async def check_bot_is_admin(bot, channel_username):
-    """التحقق مما إذا كان البوت مشرفاً في قناة"""
+    """
+    فحص مباشر لإشراف البوت في قناة (يُحدّث سجل الإشراف) - المسارات المتكررة
+    تقرأ من bot_admin_registry بدلاً منه
+    """
     try:
         channel_username = channel_username.replace("@", "").strip()
         
         try:
-            chat = await bot.get_chat(chat_id=f"@{channel_username}")
+            chat = await chat_metadata.resolve(bot, channel_username)
             
+            # هوية البوت معروفة من Application.initialize - بدون get_me
             bot_member = await bot.get_chat_member(
-                chat_id=chat.id,
-                user_id=(await bot.get_me()).id
+                chat_id=chat["id"],
+                user_id=bot.id
             )
             
-            if bot_member.status in ("administrator", "creator"):
-                return True
-            else:
-                return False
+            is_admin = bot_member.status in ("administrator", "creator")
 
         except Exception as e:
+            error_text = str(e).lower()
+            if "chat not found" in error_text:
+                chat_metadata.invalidate(channel_username)
             logger.error(f"خطأ في التحقق من إشراف البوت: {e}")
-            return False
+            if not any(reason in error_text for reason in BOT_NOT_ADMIN_ERRORS):
+                return False  # خطأ مؤقت: لا يغير الحالة المسجلة
+            is_admin = False
+        
+        bot_admin_registry.record(channel_username, is_admin)
+        return is_admin
 
     except Exception as e:
         logger.error(f"خطأ عام في التحقق من إشراف البوت: {e}")
@@ -663,11 +4751,12 @@ async def check_bot_is_admin(bot, channel_username):
 def check_user_channel_status(user_id, channel_id):
     """فحص شامل ودقيق لحالة المستخدم في القناة"""
     user_data = get_user_data(user_id, force_reload=True)
-    channel_data = load_data().get("channels", {}).get(channel_id, {})
+    channel_view = get_data_view().get("channels", {}).get(channel_id)
     
     # التحقق من أن القناة موجودة
-    if not channel_data:
+    if not channel_view:
         return "not_found"
+    channel_data = ChannelRecord.from_json(channel_view)
     
     # تحقق مما إذا كانت القناة مكتملة
     is_completed = channel_data.get("completed", False)
@@ -767,7 +4856,7 @@ def can_user_join_channel(user_id, channel_id, channel_username, channel_data=No
     """التحقق النهائي مما إذا كان يمكن للمستخدم الانضمام للقناة - مُحسنة"""
     
     if channel_data is None:
-        data = load_data()
+        data = get_data_view()
         channel_data = data.get("channels", {}).get(channel_id, {})
 
     # القناة غير موجودة
@@ -828,32 +4917,37 @@ def can_user_join_channel(user_id, channel_id, channel_username, channel_data=No
 def cleanup_old_left_completed_flags():
     """تنظيف علامات left_completed القديمة للقنوات المحذوفة أو المعاد تفعيلها"""
     try:
-        users_data = load_users()
-        data = load_data()
+        editor = SnapshotEditor("users", force_reload=False)
+        data = get_data_view()
+        users_view = editor.view()
         cleaned = 0
         
-        for user_id, user_data in users_data.items():
-            if "joined_channels" not in user_data:
+        # فقط القنوات التي عليها علامات (من الفهرس العكسي) بدلاً من كل المستخدمين
+        for channel_id, user_ids in channel_user_index.left_completed_users():
+            # إذا كانت القناة غير موجودة أو أعيد تفعيلها
+            channel_data = data.get("channels", {}).get(channel_id)
+            if channel_data and channel_data.get("completed", False):
                 continue
+            
+            for user_id in user_ids:
+                join_view = users_view.get(user_id, {}).get("joined_channels", {}).get(channel_id)
+                if not join_view or not join_view.get("left_completed", False):
+                    continue
                 
-            for channel_id, join_info in list(user_data["joined_channels"].items()):
-                if join_info.get("left_completed", False):
-                    # إذا كانت القناة غير موجودة أو أعيد تفعيلها
-                    channel_data = data.get("channels", {}).get(channel_id)
-                    
-                    if not channel_data:
-                        # قناة محذوفة - إزالة العلامة
-                        del user_data["joined_channels"][channel_id]
-                        cleaned += 1
-                    elif not channel_data.get("completed", False):
-                        # قناة أعيد تفعيلها - إزالة العلامة
-                        join_info["left_completed"] = False
-                        if "completed_round" in join_info:
-                            del join_info["completed_round"]
-                        cleaned += 1
+                if not channel_data:
+                    # قناة محذوفة - إزالة العلامة
+                    del editor.container(user_id, "joined_channels")[channel_id]
+                    cleaned += 1
+                else:
+                    # قناة أعيد تفعيلها - إزالة العلامة
+                    join_info = editor.edit(user_id, "joined_channels", channel_id)
+                    join_info["left_completed"] = False
+                    if "completed_round" in join_info:
+                        del join_info["completed_round"]
+                    cleaned += 1
         
         if cleaned > 0:
-            save_users(users_data)
+            editor.commit()
             logger.info(f"🧹 تم تنظيف {cleaned} علامة left_completed قديمة")
         
         return cleaned
@@ -871,24 +4965,21 @@ async def can_claim_daily_gift(user_id):
         return True, 0
     
     try:
-        last_claimed_date = datetime.strptime(last_claimed, "%Y-%m-%d %H:%M:%S")
-        now = datetime.now()
+        remaining = to_timestamp(last_claimed) + 24 * 3600 - now_ts()
         
-        if now - last_claimed_date >= timedelta(hours=24):
+        if remaining <= 0:
             return True, 0
         else:
-            next_claim = last_claimed_date + timedelta(hours=24)
-            remaining = next_claim - now
-            hours = int(remaining.total_seconds() // 3600)
-            minutes = int((remaining.total_seconds() % 3600) // 60)
+            hours = remaining // 3600
+            minutes = (remaining % 3600) // 60
             return False, f"{hours}:{minutes:02d}"
     except Exception as e:
         logger.error(f"خطأ في التحقق من الهدية اليومية: {e}")
         return True, 0
 
-async def check_force_subscription(bot, user_id, chat_id=None):
+async def check_force_subscription(bot, user_id, chat_id=None, fresh=False):
     """التحقق من اشتراك المستخدم في جميع القنوات الإجبارية"""
-    data = load_data()
+    data = get_data_view()
     force_channels = data.get("force_sub_channels", [])
     
     if not force_channels:
@@ -897,12 +4988,12 @@ async def check_force_subscription(bot, user_id, chat_id=None):
     not_subscribed = []
     
     for channel_username in force_channels:
-        bot_is_admin = await check_bot_is_admin(bot, channel_username)
+        bot_is_admin = await bot_admin_registry.is_admin(bot, channel_username)
         
         if not bot_is_admin:
             continue
         
-        is_subscribed = await check_channel_subscription(bot, user_id, channel_username)
+        is_subscribed = await check_channel_subscription(bot, user_id, channel_username, fresh=fresh)
         
         if is_subscribed is False:
             not_subscribed.append(channel_username)
@@ -1031,9 +5122,7 @@ async def send_channel_completion_notifications(bot, channel_username, owner_id,
             duration = "غير معروف"
             if created_at:
                 try:
-                    start_time = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S")
-                    end_time = datetime.now()
-                    diff = end_time - start_time
+                    diff = timedelta(seconds=now_ts() - to_timestamp(created_at, now_ts()))
                     hours = diff.seconds // 3600
                     minutes = (diff.seconds % 3600) // 60
                     duration = f"{diff.days} يوم و {hours} ساعة و {minutes} دقيقة"
@@ -1048,7 +5137,7 @@ async def send_channel_completion_notifications(bot, channel_username, owner_id,
                 f"👤 المالك: {owner_username}\n"
                 f"🆔 آيدي المالك: {owner_id}\n"
                 f"📊 العدد النهائي: {current_count}/{required_count}\n"
-                f"📅 وقت البدء: {created_at}\n"
+                f"📅 وقت البدء: {format_timestamp(created_at)}\n"
                 f"📅 وقت الاكتمال: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
                 f"⏰ المدة: {duration}\n"
                 f"💰 النقاط المدفوعة: {required_count * 2}\n"
@@ -1098,7 +5187,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # ✅✅✅ حفظ حالة المستخدم الجديد قبل أي تحديث ✅✅✅
-    users_data = load_users()
+    users_data = get_users_view()
     is_new_user = (user_id not in users_data)
     
     # 🔢 حساب رقم المستخدم الترتيبي (فقط للمستخدمين الجدد)
@@ -1119,7 +5208,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ref_id = context.args[0]
         
         # إعادة تحميل users_data للتأكد
-        users_data = load_users()
+        users_data = get_users_view()
         
         if ref_id != user_id and ref_id in users_data:
             # تحميل بيانات المُحيل
@@ -1131,16 +5220,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 old_points = ref_data.get("points", 0)
                 old_invites = ref_data.get("invites", 0)
                 
-                # تحديث بيانات المُحيل
-                ref_data["invites"] = old_invites + 1
-                ref_data["invited_users"] = invited_users + [user_id]
-                
                 # إضافة النقاط للمحيل
                 success, message = safe_add_points(ref_id, 4, "add", "invite_points")
                 if success:
                     new_points = old_points + 4
                     new_invites = old_invites + 1
                     
+                    # تحديث بيانات المُحيل (وتوب الدعوات)
+                    update_user_data(
+                        ref_id,
+                        {"invites": new_invites, "invited_users": invited_users + [user_id]},
+                        "invite_update"
+                    )
+                    
                     update_system_stats("total_invites", increment=1)
                     
                     # 🔔 1. إشعار لصاحب رابط الإحالة
@@ -1224,6 +5316,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"📊 إحصائيات البوت الحالية:\n"
                 f"• إجمالي المستخدمين: {stats.get('total_users', 0)}\n"
                 f"• المستخدمين النشطين اليوم: {stats.get('active_users', 0)}\n"
+                f"• النشطون الأسبوع/الشهر: ~{stats.get('active_week', 0)} / ~{stats.get('active_month', 0)}\n"
                 f"• الجدد اليوم: {stats.get('new_today', 0)}\n"
                 f"• الجدد الأسبوع: {stats.get('new_week', 0)}\n"
                 f"• الجدد الشهر: {stats.get('new_month', 0)}\n"
@@ -1291,7 +5384,7 @@ async def handle_code_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     code_name = context.args[0].upper()
     user_id = str(update.message.from_user.id)
-    data = load_data()
+    data = get_data_view()
     
     if code_name in data.get("codes", {}):
         code_data = data["codes"][code_name]
@@ -1311,12 +5404,10 @@ async def handle_code_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text(f"❌ {message}")
             return
         
-        code_data["used_count"] = code_data.get("used_count", 0) + 1
-        if "used_by" not in code_data:
-            code_data["used_by"] = []
-        code_data["used_by"].append(user_id)
-        
-        save_data(data)
+        with edit_snapshot("data") as editor:
+            code_data = editor.edit("codes", code_name)
+            code_data["used_count"] = code_data.get("used_count", 0) + 1
+            code_data.setdefault("used_by", []).append(user_id)
         
         user_data = get_user_data(user_id)
         
@@ -1404,10 +5495,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await handle_claim_daily_gift(query, user_id, context.bot)
             
         elif query.data == "check_force_sub":
+            # المستخدم يؤكد أنه اشترك للتو - فحص جديد بدون الكاش
             can_use, missing_channels = await check_force_subscription(
                 context.bot,
                 int(user_id),
-                query.message.chat_id
+                query.message.chat_id,
+                fresh=True
             )
             
             if can_use:
@@ -1451,6 +5544,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await show_admin_panel(query)
             elif action == "stats":
                 await show_admin_stats(query)
+            elif action == "reports":
+                await show_admin_reports(query)
             elif action == "user_info":
                 await query.edit_message_text(
                     "👤 معلومات مستخدم:\n\n"
@@ -1571,6 +5666,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 context.user_data["admin_action"] = "remove_code"
             elif action == "storage_info":
                 await storage_info(query, context)
+            elif action.startswith("tx_"):
+                target_uid, page = action[3:].rsplit("_", 1)
+                await show_user_transactions(query, target_uid, int(page))
             
         else:
             await query.answer("❌ هذا الزر لا يعمل حالياً!", show_alert=True)
@@ -1611,7 +5709,7 @@ async def show_daily_gift(query, user_id):
         text += f"⏳ الوقت المتبقي: {time_remaining} ساعة\n"
         text += f"📊 السلسلة: {streak} يوم\n"
         text += f"🎯 المجموع: {total_claimed} مرة\n\n"
-        text += f"🕐 آخر مطالبة: {daily_gift.get('last_claimed', 'لم تطالب من قبل')}"
+        text += f"🕐 آخر مطالبة: {format_timestamp(daily_gift.get('last_claimed'), 'لم تطالب من قبل')}"
         
         keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="back_main")]]
     
@@ -1660,21 +5758,12 @@ async def handle_claim_daily_gift(query, user_id, bot):
             return
         
         # تحديث بيانات الهدية اليومية
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        now = now_ts()
         daily_gift = user_data.get("daily_gift", {})
         
-        last_claimed = daily_gift.get("last_claimed")
-        if last_claimed:
-            try:
-                last_date = datetime.strptime(last_claimed, "%Y-%m-%d %H:%M:%S")
-                now_date = datetime.now()
-                
-                if (now_date - last_date).days <= 1:
-                    streak = daily_gift.get("streak", 0) + 1
-                else:
-                    streak = 1
-            except Exception:
-                streak = 1
+        last_claimed = to_timestamp(daily_gift.get("last_claimed"))
+        if last_claimed and (now - last_claimed) // 86400 <= 1:
+            streak = daily_gift.get("streak", 0) + 1
         else:
             streak = 1
         
@@ -1692,6 +5781,7 @@ async def handle_claim_daily_gift(query, user_id, bot):
         
         # تحديث الإحصائيات مرة واحدة
         update_system_stats("total_daily_gifts", increment=1, points=points_to_add)
+        daily_counters.bump("daily_gifts")
         
         # وضع علامة على المعاملة كمكتملة
         cooldown_manager.mark_transaction_complete(transaction_id)
@@ -1729,13 +5819,13 @@ async def handle_claim_daily_gift(query, user_id, bot):
 
 def check_and_mark_completed_channels():
     """التحقق من القنوات المكتملة وحذفها من الملفات"""
-    data = load_data(force_reload=True)
-    users_data = load_users(force_reload=True)
+    data = get_data_view(force_reload=True)
+    users_editor = SnapshotEditor("users")
     channels = data.get("channels", {})
     completed_count = 0
     deleted_channels = []
     
-    for channel_id, channel_data in list(channels.items()):
+    for channel_id, channel_data in channels.items():
         current = channel_data.get("current", 0)
         required = channel_data.get("required", 0)
         
@@ -1746,46 +5836,10 @@ def check_and_mark_completed_channels():
             
             logger.info(f"✅ القناة {channel_username} اكتملت - سيتم حذفها من الملفات")
             
-            # تنظيف بيانات جميع المستخدمين المرتبطين بهذه القناة
-            cleaned_users = 0
-            for user_id, user_info in users_data.items():
-                try:
-                    needs_update = False
-                    
-                    # حذف من active_subscriptions
-                    if "active_subscriptions" in user_info and channel_id in user_info["active_subscriptions"]:
-                        user_info["active_subscriptions"] = [c for c in user_info["active_subscriptions"] if c != channel_id]
-                        needs_update = True
-                    
-                    # حذف من joined_channels
-                    if "joined_channels" in user_info and channel_id in user_info["joined_channels"]:
-                        del user_info["joined_channels"][channel_id]
-                        needs_update = True
-                    
-                    # حذف من temp_left_channels
-                    if "temp_left_channels" in user_info and channel_id in user_info["temp_left_channels"]:
-                        user_info["temp_left_channels"] = [c for c in user_info["temp_left_channels"] if c != channel_id]
-                        needs_update = True
-                    
-                    # حذف من permanent_left_channels
-                    if "permanent_left_channels" in user_info and channel_id in user_info["permanent_left_channels"]:
-                        user_info["permanent_left_channels"] = [c for c in user_info["permanent_left_channels"] if c != channel_id]
-                        needs_update = True
-                    
-                    # حذف من left_channels القديم
-                    if "left_channels" in user_info and channel_id in user_info["left_channels"]:
-                        user_info["left_channels"] = [c for c in user_info["left_channels"] if c != channel_id]
-                        needs_update = True
-                    
-                    if needs_update:
-                        users_data[user_id] = user_info
-                        cleaned_users += 1
-                        
-                except Exception as e:
-                    logger.error(f"خطأ في تنظيف بيانات المستخدم {user_id}: {e}")
+            # تنظيف بيانات المستخدمين المرتبطين بهذه القناة فقط
+            cleaned_users = detach_channel_from_users(users_editor, channel_id)
             
             if cleaned_users > 0:
-                save_users(users_data, backup=False)
                 logger.info(f"🧹 تم تنظيف بيانات {cleaned_users} مستخدم للقناة {channel_username}")
             
             # حذف القناة من الملفات نهائياً
@@ -1794,26 +5848,29 @@ def check_and_mark_completed_channels():
                 "username": channel_username,
                 "owner": owner_id,
                 "final_count": f"{current}/{required}",
-                "deleted_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                "deleted_at": now_ts()
             })
             
-            del channels[channel_id]
             completed_count += 1
     
     if completed_count > 0:
-        data["channels"] = channels
-        save_data(data, backup=False)
+        try:
+            users_editor.commit()
+        except SnapshotConflict as e:
+            # مستخدم تغير أثناء التنظيف - تُحذف القنوات الآن، وروابطها تُنظف في الفحص التالي
+            logger.warning(f"🔀 {e} - تأجيل تنظيف المستخدمين للقنوات المكتملة")
+        
+        with edit_snapshot("data") as editor:
+            channels = editor.container("channels")
+            for deleted in deleted_channels:
+                channels.pop(deleted["id"], None)
+            
+            # حفظ سجل القنوات المحذوفة (اختياري) - الاحتفاظ بآخر 100 سجل فقط
+            root = editor.container()
+            root["deleted_channels_history"] = (
+                list(root.get("deleted_channels_history", [])) + deleted_channels
+            )[-100:]
         logger.info(f"🎯 تم حذف {completed_count} قناة مكتملة من الملفات")
-        
-        # حفظ سجل القنوات المحذوفة (اختياري)
-        if "deleted_channels_history" not in data:
-            data["deleted_channels_history"] = []
-        
-        data["deleted_channels_history"].extend(deleted_channels)
-        
-        # الاحتفاظ بآخر 100 سجل فقط
-        data["deleted_channels_history"] = data["deleted_channels_history"][-100:]
-        save_data(data, backup=False)
     
     return completed_count
 
@@ -1821,7 +5878,7 @@ async def show_collect_points(query, user_id):
     """عرض قنوات التجميع - نسخة مُصلحة تسمح بالعودة"""
     check_and_mark_completed_channels()
 
-    data = load_data(force_reload=True)
+    data = get_data_view(force_reload=True)
     user_data = get_user_data(user_id, force_reload=True)
 
     text = "📊 قنوات التجميع:\n\n"
@@ -1890,7 +5947,7 @@ async def show_collect_points(query, user_id):
                             "verified": True,
                             "left": False,
                             "round": current_round,
-                            "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                            "joined_at": now_ts()
                         }
                         
                         update_user_data(
@@ -1958,7 +6015,7 @@ async def handle_join_channel(query, user_id, bot):
     
     channel_id = query.data.replace("join_channel_", "")
     
-    data = load_data()
+    data = get_data_view()
     
     if channel_id not in data.get("channels", {}):
         await query.answer("❌ القناة غير متاحة", show_alert=True)
@@ -2029,7 +6086,7 @@ async def handle_verify_channel(query, user_id, bot, context):
     _verify_locks.setdefault(lock_key, threading.Lock())
     
     with _verify_locks[lock_key]:
-        data = load_data(force_reload=True)
+        data = get_data_view(force_reload=True)
         
         # التحقق من وجود القناة
         if channel_id not in data.get("channels", {}):
@@ -2096,8 +6153,8 @@ async def handle_verify_channel(query, user_id, bot, context):
             # التحقق من إعادة التفعيل (للحالات الأخرى)
             elif reactivated_at and "joined_at" in join_info:
                 try:
-                    join_time = datetime.strptime(join_info["joined_at"], "%Y-%m-%d %H:%M:%S")
-                    reactivate_time = datetime.strptime(reactivated_at, "%Y-%m-%d %H:%M:%S")
+                    join_time = to_timestamp(join_info["joined_at"])
+                    reactivate_time = to_timestamp(reactivated_at)
                     
                     # إذا انضم قبل إعادة التفعيل ولا يزال منضماً (بدون left)
                     if join_time < reactivate_time and join_info.get("verified", False) and not join_info.get("left", False):
@@ -2129,7 +6186,8 @@ async def handle_verify_channel(query, user_id, bot, context):
         
         # التحقق من اشتراك المستخدم في القناة
         try:
-            is_subscribed = await check_channel_subscription(bot, int(user_id), channel_username)
+            # المستخدم يؤكد أنه انضم للتو - فحص جديد بدون الكاش
+            is_subscribed = await check_channel_subscription(bot, int(user_id), channel_username, fresh=True)
             
             if is_subscribed is None:
                 await query.edit_message_text(
@@ -2199,12 +6257,13 @@ async def handle_verify_channel(query, user_id, bot, context):
             cooldown_manager.mark_transaction_complete(transaction_id)
             return
         
-        # تحديث بيانات القناة
+        # تحديث بيانات القناة (نسخة خاصة من هذه القناة فقط)
+        channel = channel.copy()
         current_count = channel.get("current", 0) + 1
         required_count = channel.get("required", 0)
         
         channel["current"] = current_count
-        channel["last_activity"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        channel["last_activity"] = now_ts()
         
         # ✅ التحقق إذا كان المستخدم عائد (غادر سابقاً)
         user_data_check = get_user_data(user_id, force_reload=True)
@@ -2220,39 +6279,36 @@ async def handle_verify_channel(query, user_id, bot, context):
                 previous_leave_time = join_info_check.get("left_at")
                 logger.info(
                     f"🔄 المستخدم {user_id} يعود للقناة {channel_id} "
-                    f"(غادر في: {previous_leave_time})"
+                    f"(غادر في: {format_timestamp(previous_leave_time)})"
                 )
         
+        normalize_channel_history(channel)
+        
         # ✅ تسجيل في سجل العودة إذا كان عائداً
         if is_returning_user:
-            if "return_history" not in channel:
-                channel["return_history"] = []
-            
-            channel["return_history"].append({
+            append_channel_history(channel, "return_history", {
                 "user_id": user_id,
-                "returned_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "returned_at": now_ts(),
                 "previous_leave": previous_leave_time,
                 "previous_count": current_count - 1,
                 "new_count": current_count,
                 "points_earned": 3
             })
-        
-        if "joined_users" not in channel:
-            channel["joined_users"] = []
+            channel["total_returns"] += 1
         
         # إضافة المستخدم مع معلومات الجولة
-        channel["joined_users"].append({
-            "user_id": user_id,
-            "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        channel["joined_users"][user_id] = {
+            "joined_at": now_ts(),
             "round": current_round,
             "reactivated_at": reactivated_at,
             "returning": is_returning_user
-        })
+        }
+        channel["total_joins"] += 1
         
         # التحقق من اكتمال القناة
         if current_count >= required_count:
             channel["completed"] = True
-            channel["completed_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            channel["completed_at"] = now_ts()
             logger.info(f"✅ تم إكمال القناة {channel_username} - {current_count}/{required_count}")
             
             # 🔴 🔴 🔴 إرسال إشعارات فورية عند الاكتمال 🔴 🔴 🔴
@@ -2263,15 +6319,16 @@ async def handle_verify_channel(query, user_id, bot, context):
                     owner_id=channel.get("owner"),
                     current_count=current_count,
                     required_count=required_count,
-                    created_at=channel.get("created_at", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                    created_at=channel.get("created_at", now_ts())
                 )
             except Exception as e:
                 logger.error(f"❌ خطأ في إرسال إشعارات الاكتمال: {e}")
         
         # تحديث بيانات القناة
-        data["channels"][channel_id] = channel
+        push = {"return_history": channel["return_history"][-1]} if is_returning_user else None
+        join = {user_id: channel["joined_users"][user_id]}
         
-        if not save_data(data, backup=False):
+        if not save_channel_counter_change(channel_id, channel, push=push, join=join):
             logger.error(f"خطأ في حفظ بيانات القناة {channel_id}")
         
         # وضع علامة على المعاملة كمكتملة
@@ -2396,7 +6453,7 @@ async def handle_buy(query, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_invite_link(query, user_id, bot):
     """عرض رابط الدعوة"""
-    bot_username = (await bot.get_me()).username
+    bot_username = bot.username
     invite_link = f"https://t.me/{bot_username}?start={user_id}"
     
     user_data = get_user_data(user_id)
@@ -2420,14 +6477,14 @@ async def show_invite_link(query, user_id, bot):
 def cleanup_permanent_left_channels(context: ContextTypes.DEFAULT_TYPE = None):
     """تنظيف القنوات المتروكة نهائياً (تغيير النظام)"""
     try:
-        users_data = load_users()
+        users_data = get_users_view()
         cleaned_count = 0
         
         for user_id, user_data in users_data.items():
             if "permanent_left_channels" in user_data and user_data["permanent_left_channels"]:
                 # ننقل جميع القنوات من permanent_left إلى temp_left
-                temp_left = user_data.get("temp_left_channels", [])
-                permanent_left = user_data["permanent_left_channels"]
+                temp_left = list(user_data.get("temp_left_channels", []))
+                permanent_left = list(user_data["permanent_left_channels"])
                 
                 for channel_id in permanent_left:
                     if channel_id not in temp_left:
@@ -2449,46 +6506,52 @@ def cleanup_permanent_left_channels(context: ContextTypes.DEFAULT_TYPE = None):
         logger.error(f"خطأ في تنظيف permanent_left_channels: {e}")
         return 0
         
-async def show_top(query):
-    """عرض التوب"""
-    users_data = load_users()
-    data = load_data()
-    
-    users_points = []
-    for uid, user_data in users_data.items():
-        if uid not in data.get("admins", []):
-            users_points.append((uid, user_data.get("points", 0), user_data.get("username", "بدون يوزر")))
-    
-    users_points.sort(key=lambda x: x[1], reverse=True)
+_top_text_cache = {"key": None, "text": ""}
+
+def render_top_text():
+    """نص التوب - يُعاد بناؤه فقط إذا تغير ترتيب أو اسم أو حالة أحد المعروضين"""
+    users_data = get_users_view()
+    data = get_data_view()
+    admins = set(data.get("admins", []))
+    banned = set(data.get("banned_users", []))
+    muted = data.get("muted_users", {})
+    
+    def status_of(uid):
+        if uid in banned:
+            return "🚫 "
+        if uid in muted and is_muted(uid)[0]:
+            return "🔇 "
+        return ""
+    
+    boards = []
+    for field in ("points", "invites"):
+        version, top = user_columns.top(field, TOP_SIZE, exclude=admins)
+        boards.append((version, tuple(
+            (uid, value, users_data.get(uid, {}).get("username", "بدون يوزر"), status_of(uid))
+            for uid, value in top
+        )))
+    
+    key = tuple(boards)
+    if _top_text_cache["key"] == key:
+        return _top_text_cache["text"]
+    
+    (_, top_points), (_, top_invites) = boards
     
     text = "🏆 توب النقاط:\n\n"
-    for i, (uid, points, username) in enumerate(users_points[:10], 1):
-        status = ""
-        if is_banned(int(uid)):
-            status = "🚫 "
-        elif is_muted(uid)[0]:
-            status = "🔇 "
-        
+    for i, (uid, points, username, status) in enumerate(top_points, 1):
         text += f"{i}. {status}@{username}: {points} نقطة\n"
     
     text += "\n🏆 توب الدعوات:\n\n"
-    
-    users_invites = []
-    for uid, user_data in users_data.items():
-        if uid not in data.get("admins", []):
-            users_invites.append((uid, user_data.get("invites", 0), user_data.get("username", "بدون يوزر")))
-    
-    users_invites.sort(key=lambda x: x[1], reverse=True)
-    
-    for i, (uid, invites, username) in enumerate(users_invites[:10], 1):
-        status = ""
-        if is_banned(int(uid)):
-            status = "🚫 "
-        elif is_muted(uid)[0]:
-            status = "🔇 "
-        
+    for i, (uid, invites, username, status) in enumerate(top_invites, 1):
         text += f"{i}. {status}@{username}: {invites} دعوة\n"
     
+    _top_text_cache["key"], _top_text_cache["text"] = key, text
+    return text
+
+async def show_top(query):
+    """عرض التوب"""
+    text = render_top_text()
+    
     keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="back_main")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="HTML")
@@ -2522,15 +6585,12 @@ async def handle_report_channel(query, user_id, bot):
         await query.answer(f"⚠️ لقد أبلغت عن هذه القناة {channel_type} مسبقاً!", show_alert=True)
         return
     
-    data = load_data()
+    data = get_data_view()
     if channel_id in data.get("channels", {}):
         channel = data["channels"][channel_id]
         
-        if "reports" not in data:
-            data["reports"] = {}
-        
         report_id = f"report_{int(time.time())}"
-        data["reports"][report_id] = {
+        report = {
             "channel_id": channel_id,
             "channel_username": channel.get("username", ""),
             "channel_type": channel_type,
@@ -2538,10 +6598,13 @@ async def handle_report_channel(query, user_id, bot):
             "reporter_username": get_user_data(user_id).get("username", ""),
             "reason": "عدم الاشتراك أو مشكلة في القناة",
             "status": "pending",
-            "created_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            "created_at": now_ts()
         }
         
-        save_data(data)
+        with edit_snapshot("data") as editor:
+            if "reports" not in editor.view():
+                editor.container()["reports"] = {}
+            editor.container("reports")[report_id] = report
         
         add_user_reported_channel(user_id, channel_id)
         
@@ -2634,22 +6697,14 @@ async def show_admin_panel(query):
 
 async def show_admin_stats(query):
     """عرض إحصائيات البوت"""
-    data = load_data()
-    users_data = load_users()
+    data = get_data_view()
     stats = data.get("stats", {})
     
-    active_users = 0
-    week_ago = datetime.now().timestamp() - (7 * 24 * 60 * 60)
-    
-    for uid, user_data in users_data.items():
-        last_active_str = user_data.get("last_active", "")
-        if last_active_str:
-            try:
-                last_active = datetime.strptime(last_active_str, "%Y-%m-%d %H:%M:%S").timestamp()
-                if last_active > week_ago:
-                    active_users += 1
-            except:
-                pass
+    # نشطون مميزون خلال 7 و 30 يوماً (تقريبي من مخططات HyperLogLog)
+    active_users = active_sketches.count(0, 6)
+    active_month = active_sketches.count(0, 29)
+    today = daily_counters.day()
+    balance = user_columns.balance()
     
     completed_channels = 0
     active_channels = 0
@@ -2659,17 +6714,13 @@ async def show_admin_stats(query):
         else:
             active_channels += 1
     
-    total_daily_gifts = 0
-    for uid, user_data in users_data.items():
-        daily_gift = user_data.get("daily_gift", {})
-        total_daily_gifts += daily_gift.get("total_claimed", 0)
-    
     text = (
         f"📊 إحصائيات البوت الكاملة:\n\n"
         
         f"👥 المستخدمين:\n"
         f"• إجمالي المستخدمين: {stats.get('total_users', 0)}\n"
-        f"• المستخدمين النشطين: {active_users}\n"
+        f"• النشطون هذا الأسبوع: ~{active_users}\n"
+        f"• النشطون هذا الشهر: ~{active_month}\n"
         f"• عدد المحظورين: {len(data.get('banned_users', []))}\n"
         f"• عدد المكتومين: {len(data.get('muted_users', {}))}\n"
         f"• عدد الأدمن: {len(data.get('admins', []))}\n\n"
@@ -2679,7 +6730,16 @@ async def show_admin_stats(query):
         f"• إجمالي الدعوات: {stats.get('total_invites', 0)}\n"
         f"• إجمالي المشتريات: {stats.get('total_purchases', 0)}\n"
         f"• إجمالي الانضمامات: {stats.get('total_joins', 0)}\n"
-        f"• إجمالي الهدايا اليومية: {total_daily_gifts}\n\n"
+        f"• إجمالي الهدايا اليومية: {stats.get('total_daily_gifts', 0)}\n"
+        f"• المكتسب / المصروف: {balance['total_earned']} / {balance['total_spent']}\n\n"
+        
+        f"📅 اليوم:\n"
+        f"• مستخدمون جدد: {today.get('new_users', 0)}\n"
+        f"• مستخدمون نشطون: {today.get('active_users', 0)}\n"
+        f"• نقاط موزعة: {today.get('points_issued', 0)}\n"
+        f"• نقاط مصروفة: {today.get('points_spent', 0)}\n"
+        f"• انضمامات: {today.get('joins', 0)}\n"
+        f"• هدايا يومية: {today.get('daily_gifts', 0)}\n\n"
         
         f"📢 القنوات:\n"
         f"• إجمالي القنوات: {len(data.get('channels', {}))}\n"
@@ -2693,76 +6753,112 @@ async def show_admin_stats(query):
         f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
     )
     
-    keyboard = [[InlineKeyboardButton("🔙 رجوع للوحة", callback_data="admin_panel")]]
+    keyboard = [
+        [InlineKeyboardButton("📈 تقارير تحليلية", callback_data="admin_reports")],
+        [InlineKeyboardButton("🔙 رجوع للوحة", callback_data="admin_panel")]
+    ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="HTML")
 
+async def show_admin_reports(query):
+    """تقارير تحليلية من اللقطة العمودية: توزيع النقاط، الرصيد، النشاط، الاحتفاظ"""
+    percentiles = user_columns.percentiles("points")
+    points_buckets = user_columns.distribution("points", [1, 10, 100, 1000])
+    invites_buckets = user_columns.distribution("invites", [1, 5, 20])
+    balance = user_columns.balance()
+    activity = user_columns.activity_buckets()
+    
+    text = "📈 تقارير تحليلية:\n\n"
+    
+    text += "💰 توزيع النقاط (نسب مئوية):\n"
+    text += " | ".join(f"p{p}: {value}" for p, value in percentiles.items()) + "\n"
+    text += (
+        f"• 0: {points_buckets[0]} | 1-9: {points_buckets[1]} | 10-99: {points_buckets[2]} | "
+        f"100-999: {points_buckets[3]} | 1000+: {points_buckets[4]}\n\n"
+    )
+    
+    text += (
+        f"👥 توزيع الدعوات:\n"
+        f"• 0: {invites_buckets[0]} | 1-4: {invites_buckets[1]} | 5-19: {invites_buckets[2]} | 20+: {invites_buckets[3]}\n\n"
+    )
+    
+    text += (
+        f"⚖️ المكتسب مقابل المصروف:\n"
+        f"• المكتسب: {balance['total_earned']} | المصروف: {balance['total_spent']}\n"
+        f"• نسبة الصرف: {balance['spend_ratio'] * 100:.1f}%\n"
+        f"• صرفوا أكثر مما اكتسبوا: {balance['overspent']}\n"
+        f"• اكتسبوا ولم يصرفوا: {balance['never_spent']}\n\n"
+    )
+    
+    text += (
+        f"🕒 آخر نشاط:\n"
+        f"• اليوم: {activity[0]} | الأسبوع: {activity[1]} | الشهر: {activity[2]} | أقدم: {activity[3]}\n\n"
+    )
+    
+    text += "📅 الاحتفاظ حسب أسبوع الانضمام (نشطون آخر 7 أيام):\n"
+    for week, size, retained in user_columns.cohort_retention():
+        rate = retained / size * 100 if size else 0
+        text += f"• قبل {week} أسبوع: {retained}/{size} ({rate:.0f}%)\n"
+    
+    keyboard = [[InlineKeyboardButton("🔙 رجوع للإحصائيات", callback_data="admin_stats")]]
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML")
+
+async def show_user_transactions(query, target_uid, page=0):
+    """عرض صفحة من سجل معاملات مستخدم (من فهرس سجل المعاملات)"""
+    ledger = get_ledger()
+    total = ledger.count(target_uid)
+    pages = max(1, (total + TRANSACTIONS_PAGE_SIZE - 1) // TRANSACTIONS_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    
+    text = f"📜 سجل معاملات {target_uid}\n📊 المجموع: {total} | الصفحة {page + 1}/{pages}\n\n"
+    
+    transactions = ledger.page(target_uid, page, TRANSACTIONS_PAGE_SIZE)
+    if not transactions:
+        text += "لا توجد معاملات."
+    for transaction in transactions:
+        updates = transaction.get("updates", {})
+        changes = ", ".join(
+            f"{key}={value}" for key, value in updates.items() if not isinstance(value, (dict, list))
+        )
+        text += f"🕒 {format_timestamp(transaction.get('timestamp'))}\n🔖 {transaction.get('action', '')}"
+        if changes:
+            text += f" ({changes})"
+        text += "\n\n"
+    
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️ الأحدث", callback_data=f"admin_tx_{target_uid}_{page - 1}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("الأقدم ➡️", callback_data=f"admin_tx_{target_uid}_{page + 1}"))
+    
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("🔙 رجوع للوحة", callback_data="admin_panel")])
+    
+    await query.edit_message_text(text[:4000], reply_markup=InlineKeyboardMarkup(keyboard))
+
 def get_user_statistics():
-    """الحصول على إحصائيات شاملة للمستخدمين"""
+    """الحصول على إحصائيات شاملة للمستخدمين (من العدادات اليومية والفهارس)"""
     try:
-        users_data = load_users()
-        data = load_data()
-        
-        stats = {
-            "total_users": len(users_data),
-            "active_users": 0,
-            "new_today": 0,
-            "new_week": 0,
-            "new_month": 0,
-            "with_username": 0,
-            "with_invites": 0,
+        data = get_data_view()
+        columns = user_columns.summary()
+        
+        return {
+            "total_users": columns["users"],
+            "active_users": active_sketches.count(0, 0),
+            "active_week": active_sketches.count(0, 6),
+            "active_month": active_sketches.count(0, 29),
+            "new_today": daily_counters.total("new_users", 0, 0),
+            "new_week": daily_counters.total("new_users", 1, 7),
+            "new_month": daily_counters.total("new_users", 8, 30),
+            "with_username": username_index.count(),
+            "with_invites": columns["with_invites"],
             "banned_users": len(data.get("banned_users", [])),
             "muted_users": len(data.get("muted_users", {})),
-            "total_points": 0,
-            "total_invites": 0
+            "total_points": columns["total_points"],
+            "total_invites": columns["total_invites"]
         }
         
-        today = datetime.now().date()
-        week_ago = today - timedelta(days=7)
-        month_ago = today - timedelta(days=30)
-        
-        for uid, user_data in users_data.items():
-            # النقاط والدعوات
-            stats["total_points"] += user_data.get("points", 0)
-            stats["total_invites"] += user_data.get("invites", 0)
-            
-            # اليوزرنيم
-            if user_data.get("username"):
-                stats["with_username"] += 1
-            
-            # الدعوات
-            if user_data.get("invites", 0) > 0:
-                stats["with_invites"] += 1
-            
-            # النشاط
-            last_active_str = user_data.get("last_active", "")
-            if last_active_str:
-                try:
-                    last_active_date = datetime.strptime(last_active_str, "%Y-%m-%d %H:%M:%S").date()
-                    if last_active_date == today:
-                        stats["active_users"] += 1
-                except:
-                    pass
-            
-            # التواريخ
-            first_join_str = user_data.get("first_join", "")
-            if first_join_str:
-                try:
-                    join_date = datetime.strptime(first_join_str, "%Y-%m-%d %H:%M:%S").date()
-                    
-                    if join_date == today:
-                        stats["new_today"] += 1
-                    elif join_date >= week_ago:
-                        stats["new_week"] += 1
-                    elif join_date >= month_ago:
-                        stats["new_month"] += 1
-                        
-                except:
-                    pass
-        
-        return stats
-        
     except Exception as e:
         logger.error(f"❌ خطأ في get_user_statistics: {e}")
         return None
@@ -2770,7 +6866,7 @@ def get_user_statistics():
 async def check_and_remove_channel_if_bot_not_admin(bot, context: ContextTypes.DEFAULT_TYPE = None):
     """فحص جميع القنوات وإزالة القنوات التي لم يعد البوت مشرفاً فيها"""
     try:
-        data = load_data(force_reload=True)
+        data = get_data_view(force_reload=True)
         channels = data.get("channels", {})
         removed_channels = []
         
@@ -2785,7 +6881,7 @@ async def check_and_remove_channel_if_bot_not_admin(bot, context: ContextTypes.D
                 continue
             
             try:
-                bot_is_admin = await check_bot_is_admin(bot, channel_username)
+                bot_is_admin = await bot_admin_registry.is_admin(bot, channel_username)
                 
                 if not bot_is_admin:
                     # البوت لم يعد مشرفاً - حذف القناة
@@ -2795,16 +6891,11 @@ async def check_and_remove_channel_if_bot_not_admin(bot, context: ContextTypes.D
                         "owner": channel_data.get("owner", "unknown"),
                         "required": channel_data.get("required", 0),
                         "current": channel_data.get("current", 0),
-                        "created_at": channel_data.get("created_at", "unknown"),
-                        "removed_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        "created_at": channel_data.get("created_at", 0),
+                        "removed_at": now_ts(),
                         "reason": "البوت لم يعد مشرفاً في القناة"
                     }
                     
-                    # إضافة للسجل
-                    if "removed_channels_history" not in data:
-                        data["removed_channels_history"] = []
-                    data["removed_channels_history"].append(channel_info)
-                    
                     # الحصول على معلومات المالك
                     owner_id = channel_data.get("owner")
                     owner_name = "غير معروف"
@@ -2852,8 +6943,7 @@ async def check_and_remove_channel_if_bot_not_admin(bot, context: ContextTypes.D
                             else:
                                 logger.error(f"❌ فشل إعادة النقاط للمالك {owner_id}: {message}")
                     
-                    # حذف القناة
-                    del channels[channel_id]
+                    # حذف القناة (يُحفظ مرة واحدة بعد الفحص)
                     removed_channels.append(channel_info)
                     logger.warning(f"🗑️ تم حذف القناة {channel_username} - البوت لم يعد مشرفاً")
                     
@@ -2861,17 +6951,22 @@ async def check_and_remove_channel_if_bot_not_admin(bot, context: ContextTypes.D
                 logger.error(f"❌ خطأ في فحص إشراف البوت للقناة {channel_username}: {e}")
         
         if removed_channels:
-            data["channels"] = channels
-            save_data(data, backup=False)
+            with edit_snapshot("data") as editor:
+                remaining = editor.container("channels")
+                for chan in removed_channels:
+                    remaining.pop(chan["id"], None)
+                # إضافة للسجل
+                root = editor.container()
+                root["removed_channels_history"] = list(root.get("removed_channels_history", [])) + removed_channels
             
             # إرسال تقرير للمالك
             report_msg = (
                 f"⚠️ تقرير فحص إشراف البوت\n\n"
                 f"━━━━━━━━━━━━━━━━━━━━\n"
                 f"📅 التاريخ: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-                f"🔍 تم فحص: {len(data.get('channels', {})) + len(removed_channels)} قناة\n"
+                f"🔍 تم فحص: {len(channels)} قناة\n"
                 f"🗑️ تم حذف: {len(removed_channels)} قناة\n"
-                f"✅ القنوات النشطة: {len(data.get('channels', {}))}\n"
+                f"✅ القنوات النشطة: {len(remaining)}\n"
                 f"━━━━━━━━━━━━━━━━━━━━\n\n"
                 f"📋 القنوات المحذوفة:\n"
             )
@@ -2910,7 +7005,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 target_uid = None
                 
                 if target.isdigit():
-                    users_data = load_users()
+                    users_data = get_users_view()
                     if target in users_data:
                         target_uid = target
                 else:
@@ -2918,7 +7013,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 
                 if target_uid:
                     user_data = get_user_data(target_uid)
-                    data = load_data()
+                    data = get_data_view()
                     
                     daily_gift = user_data.get("daily_gift", {})
                     
@@ -2937,8 +7032,8 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                         f"💰 مجموع الربح: {user_data.get('total_earned', 0)}\n"
                         f"💸 مجموع الصرف: {user_data.get('total_spent', 0)}\n"
                         f"🔗 عدد الدعوات: {user_data.get('invites', 0)}\n"
-                        f"📅 تاريخ الانضمام: {user_data.get('first_join', '')}\n"
-                        f"🔄 آخر نشاط: {user_data.get('last_active', '')}\n"
+                        f"📅 تاريخ الانضمام: {format_timestamp(user_data.get('first_join'))}\n"
+                        f"🔄 آخر نشاط: {format_timestamp(user_data.get('last_active'))}\n"
                         f"🚫 الحالة: {ban_status}\n"
                         f"🔇 الكتم: {mute_status_text}\n"
                         f"🛒 عدد الطلبات: {len(user_data.get('orders', []))}\n"
@@ -2948,7 +7043,14 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                         f"📈 سلسلة الهدايا: {daily_gift.get('streak', 0)} يوم\n\n"
                     )
                     
-                    await update.message.reply_text(info_text, parse_mode="HTML")
+                    tx_count = get_ledger().count(target_uid)
+                    keyboard = [[InlineKeyboardButton(
+                        f"📜 سجل المعاملات ({tx_count})", callback_data=f"admin_tx_{target_uid}_0"
+                    )]]
+                    
+                    await update.message.reply_text(
+                        info_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="HTML"
+                    )
                 else:
                     await update.message.reply_text("❌ المستخدم غير موجود في قاعدة البيانات.")
                 
@@ -2958,7 +7060,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 await update.message.reply_text("⏳ جاري إرسال الرسالة للجميع...")
                 
                 broadcast_msg = text
-                users_data = load_users()
+                users_data = get_users_view()
                 sent_count = 0
                 failed_count = 0
                 total_users = len(users_data)
@@ -3002,7 +7104,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 target_uid = None
                 
                 if target_input.isdigit():
-                    users_data = load_users()
+                    users_data = get_users_view()
                     if target_input in users_data:
                         target_uid = target_input
                 else:
@@ -3050,7 +7152,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 target_uid = None
                 
                 if target_input.isdigit():
-                    users_data = load_users()
+                    users_data = get_users_view()
                     if target_input in users_data:
                         target_uid = target_input
                 else:
@@ -3081,17 +7183,17 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 target_uid = None
                 
                 if target.isdigit():
-                    users_data = load_users()
+                    users_data = get_users_view()
                     if target in users_data:
                         target_uid = target
                 else:
                     target_uid = find_user_by_username(target)
                 
                 if target_uid:
-                    data = load_data()
-                    if target_uid not in data["banned_users"]:
-                        data["banned_users"].append(target_uid)
-                        save_data(data)
+                    editor = SnapshotEditor("data")
+                    if target_uid not in editor.root["banned_users"]:
+                        editor.container("banned_users").append(target_uid)
+                        editor.commit()
                         
                         user_data = get_user_data(target_uid)
                         
@@ -3130,12 +7232,12 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                     target_uid = find_user_by_username(target)
                 
                 if target_uid:
-                    data = load_data()
-                    if target_uid in data["banned_users"]:
-                        data["banned_users"].remove(target_uid)
-                        save_data(data)
+                    editor = SnapshotEditor("data")
+                    if target_uid in editor.root["banned_users"]:
+                        editor.container("banned_users").remove(target_uid)
+                        editor.commit()
                         
-                        users_data = load_users()
+                        users_data = get_users_view()
                         username = users_data.get(target_uid, {}).get("username", target_uid)
                         
                         await update.message.reply_text(
@@ -3173,7 +7275,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 target_uid = None
                 
                 if target_input.isdigit():
-                    users_data = load_users()
+                    users_data = get_users_view()
                     if target_input in users_data:
                         target_uid = target_input
                 else:
@@ -3193,7 +7295,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                     user_data = get_user_data(target_uid)
                     
                     duration_text = "دائم" if mute_seconds == 0 else format_time(mute_seconds)
-                    mute_until_text = mute_info.get("until", "غير محدد")
+                    mute_until_text = format_timestamp(mute_info.get("until"), "غير محدد")
                     
                     try:
                         await context.bot.send_message(
@@ -3266,19 +7368,17 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 channel_username = parts[0].replace("@", "").strip()
                 members_count = int(parts[1])
                 
-                data = load_data()
+                data = get_data_view()
                 
-                # التحقق من وجود قناة نشطة لنفس اليوزر
-                existing_active_channel = None
-                for cid, existing_channel in data.get("channels", {}).items():
-                    if (existing_channel.get("username") == channel_username and 
-                        not existing_channel.get("completed", False)):  # قناة نشطة غير مكتملة
-                        existing_active_channel = (cid, existing_channel)
-                        break
-
-                if existing_active_channel:
+                # التحقق من وجود قناة نشطة غير مكتملة لنفس اليوزر
+                active_channels = channel_username_index.find(
+                    data.get("channels", {}), channel_username, completed=False
+                )
+
+                if active_channels:
                     # هناك قناة نشطة لنفس اليوزر
-                    cid, chan_data = existing_active_channel
+                    cid = active_channels[0]
+                    chan_data = data["channels"][cid]
                     owner_id = chan_data.get("owner", "غير معروف")
                     
                     # الحصول على اسم المالك إذا كان مستخدم عادي
@@ -3294,7 +7394,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                         f"🆔 ID المالك: {owner_id}\n"
                         f"📊 التقدم: {chan_data.get('current', 0)}/{chan_data.get('required', 0)}\n"
                         f"🆔 المعرف: {cid}\n"
-                        f"📅 تاريخ الإضافة: {chan_data.get('created_at', 'غير معروف')}\n\n"
+                        f"📅 تاريخ الإضافة: {format_timestamp(chan_data.get('created_at'), 'غير معروف')}\n\n"
                         f"💡 يجب:\n"
                         f"• الانتظار حتى تكتمل القناة\n"
                         f"• أو حذف القناة أولاً (باستخدام /admin_remove_channel)\n"
@@ -3305,30 +7405,25 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                     return
                 
                 # البحث عن قناة مكتملة من الأدمن لنفس القناة
-                existing_completed_channel = None
-                for cid, existing_channel in data.get("channels", {}).items():
-                    if (existing_channel.get("username") == channel_username and 
-                        existing_channel.get("owner") == str(ADMIN_ID) and 
-                        existing_channel.get("completed", False)):
-                        existing_completed_channel = (cid, existing_channel)
-                        break
+                completed_channels = channel_username_index.find(
+                    data.get("channels", {}), channel_username, owner=ADMIN_ID, completed=True
+                )
                 
-                if existing_completed_channel:
+                if completed_channels:
                     # إعادة استخدام القناة المكتملة
-                    channel_id, channel_data = existing_completed_channel
-                    
-                    channel_data.update({
-                        "required": members_count,
-                        "current": 0,
-                        "completed": False,
-                        "reuse_count": channel_data.get("reuse_count", 0) + 1,
-                        "joined_users": [],
-                        "reactivated_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        "admin_added": True
-                    })
+                    channel_id = completed_channels[0]
                     
-                    data["channels"][channel_id] = channel_data
-                    save_data(data)
+                    with edit_snapshot("data") as editor:
+                        channel_data = editor.edit("channels", channel_id)
+                        channel_data.update({
+                            "required": members_count,
+                            "current": 0,
+                            "completed": False,
+                            "reuse_count": channel_data.get("reuse_count", 0) + 1,
+                            "joined_users": {},
+                            "reactivated_at": now_ts(),
+                            "admin_added": True
+                        })
                     
                     await update.message.reply_text(
                         f"🔄 تم إعادة تفعيل قناة الأدمن!\n\n"
@@ -3344,19 +7439,19 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                     # قناة جديدة
                     channel_id = f"admin_channel_{int(time.time())}_{abs(hash(channel_username)) % 10000}"
                     
-                    data["channels"][channel_id] = {
+                    channel_data = {
                         "username": channel_username,
                         "owner": str(ADMIN_ID),
                         "required": members_count,
                         "current": 0,
                         "completed": False,
-                        "joined_users": [],
-                        "created_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        "joined_users": {},
+                        "created_at": now_ts(),
                         "admin_added": True,
                         "reuse_count": 0
                     }
-                    
-                    save_data(data)
+                    with edit_snapshot("data") as editor:
+                        editor.container("channels")[channel_id] = channel_data
                     
                     await update.message.reply_text(
                         f"✅ تم إضافة قناة جديدة:\n\n"
@@ -3364,7 +7459,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                         f"👥 العدد المطلوب: {members_count} عضو\n"
                         f"💰 النقاط للمنضم: 3 نقاط\n"
                         f"🆔 المعرف: {channel_id}\n"
-                        f"📅 تاريخ الإضافة: {data['channels'][channel_id]['created_at']}",
+                        f"📅 تاريخ الإضافة: {format_timestamp(channel_data['created_at'])}",
                         parse_mode="HTML"
                     )
                 del context.user_data["admin_action"]
@@ -3384,16 +7479,17 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                     del context.user_data["admin_action"]
                     return
                 
-                data = load_data()
-                if channel_username not in data.get("force_sub_channels", []):
-                    data["force_sub_channels"].append(channel_username)
-                    save_data(data)
+                editor = SnapshotEditor("data")
+                if channel_username not in editor.root.get("force_sub_channels", []):
+                    force_channels = editor.container("force_sub_channels")
+                    force_channels.append(channel_username)
+                    editor.commit()
                     
                     await update.message.reply_text(
                         f"✅ تم إضافة قناة اشتراك إجباري:\n\n"
                         f"🔒 اليوزر: @{channel_username}\n"
                         f"🤖 حالة البوت: مشرف ✓\n"
-                        f"📊 عدد القنوات الإجبارية: {len(data['force_sub_channels'])}\n"
+                        f"📊 عدد القنوات الإجبارية: {len(force_channels)}\n"
                         f"📅 تاريخ الإضافة: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
                         parse_mode="HTML"
                     )
@@ -3412,29 +7508,29 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 points = int(parts[1])
                 max_uses = int(parts[2])
                 
-                data = load_data()
+                editor = SnapshotEditor("data")
                 
-                if code_name in data.get("codes", {}):
+                if code_name in editor.root.get("codes", {}):
                     await update.message.reply_text("⚠️ هذا الكود موجود بالفعل!")
                     return
                 
-                data["codes"][code_name] = {
+                code_data = {
                     "points": points,
                     "max_uses": max_uses,
                     "used_count": 0,
                     "used_by": [],
-                    "created_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    "created_at": now_ts(),
                     "created_by": str(ADMIN_ID)
                 }
-                
-                save_data(data)
+                editor.container("codes")[code_name] = code_data
+                editor.commit()
                 
                 await update.message.reply_text(
                     f"✅ تم إضافة كود جديد:\n\n"
                     f"🎟️ اسم الكود: {code_name}\n"
                     f"💰 عدد النقاط: {points}\n"
                     f"👥 عدد المستخدمين: {max_uses}\n"
-                    f"📅 تاريخ الإنشاء: {data['codes'][code_name]['created_at']}\n\n"
+                    f"📅 تاريخ الإنشاء: {format_timestamp(code_data['created_at'])}\n\n"
                     f"💡 للاستخدام: /code {code_name}",
                     parse_mode="HTML"
                 )
@@ -3443,41 +7539,32 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
             elif action == "remove_channel":
                 channel_input = text.strip()
                 
-                data = load_data()
+                data = get_data_view()
                 removed_channels = []
                 
-                # البحث عن القنوات
-                for cid, channel_data in data.get("channels", {}).items():
-                    # إذا كان الإدخال يبدأ بـ @ فهو يوزر قناة
-                    if channel_input.startswith("@"):
-                        channel_username = channel_input.replace("@", "").strip()
-                        if channel_data.get("username") == channel_username:
-                            removed_channels.append({
-                                "id": cid,
-                                "username": channel_data.get("username"),
-                                "owner": channel_data.get("owner"),
-                                "progress": f"{channel_data.get('current', 0)}/{channel_data.get('required', 0)}",
-                                "completed": channel_data.get("completed", False),
-                                "created_at": channel_data.get("created_at", "غير معروف")
-                            })
-                    else:
-                        # إذا كان معرف القناة مباشرة
-                        if cid == channel_input:
-                            removed_channels.append({
-                                "id": cid,
-                                "username": channel_data.get("username"),
-                                "owner": channel_data.get("owner"),
-                                "progress": f"{channel_data.get('current', 0)}/{channel_data.get('required', 0)}",
-                                "completed": channel_data.get("completed", False),
-                                "created_at": channel_data.get("created_at", "غير معروف")
-                            })
+                # البحث عن القنوات: يوزر قناة (يبدأ بـ @) من الفهرس، أو معرف القناة مباشرة
+                if channel_input.startswith("@"):
+                    matched_ids = channel_username_index.find(data.get("channels", {}), channel_input)
+                else:
+                    matched_ids = [channel_input] if channel_input in data.get("channels", {}) else []
+                
+                for cid in matched_ids:
+                    channel_data = data["channels"][cid]
+                    removed_channels.append({
+                        "id": cid,
+                        "username": channel_data.get("username"),
+                        "owner": channel_data.get("owner"),
+                        "progress": f"{channel_data.get('current', 0)}/{channel_data.get('required', 0)}",
+                        "completed": channel_data.get("completed", False),
+                        "created_at": format_timestamp(channel_data.get("created_at"), "غير معروف")
+                    })
                 
                 if removed_channels:
                     # حذف القنوات
-                    for chan in removed_channels:
-                        del data["channels"][chan["id"]]
-                    
-                    save_data(data)
+                    with edit_snapshot("data") as editor:
+                        channels = editor.container("channels")
+                        for chan in removed_channels:
+                            channels.pop(chan["id"], None)
                     
                     # بناء رسالة النتائج
                     result_text = f"✅ تم حذف {len(removed_channels)} قناة:\n\n"
@@ -3512,10 +7599,10 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
             elif action == "remove_force":
                 channel_username = text.replace("@", "").strip()
                 
-                data = load_data()
-                if channel_username in data.get("force_sub_channels", []):
-                    data["force_sub_channels"].remove(channel_username)
-                    save_data(data)
+                editor = SnapshotEditor("data")
+                if channel_username in editor.root.get("force_sub_channels", []):
+                    editor.container("force_sub_channels").remove(channel_username)
+                    editor.commit()
                     await update.message.reply_text(
                         f"✅ تم حذف قناة الإجباري:\n\n"
                         f"🔓 @{channel_username}\n"
@@ -3530,11 +7617,10 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
             elif action == "remove_code":
                 code_name = text.upper().strip()
                 
-                data = load_data()
-                if code_name in data.get("codes", {}):
-                    code_data = data["codes"][code_name]
-                    del data["codes"][code_name]
-                    save_data(data)
+                editor = SnapshotEditor("data")
+                if code_name in editor.root.get("codes", {}):
+                    code_data = editor.container("codes").pop(code_name)
+                    editor.commit()
                     await update.message.reply_text(
                         f"✅ تم حذف الكود:\n\n"
                         f"🎟️ اسم الكود: {code_name}\n"
@@ -3559,80 +7645,85 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
 
 # ===================== معالجة الرسائل العامة =====================
 
-def mark_channel_as_left(user_id, channel_id, channel_data=None):
-    """تحديد القناة كمتروكة من قبل المستخدم - نسخة محسنة"""
-    try:
-        if channel_data is None:
-            data = load_data(force_reload=True)
-            channel_data = data.get("channels", {}).get(channel_id, {})
-        
-        user_data = get_user_data(user_id, force_reload=True)
+def build_channel_leave_updates(user_id, user_data, channel_id, channel_data):
+    """تحديثات سجل المستخدم لوضع علامة مغادرة قناة (تعدل joined_channels في مكانها)"""
+    joined_channels = user_data.get("joined_channels", {})
+    updates = {}
+    
+    if channel_id in joined_channels:
+        joined_channels[channel_id]["left"] = True
+        joined_channels[channel_id]["left_at"] = now_ts()
         
-        joined_channels = user_data.get("joined_channels", {})
-        updates = {}
+        # تحديد نوع المغادرة بناءً على حالة القناة
+        is_completed = channel_data.get("completed", False)
+        current_round = channel_data.get("reuse_count", 0)
         
-        if channel_id in joined_channels:
-            joined_channels[channel_id]["left"] = True
-            joined_channels[channel_id]["left_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
-            # تحديد نوع المغادرة بناءً على حالة القناة
-            is_completed = channel_data.get("completed", False)
-            current_round = channel_data.get("reuse_count", 0)
-            
-            if is_completed:
-                # قناة مكتملة - علامة خاصة
-                joined_channels[channel_id]["left_completed"] = True
-                joined_channels[channel_id]["completed_round"] = current_round
-                joined_channels[channel_id]["completed_at"] = channel_data.get("completed_at", "")
-                
-                logger.info(f"📦 المستخدم {user_id} غادر قناة مكتملة: {channel_id} (الجولة {current_round})")
-            else:
-                logger.info(f"📤 المستخدم {user_id} غادر قناة قيد التجميع: {channel_id}")
+        if is_completed:
+            # قناة مكتملة - علامة خاصة
+            joined_channels[channel_id]["left_completed"] = True
+            joined_channels[channel_id]["completed_round"] = current_round
+            joined_channels[channel_id]["completed_at"] = channel_data.get("completed_at", "")
             
-            # إضافة إلى temp_left_channels (للقنوات النشطة والمكتملة)
+            logger.info(f"📦 المستخدم {user_id} غادر قناة مكتملة: {channel_id} (الجولة {current_round})")
+        else:
+            logger.info(f"📤 المستخدم {user_id} غادر قناة قيد التجميع: {channel_id}")
+        
+        # إضافة إلى temp_left_channels (للقنوات النشطة والمكتملة)
+        temp_left = user_data.get("temp_left_channels", [])
+        if channel_id not in temp_left:
+            temp_left.append(channel_id)
+            updates["temp_left_channels"] = temp_left
+        
+        # حفظ joined_channels المحدثة
+        updates["joined_channels"] = joined_channels
+        
+    else:
+        # لا توجد بيانات انضمام سابقة
+        if not channel_data.get("completed", False):
+            # قناة قيد التجميع فقط (بدون انضمام سابق)
             temp_left = user_data.get("temp_left_channels", [])
             if channel_id not in temp_left:
                 temp_left.append(channel_id)
                 updates["temp_left_channels"] = temp_left
-            
-            # حفظ joined_channels المحدثة
-            updates["joined_channels"] = joined_channels
-            
-        else:
-            # لا توجد بيانات انضمام سابقة
-            if not channel_data.get("completed", False):
-                # قناة قيد التجميع فقط (بدون انضمام سابق)
-                temp_left = user_data.get("temp_left_channels", [])
-                if channel_id not in temp_left:
-                    temp_left.append(channel_id)
-                    updates["temp_left_channels"] = temp_left
-                    
-                logger.info(f"📝 تمت إضافة {channel_id} لـ temp_left_channels للمستخدم {user_id}")
-        
-        # إزالة من القنوات النشطة (إن وجدت)
-        active_subscriptions = user_data.get("active_subscriptions", [])
-        if channel_id in active_subscriptions:
-            active_subscriptions = [c for c in active_subscriptions if c != channel_id]
-            updates["active_subscriptions"] = active_subscriptions
-            logger.info(f"🗑️ تمت إزالة {channel_id} من active_subscriptions للمستخدم {user_id}")
-        
-        # إزالة من القنوات المتروكة القديمة (للتوافق)
-        old_left = user_data.get("left_channels", [])
-        if channel_id in old_left:
-            old_left = [c for c in old_left if c != channel_id]
-            updates["left_channels"] = old_left
-        
-        # إزالة من القنوات المتروكة نهائياً (إن وجدت)
-        permanent_left = user_data.get("permanent_left_channels", [])
-        if channel_id in permanent_left:
-            permanent_left = [c for c in permanent_left if c != channel_id]
-            updates["permanent_left_channels"] = permanent_left
-        
-        # إزالة من left_completed_channels (إن وجدت)
-        left_completed = user_data.get("left_completed_channels", [])
-        if channel_id in left_completed:
-            left_completed = [c for c in left_completed if c != channel_id]
-            updates["left_completed_channels"] = left_completed
+                
+            logger.info(f"📝 تمت إضافة {channel_id} لـ temp_left_channels للمستخدم {user_id}")
+    
+    # إزالة من القنوات النشطة (إن وجدت)
+    active_subscriptions = user_data.get("active_subscriptions", [])
+    if channel_id in active_subscriptions:
+        active_subscriptions = [c for c in active_subscriptions if c != channel_id]
+        updates["active_subscriptions"] = active_subscriptions
+        logger.info(f"🗑️ تمت إزالة {channel_id} من active_subscriptions للمستخدم {user_id}")
+    
+    # إزالة من القنوات المتروكة القديمة (للتوافق)
+    old_left = user_data.get("left_channels", [])
+    if channel_id in old_left:
+        old_left = [c for c in old_left if c != channel_id]
+        updates["left_channels"] = old_left
+    
+    # إزالة من القنوات المتروكة نهائياً (إن وجدت)
+    permanent_left = user_data.get("permanent_left_channels", [])
+    if channel_id in permanent_left:
+        permanent_left = [c for c in permanent_left if c != channel_id]
+        updates["permanent_left_channels"] = permanent_left
+    
+    # إزالة من left_completed_channels (إن وجدت)
+    left_completed = user_data.get("left_completed_channels", [])
+    if channel_id in left_completed:
+        left_completed = [c for c in left_completed if c != channel_id]
+        updates["left_completed_channels"] = left_completed
+    
+    return updates
+
+def mark_channel_as_left(user_id, channel_id, channel_data=None):
+    """تحديد القناة كمتروكة من قبل المستخدم - نسخة محسنة"""
+    try:
+        if channel_data is None:
+            data = get_data_view(force_reload=True)
+            channel_data = data.get("channels", {}).get(channel_id, {})
+        
+        user_data = get_user_data(user_id, force_reload=True)
+        updates = build_channel_leave_updates(user_id, user_data, channel_id, channel_data)
         
         # تنفيذ التحديثات
         if updates:
@@ -3652,6 +7743,48 @@ def mark_channel_as_left(user_id, channel_id, channel_data=None):
         traceback.print_exc()
         return False
 
+def apply_channel_leave(channel, user_id, penalty_amount):
+    """تطبيق مغادرة مستخدم على سجل قناة في مكانه - يعيد (العداد السابق، العداد الجديد)"""
+    current_count = channel.get("current", 0)
+    
+    # ✅ تقليل العداد (لا يقل عن 0)
+    new_count = max(0, current_count - 1)
+    
+    # تحديث بيانات القناة
+    channel["current"] = new_count
+    channel["last_activity"] = now_ts()
+    
+    normalize_channel_history(channel)
+    
+    # تسجيل المغادرة في السجل (محدود) والعداد الإجمالي
+    append_channel_history(channel, "leave_history", {
+        "user_id": user_id,
+        "left_at": now_ts(),
+        "previous_count": current_count,
+        "new_count": new_count,
+        "penalty_applied": penalty_amount,
+        "channel_username": channel.get("username", "unknown")
+    })
+    channel["total_leaves"] += 1
+    membership_cache.observe(channel.get("username", ""), user_id, False)
+    
+    # إزالة المستخدم من joined_users
+    if channel["joined_users"].pop(str(user_id), None) is not None:
+        logger.info(f"🗑️ تمت إزالة المستخدم {user_id} من joined_users")
+    
+    # إلغاء الاكتمال إذا أصبح العداد أقل من المطلوب
+    required = channel.get("required", 0)
+    if channel.get("completed", False) and new_count < required:
+        channel["completed"] = False
+        channel["uncompleted_at"] = now_ts()
+        channel["uncompleted_reason"] = f"user_left:{user_id}"
+        logger.warning(
+            f"⚠️ تم إلغاء اكتمال القناة {channel.get('username')} - "
+            f"العداد: {new_count}/{required} (مغادرة المستخدم {user_id})"
+        )
+    
+    return current_count, new_count
+
 async def decrease_channel_counter(bot, user_id, channel_id, channel_data=None, penalty_amount=5):
     """
     تقليل عداد القناة عند مغادرة المستخدم
@@ -3674,61 +7807,21 @@ async def decrease_channel_counter(bot, user_id, channel_id, channel_data=None,
         tuple: (success: bool, new_counter: int, message: str)
     """
     try:
-        data = load_data(force_reload=True)
+        data = get_data_view(force_reload=True)
         
         # التحقق من وجود القناة
         if channel_id not in data.get("channels", {}):
             return False, 0, "القناة غير موجودة"
         
-        channel = data["channels"][channel_id]
-        current_count = channel.get("current", 0)
-        
-        # ✅ تقليل العداد (لا يقل عن 0)
-        new_count = max(0, current_count - 1)
-        
-        # تحديث بيانات القناة
-        channel["current"] = new_count
-        channel["last_activity"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # تسجيل المغادرة في السجل
-        if "leave_history" not in channel:
-            channel["leave_history"] = []
-        
-        channel["leave_history"].append({
-            "user_id": user_id,
-            "left_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "previous_count": current_count,
-            "new_count": new_count,
-            "penalty_applied": penalty_amount,
-            "channel_username": channel.get("username", "unknown")
-        })
-        
-        # إزالة المستخدم من joined_users
-        if "joined_users" in channel:
-            original_length = len(channel["joined_users"])
-            channel["joined_users"] = [
-                u for u in channel["joined_users"] 
-                if str(u.get("user_id", "")) != str(user_id)
-            ]
-            removed = original_length - len(channel["joined_users"])
-            if removed > 0:
-                logger.info(f"🗑️ تمت إزالة {removed} سجل للمستخدم {user_id} من joined_users")
-        
-        # إلغاء الاكتمال إذا أصبح العداد أقل من المطلوب
-        required = channel.get("required", 0)
-        if channel.get("completed", False) and new_count < required:
-            channel["completed"] = False
-            channel["uncompleted_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            channel["uncompleted_reason"] = f"user_left:{user_id}"
-            logger.warning(
-                f"⚠️ تم إلغاء اكتمال القناة {channel.get('username')} - "
-                f"العداد: {new_count}/{required} (مغادرة المستخدم {user_id})"
-            )
+        channel = data["channels"][channel_id].copy()
+        current_count, new_count = apply_channel_leave(channel, user_id, penalty_amount)
         
         # حفظ التحديثات
-        data["channels"][channel_id] = channel
-        
-        if save_data(data, backup=False):
+        if save_channel_counter_change(
+            channel_id, channel,
+            push={"leave_history": channel["leave_history"][-1]},
+            pull_user=user_id
+        ):
             logger.info(
                 f"✅ تم تقليل عداد القناة {channel.get('username')}: "
                 f"{current_count} → {new_count} (المستخدم {user_id})"
@@ -3755,7 +7848,7 @@ def get_channel_counter_stats(channel_id):
         dict: إحصائيات مفصلة أو None إذا فشل
     """
     try:
-        data = load_data(force_reload=True)
+        data = get_data_view(force_reload=True)
         
         if channel_id not in data.get("channels", {}):
             return None
@@ -3767,13 +7860,13 @@ def get_channel_counter_stats(channel_id):
             "required": channel.get("required", 0),
             "percentage": (channel.get("current", 0) / max(channel.get("required", 1), 1)) * 100,
             "completed": channel.get("completed", False),
-            "total_joins": len(channel.get("joined_users", [])),
-            "total_leaves": len(channel.get("leave_history", [])),
-            "total_returns": len(channel.get("return_history", [])),
-            "net_change": len(channel.get("joined_users", [])) - len(channel.get("leave_history", [])),
+            "total_joins": channel.get("total_joins", len(channel.get("joined_users", ()))),
+            "total_leaves": channel.get("total_leaves", len(channel.get("leave_history", ()))),
+            "total_returns": channel.get("total_returns", len(channel.get("return_history", ()))),
             "channel_username": channel.get("username", "unknown"),
             "owner": channel.get("owner", "unknown")
         }
+        stats["net_change"] = stats["total_joins"] - stats["total_leaves"]
         
         return stats
         
@@ -3785,12 +7878,21 @@ def get_channel_counter_stats(channel_id):
 def cleanup_channel_data():
     """تنظيف بيانات القنوات من الحقول غير المتسقة"""
     try:
-        data = load_data(force_reload=True)
-        channels = data.get("channels", {})
+        editor = SnapshotEditor("data")
+        channels = editor.root.get("channels", {})
         cleaned_count = 0
         
-        for channel_id, channel_data in channels.items():
-            needs_update = False
+        for channel_id in list(channels):
+            channel_data = channels[channel_id]
+            needs_update = (
+                not channel_data.get("completed", False) and "completed_at" in channel_data
+            ) or (
+                channel_data.get("completed", False)
+                and channel_data.get("current", 0) < channel_data.get("required", 1)
+            )
+            if not needs_update:
+                continue
+            channel_data = editor.edit("channels", channel_id)
             
             # 1. إذا كانت completed=false ولكن فيها completed_at
             if not channel_data.get("completed", False) and "completed_at" in channel_data:
@@ -3810,11 +7912,10 @@ def cleanup_channel_data():
                     logger.info(f"🔧 صححت completed من true إلى false لـ {channel_data.get('username')} ({current}/{required})")
             
             if needs_update:
-                data["channels"][channel_id] = channel_data
                 cleaned_count += 1
         
         if cleaned_count > 0:
-            save_data(data, backup=False)
+            editor.commit()
             logger.info(f"✅ تم تنظيف {cleaned_count} قناة")
         
         return cleaned_count
@@ -3829,12 +7930,12 @@ def cleanup_channel_data():
 def should_channel_be_shown_to_user(user_id, channel_id):
     """التحقق مما إذا كان يجب عرض القناة للمستخدم مع مراعاة إعادة التفعيل"""
     user_data = get_user_data(user_id)
-    data = load_data()
+    data = get_data_view()
     
     if channel_id not in data.get("channels", {}):
         return False
     
-    channel_data = data["channels"][channel_id]
+    channel_data = ChannelRecord.from_json(data["channels"][channel_id])
     
     # التحقق من اكتمال القناة
     if channel_data.get("completed", False):
@@ -3892,8 +7993,8 @@ def should_channel_be_shown_to_user(user_id, channel_id):
         reactivated_at = channel_data.get("reactivated_at")
         if reactivated_at and "joined_at" in join_info:
             try:
-                join_time = datetime.strptime(join_info["joined_at"], "%Y-%m-%d %H:%M:%S")
-                reactivate_time = datetime.strptime(reactivated_at, "%Y-%m-%d %H:%M:%S")
+                join_time = to_timestamp(join_info["joined_at"])
+                reactivate_time = to_timestamp(reactivated_at)
                 
                 # إذا انضم قبل إعادة التفعيل
                 if join_time < reactivate_time:
@@ -3999,6 +8100,7 @@ async def handle_channel_purchase(update: Update, context: ContextTypes.DEFAULT_
                 user_id=context.bot.id
             )
 
+            bot_admin_registry.record(channel_username, bot_member.status in ("administrator", "creator"))
             if bot_member.status not in ("administrator", "creator"):
                 await update.message.reply_text(
                     f"❌ البوت ليس مشرفاً في القناة!\n\n"
@@ -4040,24 +8142,20 @@ async def handle_channel_purchase(update: Update, context: ContextTypes.DEFAULT_
             )
             return
 
-        data = load_data()
+        channels = get_data_view().get("channels", {})
         
-        # منع صاحب القناة النشطة من شراء أعضاء لها
-        active_user_channels = []
-        
-        for cid, chan_data in data.get("channels", {}).items():
-            if (chan_data.get("username") == channel_username and 
-                chan_data.get("owner") == user_id and 
-                not chan_data.get("completed", False)):  # قناة نشطة غير مكتملة
-                active_user_channels.append(cid)
+        # منع صاحب القناة النشطة من شراء أعضاء لها (قناة نشطة غير مكتملة)
+        active_user_channels = channel_username_index.find(
+            channels, channel_username, owner=user_id, completed=False
+        )
         
         if active_user_channels:
             # الحصول على معلومات القنوات النشطة
             active_channels_info = []
             for cid in active_user_channels:
-                chan_data = data["channels"][cid]
+                chan_data = channels[cid]
                 progress = f"{chan_data.get('current', 0)}/{chan_data.get('required', 0)}"
-                created_at = chan_data.get('created_at', 'غير معروف')
+                created_at = format_timestamp(chan_data.get('created_at'), 'غير معروف')
                 active_channels_info.append(f"• {progress} - {created_at}")
             
             await update.message.reply_text(
@@ -4072,20 +8170,14 @@ async def handle_channel_purchase(update: Update, context: ContextTypes.DEFAULT_
             )
             return
 
-        channels = data.get("channels", {})
-        
         # البحث عن قناة مكتملة من نفس المستخدم لنفس القناة
-        existing_completed_channel = None
-        for channel_id, channel_data in channels.items():
-            if (channel_data.get("username") == channel_username and 
-                channel_data.get("owner") == user_id and 
-                channel_data.get("completed", False)):
-                existing_completed_channel = (channel_id, channel_data)
-                break
+        completed_user_channels = channel_username_index.find(
+            channels, channel_username, owner=user_id, completed=True
+        )
         
-        if existing_completed_channel:
+        if completed_user_channels:
             # إعادة استخدام القناة المكتملة
-            channel_id, channel_data = existing_completed_channel
+            channel_id = completed_user_channels[0]
             
             # خصم النقاط
             success, message = safe_add_points(
@@ -4100,62 +8192,29 @@ async def handle_channel_purchase(update: Update, context: ContextTypes.DEFAULT_
                 await update.message.reply_text(f"❌ {message}")
                 return
             
-            # تنظيف بيانات جميع المستخدمين السابقين
-            users_data = load_users()
-            cleaned_users = 0
-            
-            for uid, user_info in users_data.items():
-                try:
-                    cleaned = False
-                    
-                    if "left_completed_channels" in user_info and channel_id in user_info["left_completed_channels"]:
-                        user_info["left_completed_channels"].remove(channel_id)
-                        cleaned = True
-                    
-                    if "permanent_left_channels" in user_info and channel_id in user_info["permanent_left_channels"]:
-                        user_info["permanent_left_channels"].remove(channel_id)
-                        cleaned = True
-                    
-                    if "temp_left_channels" in user_info and channel_id in user_info["temp_left_channels"]:
-                        user_info["temp_left_channels"].remove(channel_id)
-                        cleaned = True
-                    
-                    if "left_channels" in user_info and channel_id in user_info["left_channels"]:
-                        user_info["left_channels"].remove(channel_id)
-                        cleaned = True
-                    
-                    if "joined_channels" in user_info and channel_id in user_info["joined_channels"]:
-                        del user_info["joined_channels"][channel_id]
-                        cleaned = True
-                    
-                    if "active_subscriptions" in user_info and channel_id in user_info["active_subscriptions"]:
-                        user_info["active_subscriptions"] = [c for c in user_info["active_subscriptions"] if c != channel_id]
-                        cleaned = True
-                    
-                    if cleaned:
-                        cleaned_users += 1
-                        users_data[uid] = user_info
-                        
-                except Exception as e:
-                    logger.error(f"خطأ في تنظيف بيانات المستخدم {uid}: {e}")
+            # تنظيف بيانات المستخدمين السابقين (من الفهرس العكسي)
+            users_editor = SnapshotEditor("users")
+            cleaned_users = detach_channel_from_users(users_editor, channel_id)
             
             if cleaned_users > 0:
-                save_users(users_data, backup=False)
+                users_editor.commit()
                 logger.info(f"🧹 تم تنظيف بيانات {cleaned_users} مستخدم للقناة {channel_username}")
             
             # تحديث بيانات القناة
-            channel_data.update({
-                "required": buying["members"],
-                "current": 0,
-                "completed": False,
-                "reuse_count": channel_data.get("reuse_count", 0) + 1,
-                "joined_users": [],
-                "reactivated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "last_activity": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "previous_completion": channel_data.get("completed_at"),
-                "reactivated_by": user_id,
-                "admin_added": channel_data.get("admin_added", False)
-            })
+            with edit_snapshot("data") as editor:
+                channel_data = editor.edit("channels", channel_id)
+                channel_data.update({
+                    "required": buying["members"],
+                    "current": 0,
+                    "completed": False,
+                    "reuse_count": channel_data.get("reuse_count", 0) + 1,
+                    "joined_users": {},
+                    "reactivated_at": now_ts(),
+                    "last_activity": now_ts(),
+                    "previous_completion": channel_data.get("completed_at"),
+                    "reactivated_by": user_id,
+                    "admin_added": channel_data.get("admin_added", False)
+                })
             
             order_id = channel_id
             
@@ -4167,16 +8226,13 @@ async def handle_channel_purchase(update: Update, context: ContextTypes.DEFAULT_
                 "points": buying["points"],
                 "status": "إعادة تفعيل",
                 "current": 0,
-                "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "created_at": now_ts(),
                 "reuse_number": channel_data.get("reuse_count", 1),
                 "transaction_id": transaction_id,
                 "reactivated_from_completed": True
             })
             
-            update_user_data(user_id, {"orders": user_data["orders"]}, "channel_reuse_purchase", transaction_id)
-            
-            data["channels"][channel_id] = channel_data
-            save_data(data)
+            update_user_data(user_id, {"orders": user_data["orders"]}, "channel_reuse_order", transaction_id)
             
             update_system_stats("total_purchases", increment=1)
             
@@ -4218,28 +8274,27 @@ async def handle_channel_purchase(update: Update, context: ContextTypes.DEFAULT_
                 "points": buying["points"],
                 "status": "قيد التنفيذ",
                 "current": 0,
-                "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "created_at": now_ts(),
                 "transaction_id": transaction_id
             })
 
-            update_user_data(user_id, {"orders": user_data["orders"]}, "channel_purchase", transaction_id)
+            update_user_data(user_id, {"orders": user_data["orders"]}, "channel_purchase_order", transaction_id)
 
             # حفظ القناة
-            data["channels"][order_id] = {
-                "username": channel_username,
-                "owner": user_id,
-                "required": buying["members"],
-                "current": 0,
-                "completed": False,
-                "reuse_count": 0,
-                "joined_users": [],
-                "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "bot_is_admin": True,
-                "last_admin_check": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "transaction_id": transaction_id
-            }
-
-            save_data(data)
+            with edit_snapshot("data") as editor:
+                editor.container("channels")[order_id] = {
+                    "username": channel_username,
+                    "owner": user_id,
+                    "required": buying["members"],
+                    "current": 0,
+                    "completed": False,
+                    "reuse_count": 0,
+                    "joined_users": {},
+                    "created_at": now_ts(),
+                    "bot_is_admin": True,
+                    "last_admin_check": now_ts(),
+                    "transaction_id": transaction_id
+                }
             
             update_system_stats("total_purchases", increment=1)
 
@@ -4273,194 +8328,330 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ===================== المهام المجدولة =====================
 
+class NotificationQueue:
+    """طابور رسائل يُرسل في الخلفية بمعدل محدود - المرسل لا ينتظر تيليجرام"""
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self.queue = None
+        self.worker = None
+        self.sent = 0
+        self.failed = 0
+    
+    def put(self, bot, chat_id, text):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        self.queue.put_nowait((bot, int(chat_id), text, 0))
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.get_running_loop().create_task(self._run())
+    
+    def pending(self):
+        return self.queue.qsize() if self.queue is not None else 0
+    
+    async def _run(self):
+        while not self.queue.empty():
+            bot, chat_id, text, attempt = self.queue.get_nowait()
+            try:
+                await bot.send_message(chat_id, text, parse_mode="HTML")
+                self.sent += 1
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                logger.warning(f"⏳ تيليجرام طلب الانتظار {delay} ثانية قبل متابعة الإشعارات")
+                await asyncio.sleep(delay)
+                if attempt < 2:
+                    self.queue.put_nowait((bot, chat_id, text, attempt + 1))
+                else:
+                    self.failed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ خطأ في إرسال إشعار إلى {chat_id}: {e}")
+            await asyncio.sleep(self.interval)
+
+notification_queue = NotificationQueue(NOTIFICATION_SEND_INTERVAL)
+
+# آخر نتائج الفحص الدوري (للعرض في معلومات التخزين)
+_sweep_metrics = {}
+
+# أحداث العضوية المستلمة من chat_member منذ التشغيل
+_membership_events = {"joins": 0, "leaves": 0, "penalties": 0}
+
+# مغادرات chat_member بانتظار الدفعة التالية (تُعدل من حلقة الأحداث فقط)
+_pending_leaves = []
+_leave_batch_task = None
+
+# الفحص الدوري ودفعات الأحداث يُطبقان في خيوط - واحد في كل مرة
+_sweep_apply_lock = threading.Lock()
+
+def apply_subscription_sweep(leaves, missing_channels, penalty_amount=SUBSCRIPTION_LEAVE_PENALTY):
+    """
+    تطبيق نتائج الفحص دفعة واحدة: علامات المغادرة والخصم في حفظ مستخدمين واحد،
+    ثم عدادات القنوات في حفظ بيانات واحد - يعيد الرسائل المطلوب إرسالها
+    """
+    notifications = []
+    
+    with _sweep_apply_lock:
+        channels_view = get_data_view().get("channels", {})
+        
+        # 1. سجلات المستخدمين أولاً: إزالة القناة من active_subscriptions هي ما يمنع تكرار
+        # خصم العداد، فلا يُلمس العداد إلا بعد نجاح هذا الحفظ
+        saved = False
+        for attempt in range(SNAPSHOT_COMMIT_RETRIES):
+            penalties = []  # (المستخدم، القناة)
+            points_batch = PointsBatch()
+            left = []  # (المستخدم، القناة، النقاط بعد الخصم، اليوزر)
+            
+            users_editor = SnapshotEditor("users")
+            users_view = users_editor.view()
+            
+            # المغادرة تُطبق مرة واحدة فقط: قد يسبق حدث chat_member الفحص الدوري لنفس الاشتراك
+            pending = [
+                (user_id, channel_id) for user_id, channel_id in leaves
+                if channel_id in ((users_view.get(user_id) or {}).get("active_subscriptions") or ())
+            ]
+            if not pending and not missing_channels:
+                return 0, notifications
+            
+            for user_id, channel_id in pending:
+                channel = channels_view.get(channel_id)
+                if user_id not in users_view or channel is None:
+                    continue
+                user_data = users_editor.edit(user_id)
+                for key, value in build_channel_leave_updates(user_id, user_data, channel_id, channel).items():
+                    user_data[key] = value
+                
+                if not channel.get("completed", False):
+                    transaction_id = f"penalty_{user_id}_{channel_id}_{int(time.time() * 1000)}"
+                    if points_batch.apply(
+                        user_id, user_data, penalty_amount, "subtract",
+                        "subscription_check_penalty", transaction_id, channel_id=channel_id
+                    ) is not None:
+                        penalties.append((user_id, channel_id))
+                left.append((user_id, channel_id, user_data.get("points", 0), user_data.get("username")))
+            
+            for user_id, channel_ids in missing_channels.items():
+                if user_id not in users_view:
+                    continue
+                user_data = users_editor.edit(user_id)
+                user_data["active_subscriptions"] = [
+                    c for c in user_data.get("active_subscriptions", []) if c not in channel_ids
+                ]
+            
+            # تعديل متزامن لنفس المستخدمين = إعادة بناء الدفعة من اللقطة الجديدة
+            try:
+                saved = users_editor.commit()
+                break
+            except SnapshotConflict as e:
+                logger.warning(f"🔀 {e} - إعادة تطبيق نتائج الفحص ({attempt + 1})")
+        
+        if not saved:
+            logger.error(f"❌ فشل حفظ نتائج الفحص لـ {len(leaves)} مغادرة - لم تتغير عدادات القنوات")
+            return 0, []
+        
+        # 2. عدادات القنوات (المستخدمون حُفظوا - التعارض هنا يعيد عدادات القنوات فقط)
+        channels = channels_view
+        for attempt in range(SNAPSHOT_COMMIT_RETRIES):
+            data_editor = SnapshotEditor("data")
+            current_channels = data_editor.view().get("channels", {})
+            for user_id, channel_id in penalties:
+                if channel_id in current_channels:
+                    apply_channel_leave(data_editor.edit("channels", channel_id), user_id, penalty_amount)
+            
+            # الإحصائيات في نفس حفظ البيانات بدل حفظ منفصل لكل خصم
+            if points_batch.net:
+                stats = data_editor.container("stats")
+                stats["total_points"] = stats.get("total_points", 0) + points_batch.net
+            
+            updated_channels = data_editor.view().get("channels", {})
+            try:
+                if data_editor.root is not None:
+                    data_editor.commit()
+                channels = updated_channels
+                break
+            except SnapshotConflict as e:
+                logger.warning(f"🔀 {e} - إعادة تطبيق عدادات القنوات ({attempt + 1})")
+        else:
+            logger.error(f"❌ فشل تحديث عدادات {len(penalties)} قناة بعد حفظ المغادرات")
+        
+        # تسجيل معاملات الخصم (فهرس التكرار وسجل المعاملات والعدادات) - الإحصائيات حُفظت أعلاه
+        points_batch.record(update_stats=False)
+    
+    penalized = set(penalties)
+    
+    for user_id, channel_id, points, username in left:
+        channel = channels.get(channel_id, channels_view[channel_id])
+        if (user_id, channel_id) in penalized:
+            notifications.append((user_id, (
+                f"⚠️ تحذير: تم خصم نقاط!\n\n"
+                f"📢 القناة: @{channel.get('username', '')}\n"
+                f"💸 السبب: خرجت من القناة قيد التجميع\n"
+                f"💰 تم خصم: {penalty_amount} نقاط\n"
+                f"🎯 نقاطك الآن: {points}\n"
+                f"📉 العداد تغيّر: {channel.get('current', 0)}/{channel.get('required', 0)}\n\n"
+                f"🔄 يمكنك الانضمام مرة أخرى لزيادة العداد\n"
+                f"💰 ستحصل على 3 نقاط عند عودتك"
+            )))
+            owner = channel.get("owner")
+            if owner and owner != str(ADMIN_ID):
+                notifications.append((owner, (
+                    f"⚠️ مغادرة من قناتك!\n\n"
+                    f"📢 القناة: @{channel.get('username', '')}\n"
+                    f"👤 المستخدم: @{username or user_id}\n"
+                    f"📉 العداد الآن: {channel.get('current', 0)}/{channel.get('required', 0)}\n"
+                    f"📅 الوقت: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+                )))
+        else:
+            notifications.append((user_id, (
+                f"📢 القناة: @{channel.get('username', '')}\n"
+                f"✅ كانت مكتملة بالفعل\n"
+                f"👋 تمت إزالتها من قائمتك النشطة\n\n"
+                f"💡 عندما تعاد إضافة القناة، ستظهر لك مرة أخرى"
+            )))
+    
+    return len(penalties), notifications
+
+async def handle_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """انضمام/مغادرة مستخدم في قناة يشرف عليها البوت - تطبيق المغادرة فوراً بدل انتظار الفحص الدوري"""
+    change = update.chat_member
+    if change is None or not change.chat.username:
+        return
+    
+    was_member = change.old_chat_member.status in MEMBER_STATUSES
+    is_member = change.new_chat_member.status in MEMBER_STATUSES
+    if was_member == is_member:
+        return
+    
+    channel_username = change.chat.username
+    user_id = str(change.new_chat_member.user.id)
+    membership_cache.observe(channel_username, user_id, is_member)
+    
+    if is_member:
+        # مكافأة الانضمام تبقى عبر زر التحقق - الكاش يجعله فورياً
+        _membership_events["joins"] += 1
+        return
+    
+    _membership_events["leaves"] += 1
+    global _leave_batch_task
+    
+    channels = get_data_view().get("channels", {})
+    leaves = [(user_id, channel_id) for channel_id in channel_username_index.find(channels, channel_username)]
+    if not leaves:
+        return
+    
+    # لا حفظ لكل حدث على حلقة الأحداث: المغادرات تُجمع وتُطبق دفعة واحدة في خيط
+    _pending_leaves.extend(leaves)
+    if _leave_batch_task is None or _leave_batch_task.done():
+        _leave_batch_task = asyncio.create_task(flush_leave_events(context.bot))
+
+async def flush_leave_events(bot):
+    """تطبيق المغادرات المجمعة من chat_member بحفظ واحد خارج حلقة الأحداث"""
+    await asyncio.sleep(MEMBERSHIP_EVENT_BATCH_DELAY)
+    
+    leaves = list(dict.fromkeys(_pending_leaves))
+    _pending_leaves.clear()
+    try:
+        penalty_count, notifications = await asyncio.to_thread(apply_subscription_sweep, leaves, {})
+    except Exception as e:
+        logger.error(f"❌ خطأ في تطبيق {len(leaves)} مغادرة من أحداث chat_member: {e}")
+        return
+    
+    _membership_events["penalties"] += penalty_count
+    for chat_id, text in notifications:
+        notification_queue.put(bot, chat_id, text)
+    
+    if notifications:
+        logger.info(f"🚨 تم تطبيق {len(leaves)} مغادرة من أحداث chat_member ({penalty_count} خصم)")
+
 async def periodic_subscription_check(context: ContextTypes.DEFAULT_TYPE):
-    """فحص دوري للاشتراكات - نسخة محسنة مع نظام العداد الذكي"""
+    """
+    مطابقة دورية للاشتراكات (لأحداث chat_member الفائتة): فحوص متوازية محدودة
+    (SUBSCRIPTION_SWEEP_CONCURRENCY)، ثم حفظ مجمع واحد، ثم الإشعارات عبر طابور في الخلفية
+    """
     try:
         if not context or not context.bot:
             logger.error("❌ context أو bot غير متوفرين في periodic_subscription_check")
             return
         
         bot = context.bot
-        data = load_data(force_reload=True)
-        users_data = load_users(force_reload=True)
+        started = time.monotonic()
+        channels = get_data_view(force_reload=True).get("channels", {})
+        users_view = get_users_view(force_reload=True)
         
-        penalty_count = 0
-        counter_decreased = 0
-        checked_count = 0
+        pairs = []
+        missing_channels = defaultdict(set)
         skipped_count = 0
-
-        logger.info(f"🔍 بدء فحص دوري للاشتراكات: {len(users_data)} مستخدم")
-
-        for user_id, user_data in users_data.items():
-            active_channels = user_data.get("active_subscriptions", [])
-
-            if not active_channels:
-                continue
-
-            for channel_id in active_channels[:]:  # استخدام نسخة للكشف
-                channel = data.get("channels", {}).get(channel_id)
-                if not channel:
+        
+        for user_id, user_view in users_view.items():
+            for channel_id in user_view.get("active_subscriptions") or ():
+                channel = channels.get(channel_id)
+                if channel is None:
                     # قناة غير موجودة - إزالتها من النشطة
-                    active_subscriptions = user_data.get("active_subscriptions", [])
-                    user_data["active_subscriptions"] = [c for c in active_subscriptions if c != channel_id]
-                    update_user_data(user_id, {"active_subscriptions": user_data["active_subscriptions"]}, "remove_nonexistent_channel")
+                    missing_channels[user_id].add(channel_id)
                     skipped_count += 1
-                    logger.debug(f"🗑️ قناة غير موجودة: {channel_id} للمستخدم {user_id}")
                     continue
-
+                
                 channel_username = channel.get("username", "")
                 if not channel_username:
                     skipped_count += 1
-                    logger.debug(f"⏭️ قناة بدون يوزر: {channel_id}")
                     continue
-
+                pairs.append((user_id, channel_id, channel_username))
+        
+        logger.info(f"🔍 بدء فحص دوري للاشتراكات: {len(pairs)} اشتراك نشط")
+        
+        # 1. الفحوص متوازية مع حد أقصى للطلبات المتزامنة
+        semaphore = asyncio.Semaphore(SUBSCRIPTION_SWEEP_CONCURRENCY)
+        
+        async def check(user_id, channel_id, channel_username):
+            async with semaphore:
                 try:
-                    checked_count += 1
-                    
-                    logger.debug(f"🔍 فحص المستخدم {user_id} في القناة @{channel_username}")
-                    
-                    is_subscribed = await check_channel_subscription(bot, int(user_id), channel_username)
-                    
-                    if is_subscribed is None:
-                        # خطأ في التحقق - تخطي
-                        logger.warning(f"⚠️ خطأ في التحقق للمستخدم {user_id} في @{channel_username}")
-                        continue
-                    
-                    # 🔴 المستخدم غادر القناة
-                    if is_subscribed is False:
-                        logger.info(f"🚨 المستخدم {user_id} غادر القناة @{channel_username}")
-                        
-                        # التحقق من حالة القناة
-                        if channel.get("completed", False):
-                            # ⭐ قناة مكتملة - معاملة خاصة بدون خصم
-                            mark_channel_as_left(user_id, channel_id, channel)
-                            
-                            try:
-                                await bot.send_message(
-                                    int(user_id),
-                                    f"📢 القناة: @{channel_username}\n"
-                                    f"✅ كانت مكتملة بالفعل\n"
-                                    f"👋 تمت إزالتها من قائمتك النشطة\n\n"
-                                    f"💡 عندما تعاد إضافة القناة، ستظهر لك مرة أخرى",
-                                    parse_mode="HTML"
-                                )
-                            except Exception as msg_error:
-                                logger.error(f"❌ خطأ في إرسال رسالة القناة المكتملة: {msg_error}")
-                            
-                        else:
-                            # 🔴 قناة قيد التجميع - خصم نقاط وتقليل العداد
-                            transaction_id = f"penalty_{user_id}_{channel_id}_{int(time.time() * 1000)}"
-                            penalty_amount = 5
-                            
-                            # الحصول على النقاط الحالية
-                            current_user_data = get_user_data(user_id, force_reload=True)
-                            current_points = current_user_data.get("points", 0)
-                            
-                            logger.info(f"💸 محاولة خصم {penalty_amount} نقطة من {user_id} (النقاط الحالية: {current_points})")
-                            
-                            # ✅ 1. تقليل العداد أولاً
-                            counter_success, new_counter, counter_msg = await decrease_channel_counter(
-                                bot, user_id, channel_id, channel, penalty_amount
-                            )
-                            
-                            if counter_success:
-                                counter_decreased += 1
-                                logger.info(f"📉 تم تقليل عداد القناة {channel_username}: {counter_msg}")
-                            else:
-                                logger.error(f"❌ فشل تقليل العداد للقناة {channel_username}: {counter_msg}")
-                            
-                            # ✅ 2. خصم النقاط
-                            success, message = safe_add_points(
-                                user_id, 
-                                penalty_amount, 
-                                "subtract", 
-                                "subscription_check_penalty",
-                                transaction_id
-                            )
-                            
-                            if success:
-                                logger.info(f"✅ تم خصم {penalty_amount} نقطة من المستخدم {user_id}")
-                                penalty_count += 1
-                            else:
-                                logger.error(f"❌ فشل خصم النقاط من المستخدم {user_id}: {message}")
-                            
-                            # ✅ 3. وضع علامة المغادرة
-                            mark_success = mark_channel_as_left(user_id, channel_id, channel)
-                            
-                            if not mark_success:
-                                logger.error(f"❌ فشل وضع علامة المغادرة للمستخدم {user_id} من القناة {channel_id}")
-                            
-                            # الحصول على البيانات المحدثة
-                            updated_user_data = get_user_data(user_id, force_reload=True)
-                            final_points = updated_user_data.get("points", 0)
-                            
-                            logger.info(f"💰 نقاط المستخدم {user_id} بعد الخصم: {final_points}")
-                            
-                            # الحصول على العداد الجديد
-                            updated_channel_data = load_data(force_reload=True).get("channels", {}).get(channel_id, {})
-                            final_counter = updated_channel_data.get("current", 0)
-                            required_counter = updated_channel_data.get("required", 0)
-                            
-                            # ✅ 4. إرسال رسالة للمستخدم
-                            try:
-                                penalty_msg = (
-                                    f"⚠️ تحذير: تم خصم نقاط!\n\n"
-                                    f"📢 القناة: @{channel_username}\n"
-                                    f"💸 السبب: خرجت من القناة قيد التجميع\n"
-                                    f"💰 تم خصم: {penalty_amount} نقاط\n"
-                                    f"🎯 نقاطك الآن: {final_points}\n"
-                                    f"📉 العداد تغيّر: {final_counter}/{required_counter}\n\n"
-                                    f"🔄 يمكنك الانضمام مرة أخرى لزيادة العداد\n"
-                                    f"💰 ستحصل على 3 نقاط عند عودتك"
-                                )
-                                
-                                await bot.send_message(
-                                    int(user_id),
-                                    penalty_msg,
-                                    parse_mode="HTML"
-                                )
-                                logger.info(f"📤 تم إرسال رسالة خصم للمستخدم {user_id}")
-                                
-                            except Exception as send_error:
-                                logger.error(f"❌ خطأ في إرسال رسالة الخصم للمستخدم {user_id}: {send_error}")
-                            
-                            # ✅ 5. إشعار صاحب القناة
-                            channel_owner = channel.get("owner")
-                            if channel_owner and channel_owner != str(ADMIN_ID):
-                                try:
-                                    owner_user_data = get_user_data(user_id)
-                                    await bot.send_message(
-                                        int(channel_owner),
-                                        f"⚠️ مغادرة من قناتك!\n\n"
-                                        f"📢 القناة: @{channel_username}\n"
-                                        f"👤 المستخدم: @{owner_user_data.get('username', user_id)}\n"
-                                        f"📉 العداد الآن: {final_counter}/{required_counter}\n"
-                                        f"📅 الوقت: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-                                        parse_mode="HTML"
-                                    )
-                                    logger.info(f"📤 تم إرسال إشعار لمالك القناة {channel_owner}")
-                                except Exception as owner_notify_error:
-                                    logger.error(f"❌ خطأ في إشعار صاحب القناة: {owner_notify_error}")
-                                
+                    return await check_channel_subscription(bot, int(user_id), channel_username)
                 except Exception as check_error:
                     logger.error(f"❌ خطأ في فحص الاشتراك للمستخدم {user_id} في القناة {channel_id}: {check_error}")
-                    import traceback
-                    traceback.print_exc()
+                    return None
+        
+        results = await asyncio.gather(*(check(*pair) for pair in pairs))
+        checked_at = time.monotonic()
+        
+        leaves = [(user_id, channel_id) for (user_id, channel_id, _), result in zip(pairs, results) if result is False]
+        error_count = sum(1 for result in results if result is None)
+        for user_id, channel_id in leaves:
+            logger.info(f"🚨 المستخدم {user_id} غادر القناة {channel_id}")
+        
+        # 2. حفظ واحد لكل ملف لكل النتائج
+        penalty_count = 0
+        notifications = []
+        if leaves or missing_channels:
+            penalty_count, notifications = await asyncio.to_thread(
+                apply_subscription_sweep, leaves, missing_channels
+            )
+        
+        # 3. الإشعارات في الخلفية
+        for chat_id, text in notifications:
+            notification_queue.put(bot, chat_id, text)
+        
+        duration = time.monotonic() - started
+        _sweep_metrics.update({
+            "finished_at": now_ts(),
+            "duration": duration,
+            "check_duration": checked_at - started,
+            "checked": len(pairs),
+            "throughput": len(pairs) / max(checked_at - started, 1e-6),
+            "leaves": len(leaves),
+            "penalties": penalty_count,
+            "errors": error_count,
+            "skipped": skipped_count,
+        })
         
-        # تسجيل الإحصائيات
         logger.info(
-            f"📊 نتائج الفحص الدوري الذكي:\n"
-            f"  ✅ تم فحص: {checked_count} اشتراك\n"
-            f"  💸 تم خصم نقاط من: {penalty_count} مستخدم\n"
-            f"  📉 تم تقليل العداد لـ: {counter_decreased} قناة\n"
-            f"  ⏭️ تم تجاهل: {skipped_count} قناة"
+            f"📊 نتائج الفحص الدوري:\n"
+            f"  ✅ تم فحص: {len(pairs)} اشتراك في {duration:.2f} ثانية "
+            f"({_sweep_metrics['throughput']:.1f} فحص/ثانية)\n"
+            f"  🚪 مغادرات: {len(leaves)} | 💸 خصم: {penalty_count}\n"
+            f"  ⚠️ أخطاء: {error_count} | ⏭️ تم تجاهل: {skipped_count}\n"
+            f"  📤 إشعارات في الطابور: {notification_queue.pending()}"
         )
         
-        # تسجيل مفصل للمساعدة في التصحيح
-        logger.debug(f"📋 بيانات الإحصاءات النهائية:")
-        logger.debug(f"  - penalty_count: {penalty_count}")
-        logger.debug(f"  - counter_decreased: {counter_decreased}")
-        logger.debug(f"  - checked_count: {checked_count}")
+        if duration > SUBSCRIPTION_RECONCILE_INTERVAL:
+            logger.warning(f"🐢 الفحص الدوري استغرق {duration:.1f} ثانية (أطول من فترة الجدولة)")
         
     except Exception as e:
         logger.error(f"❌ خطأ كبير في فحص الاشتراكات الدوري: {e}")
@@ -4516,6 +8707,8 @@ async def storage_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # معلومات الملفات
         users_size = os.path.getsize(USERS_FILE) if os.path.exists(USERS_FILE) else 0
         data_size = os.path.getsize(DATA_FILE) if os.path.exists(DATA_FILE) else 0
+        sqlite_size = os.path.getsize(SQLITE_FILE) if os.path.exists(SQLITE_FILE) else 0
+        shards_size = get_sharded_store().total_size() if STORAGE_ENGINE == "sharded" else 0
         
         # عدد النسخ الاحتياطية
         backup_count = 0
@@ -4536,8 +8729,10 @@ async def storage_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return f"{bytes_size:.2f} GB"
         
         # تحميل البيانات للإحصائيات
-        users_data = load_users()
-        data_info = load_data()
+        users_data = get_users_view()
+        data_info = get_data_view()
+        membership = membership_cache.stats()
+        sweep = dict(_sweep_metrics)
         
         message = (
             f"📊 **معلومات التخزين المحلي**\n\n"
@@ -4548,12 +8743,28 @@ async def storage_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"📄 **الملفات الرئيسية:**\n"
             f"• `users.json`: {format_size(users_size)} ({len(users_data)} مستخدم)\n"
             f"• `data.json`: {format_size(data_size)}\n"
+            f"• `bot.db`: {format_size(sqlite_size)}\n"
+            f"• `users_shards`: {format_size(shards_size)} ({USERS_SHARD_COUNT} جزء)\n"
+            f"• محرك التخزين: `{STORAGE_ENGINE}`\n"
             f"• القنوات: {len(data_info.get('channels', {}))}\n\n"
             
             f"💾 **النسخ الاحتياطية:**\n"
             f"• العدد: {backup_count} نسخة\n"
             f"• الحجم الإجمالي: {format_size(backup_total_size)}\n\n"
             
+            f"👥 **كاش العضوية:**\n"
+            f"• الإدخالات: {membership['entries']}\n"
+            f"• نسبة الإصابة: {membership['hit_rate'] * 100:.1f}% ({membership['hits']}/{membership['hits'] + membership['misses']})\n"
+            f"• إيجابي/سلبي/خطأ: {membership['positive_hits']}/{membership['negative_hits']}/{membership['error_hits']}\n\n"
+            
+            f"🔍 **آخر فحص دوري:**\n"
+            f"• الاشتراكات: {sweep.get('checked', 0)} في {sweep.get('duration', 0):.2f} ثانية "
+            f"({sweep.get('throughput', 0):.1f} فحص/ثانية)\n"
+            f"• مغادرات/أخطاء: {sweep.get('leaves', 0)}/{sweep.get('errors', 0)}\n"
+            f"• إشعارات معلقة: {notification_queue.pending()}\n"
+            f"• أحداث chat_member (انضمام/مغادرة/خصم): {_membership_events['joins']}/"
+            f"{_membership_events['leaves']}/{_membership_events['penalties']}\n\n"
+            
             f"📅 **آخر تحديث:**\n"
             f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
         )
@@ -4576,15 +8787,16 @@ async def storage_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 def fix_left_completed_flags():
     """إصلاح علامات left_completed القديمة مع الجولات الجديدة"""
     try:
-        users_data = load_users()
-        data = load_data()
+        users_editor = SnapshotEditor("users")
+        data = get_data_view()
         fixed_count = 0
         
-        for user_id, user_data in users_data.items():
-            if "joined_channels" not in user_data:
+        for user_id, user_view in list(users_editor.view().items()):
+            if "joined_channels" not in user_view:
                 continue
-                
-            for channel_id, join_info in user_data["joined_channels"].items():
+            
+            user_data = None
+            for channel_id, join_info in user_view["joined_channels"].items():
                 if join_info.get("left_completed", False):
                     # الحصول على بيانات القناة الحالية
                     channel_data = data.get("channels", {}).get(channel_id)
@@ -4603,6 +8815,11 @@ def fix_left_completed_flags():
                     
                     # إذا كانت هناك جولة جديدة
                     if current_round_val > completed_round_val:
+                        # نسخة خاصة من هذا المستخدم فقط
+                        if user_data is None:
+                            user_data = users_editor.edit(user_id)
+                        join_info = user_data["joined_channels"][channel_id]
+                        
                         # إزالة العلامة القديمة
                         join_info["left_completed"] = False
                         if "completed_round" in join_info:
@@ -4619,7 +8836,7 @@ def fix_left_completed_flags():
                         fixed_count += 1
         
         if fixed_count > 0:
-            save_users(users_data)
+            users_editor.commit()
             logger.info(f"🔧 تم إصلاح {fixed_count} علامة left_completed قديمة")
             
         return fixed_count
@@ -4634,21 +8851,17 @@ async def periodic_cleanup(context: ContextTypes.DEFAULT_TYPE):
     """تنظيف دوري للبيانات"""
     try:
         # تنظيف المستخدمين غير النشطين (أكثر من 30 يوم)
-        users_data = load_users()
-        month_ago = datetime.now() - timedelta(days=30)
+        users_data = get_users_view()
+        month_ago = now_ts() - 30 * 86400
         inactive_count = 0
         
         for user_id, user_data in list(users_data.items()):
-            last_active_str = user_data.get("last_active")
-            if last_active_str:
-                try:
-                    last_active = datetime.strptime(last_active_str, "%Y-%m-%d %H:%M:%S")
-                    if last_active < month_ago:
-                        user_data["inactive"] = True
-                        update_user_data(user_id, {"inactive": True}, "inactive_mark")
-                        inactive_count += 1
-                except:
-                    pass
+            if user_data.get("inactive", False):
+                continue
+            last_active = to_timestamp(user_data.get("last_active"))
+            if last_active and last_active < month_ago:
+                update_user_data(user_id, {"inactive": True}, "inactive_mark")
+                inactive_count += 1
         
         if inactive_count > 0:
             logger.info(f"🧹 تم وضع علامة على {inactive_count} مستخدم كمقصر")
@@ -4672,13 +8885,34 @@ async def auto_completion_check(context: ContextTypes.DEFAULT_TYPE):
 
 def cleanup_old_transactions(context: ContextTypes.DEFAULT_TYPE = None):
     """تنظيف المعاملات القديمة"""
-    cooldown_manager.clear_old_transactions()
+    cooldown_manager.clear_stale_transactions()
+    
+    dedup_index = get_dedup_index()
+    expired = dedup_index.purge_expired()
+    dedup_index.save()
+    if expired:
+        logger.info(f"🧹 تم حذف {expired} معاملة منتهية من فهرس منع التكرار")
+    
+    ledger = get_ledger()
+    pruned = ledger.prune_tx_index(TRANSACTION_DEDUP_TTL)
+    ledger.save_index()
+    if pruned:
+        logger.info(f"🧹 تم حذف {pruned} معرّف معاملة قديم من فهرس سجل المعاملات")
+    
+    # حذف المعاملات الأقدم من مدة الاحتفاظ من السجل نفسه (يبقى السجل بحجم محدود)
+    removed = ledger.compact(LEDGER_RETENTION_DAYS * 86400)
+    if removed:
+        # مواقع السجل تغيرت: فهرس التكرار يُحفظ بالحجم الجديد حتى لا يُكمل من موقع خاطئ
+        with dedup_index.lock:
+            dedup_index.dirty = True
+        dedup_index.save()
+        logger.info(f"🧹 تم حذف {removed} معاملة أقدم من {LEDGER_RETENTION_DAYS} يوم من سجل المعاملات")
 
 def fix_channel_data_consistency(context: ContextTypes.DEFAULT_TYPE = None):
     """تصحيح تناسق بيانات القنوات"""
     try:
-        users_data = load_users()
-        data = load_data()
+        users_data = get_users_view()
+        data = get_data_view()
         channels = data.get("channels", {})
         
         for user_id, user_data in users_data.items():
@@ -4738,13 +8972,14 @@ def update_user_channel_join_info(user_id, channel_id, channel_username, current
     """تحديث معلومات انضمام المستخدم للقناة مع جميع التفاصيل"""
     
     user_data = get_user_data(user_id, force_reload=True)
+    membership_cache.observe(channel_username, user_id, True)
     
     # 1. تحديث joined_channels
     joined_channels = user_data.get("joined_channels", {})
     
     join_info = {
         "channel_username": channel_username,
-        "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "joined_at": now_ts(),
         "verified": True,
         "points_earned": points_earned,
         "left": False,
@@ -4752,9 +8987,9 @@ def update_user_channel_join_info(user_id, channel_id, channel_username, current
         "reactivated_at": reactivated_at,  # تاريخ إعادة تفعيل القناة (إذا وجد)
         "channel_reactivated": bool(reactivated_at),  # هل تمت إعادة التفعيل؟
         "join_round": current_round + 1,  # رقم الجولة عند الانضمام
-        "verified_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "verified_at": now_ts(),
         "transaction_id": transaction_id,
-        "last_verified": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "last_verified": now_ts(),
         "status": "active",
         "join_type": "new" if not reactivated_at else "reactivated"
     }
@@ -4772,7 +9007,7 @@ def update_user_channel_join_info(user_id, channel_id, channel_username, current
             "old_joined_at": old_info.get("joined_at"),
             "old_reactivated_at": old_info.get("reactivated_at"),
             "old_points_earned": old_info.get("points_earned", 0),
-            "archived_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            "archived_at": now_ts()
         })
     
     # 3. تحديث joined_channels
@@ -4805,7 +9040,7 @@ def update_user_channel_join_info(user_id, channel_id, channel_username, current
     user_data["join_history"].append({
         "channel_id": channel_id,
         "channel_username": channel_username,
-        "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "joined_at": now_ts(),
         "round": current_round,
         "reactivated_at": reactivated_at,
         "points_earned": points_earned,
@@ -4821,7 +9056,7 @@ def update_user_channel_join_info(user_id, channel_id, channel_username, current
         "permanent_left_channels": permanent_left_channels,
         "left_channels": left_channels,
         "join_history": user_data.get("join_history", []),
-        "last_active": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "last_active": now_ts(),
         "inactive": False
     }
     
@@ -4834,6 +9069,7 @@ def update_user_channel_join_info(user_id, channel_id, channel_username, current
     )
     
     if success:
+        daily_counters.bump("joins")
         logger.info(f"✅ تم تحديث معلومات انضمام {user_id} للقناة {channel_username} - الجولة {current_round}")
         return True, join_info
     else:
@@ -4842,6 +9078,7 @@ def update_user_channel_join_info(user_id, channel_id, channel_username, current
 
 def create_backup():
     """إنشاء نسخة احتياطية محسنة في المسار المحلي"""
+    flush_pending_writes()
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     backup_files = []
@@ -4902,9 +9139,17 @@ def auto_backup_manager():
 def create_local_backup():
     """إنشاء نسخة احتياطية محلية"""
     try:
+        flush_pending_writes()
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
-        for filename in [USERS_FILE, DATA_FILE]:
+        if STORAGE_ENGINE == "sqlite":
+            backup_name = os.path.join(BACKUP_DIR, f"{os.path.basename(SQLITE_FILE)}.{timestamp}.bak")
+            try:
+                get_sqlite_storage().backup_to(backup_name)
+            except Exception as e:
+                logger.error(f"❌ فشل نسخ {SQLITE_FILE}: {e}")
+        
+        for filename in [get_users_backup_source(), DATA_FILE]:
             if os.path.exists(filename):
                 backup_name = os.path.join(BACKUP_DIR, f"{os.path.basename(filename)}.{timestamp}.bak")
                 try:
@@ -4947,18 +9192,39 @@ def cleanup_old_backups():
     except Exception as e:
         logger.error(f"❌ خطأ في تنظيف النسخ القديمة: {e}")
 
+async def send_sqlite_backup(bot, caption):
+    """إرسال قاعدة SQLite للمالك (بعد دمج ملف WAL)"""
+    try:
+        get_sqlite_storage().checkpoint()
+        with open(SQLITE_FILE, 'rb') as f:
+            await bot.send_document(
+                chat_id=ADMIN_ID,
+                document=f,
+                filename=f"bot_{datetime.now().strftime('%H%M%S')}.db",
+                caption=caption
+            )
+    except Exception as e:
+        logger.error(f"❌ خطأ في إرسال قاعدة SQLite: {e}")
+
 async def send_backup_to_owner(context: ContextTypes.DEFAULT_TYPE):
     """إرسال النسخة الاحتياطية للمالك (تلقائي كل دقيقة)"""
     try:
         bot = context.bot
         
+        if STORAGE_ENGINE == "sqlite":
+            await send_sqlite_backup(bot, f"🗄️ bot.db | {datetime.now().strftime('%H:%M:%S')}")
+            return
+        
+        flush_pending_writes()
+        users_source = get_users_backup_source()
+        
         # التحقق من وجود الملفات
-        if not os.path.exists(USERS_FILE) or not os.path.exists(DATA_FILE):
+        if not os.path.exists(users_source) or not os.path.exists(DATA_FILE):
             return
         
         # إرسال users.json
         try:
-            with open(USERS_FILE, 'rb') as f:
+            with open(users_source, 'rb') as f:
                 await bot.send_document(
                     chat_id=ADMIN_ID,
                     document=f,
@@ -5001,9 +9267,13 @@ async def get_backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # إرسال الملفات
     bot = context.bot
     try:
+        if STORAGE_ENGINE == "sqlite":
+            await send_sqlite_backup(bot, "🗄️ bot.db (يدوياً)")
+        
         # إرسال users.json
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, 'rb') as f:
+        users_source = get_users_backup_source()
+        if os.path.exists(users_source):
+            with open(users_source, 'rb') as f:
                 await bot.send_document(
                     chat_id=ADMIN_ID,
                     document=f,
@@ -5039,15 +9309,23 @@ async def send_backup_files_to_owner(bot):
     
     _last_backup_time = current_time
     
+    if STORAGE_ENGINE == "sqlite":
+        await send_sqlite_backup(bot, f"🗄️ bot.db\n⏰ {datetime.now().strftime('%H:%M:%S')}")
+        return
+    
+    flush_pending_writes()
+    
     try:
+        users_source = get_users_backup_source()
+        
         # التحقق من وجود الملفات
-        if not os.path.exists(USERS_FILE) or not os.path.exists(DATA_FILE):
+        if not os.path.exists(users_source) or not os.path.exists(DATA_FILE):
             logger.warning("❌ ملفات البيانات غير موجودة للإرسال")
             return
         
         # إرسال ملف المستخدمين
         try:
-            with open(USERS_FILE, 'rb') as users_file:
+            with open(users_source, 'rb') as users_file:
                 await bot.send_document(
                     chat_id=ADMIN_ID,
                     document=users_file,
@@ -5120,8 +9398,37 @@ def main():
         
         # 🔧 التحقق من وجود ملفات البيانات وإنشاؤها إذا لزم
         logger.info("🔍 فحص ملفات البيانات...")
+        cleanup_stale_tmp_files()
+        
+        if STORAGE_ENGINE == "sqlite":
+            # 🗄️ محرك SQLite: استيراد ملفات JSON تلقائياً عند أول تشغيل
+            try:
+                storage = get_sqlite_storage()
+                if storage.is_empty():
+                    if os.path.exists(USERS_FILE) or os.path.exists(DATA_FILE):
+                        logger.info("📥 قاعدة SQLite فارغة - جاري استيراد ملفات JSON...")
+                        import_json_to_sqlite()
+                    else:
+                        storage.save_data(create_initial_data())
+                        logger.info(f"✅ تم إنشاء قاعدة البيانات: {SQLITE_FILE}")
+            except Exception as e:
+                logger.error(f"❌ فشل تجهيز قاعدة SQLite {SQLITE_FILE}: {e}")
+                return
+        
+        elif STORAGE_ENGINE == "sharded" and get_sharded_store().is_empty():
+            # 🧩 تقسيم users.json تلقائياً عند أول تشغيل بالأجزاء
+            try:
+                if os.path.exists(USERS_FILE):
+                    logger.info("📥 لا توجد أجزاء بعد - جاري تقسيم users.json...")
+                    migrate_users_to_shards()
+                else:
+                    get_sharded_store().save_all_users({})
+                    logger.info(f"✅ تم إنشاء أجزاء المستخدمين: {USERS_SHARD_DIR}")
+            except Exception as e:
+                logger.error(f"❌ فشل تجهيز أجزاء المستخدمين {USERS_SHARD_DIR}: {e}")
+                return
         
-        if not os.path.exists(DATA_FILE):
+        if STORAGE_ENGINE != "sqlite" and not os.path.exists(DATA_FILE):
             logger.info(f"📝 إنشاء ملف بيانات جديد: {DATA_FILE}")
             try:
                 save_data(create_initial_data())
@@ -5130,7 +9437,7 @@ def main():
                 logger.error(f"❌ فشل إنشاء {DATA_FILE}: {e}")
                 return
         
-        if not os.path.exists(USERS_FILE):
+        if STORAGE_ENGINE == "json" and not os.path.exists(USERS_FILE):
             logger.info(f"📝 إنشاء ملف مستخدمين جديد: {USERS_FILE}")
             try:
                 save_users({})
@@ -5139,12 +9446,40 @@ def main():
                 logger.error(f"❌ فشل إنشاء {USERS_FILE}: {e}")
                 return
         
+        # 📜 إعادة تطبيق سجل WAL المتبقي من التشغيل السابق
+        if is_wal_active():
+            try:
+                recover_from_wal()
+            except Exception as e:
+                logger.error(f"❌ فشل استرجاع سجل WAL {WAL_FILE}: {e}")
+                return
+        
+        # 📒 نقل سجلات المعاملات القديمة من users.json إلى سجل المعاملات
+        try:
+            migrate_transactions_to_ledger()
+        except Exception as e:
+            logger.error(f"❌ فشل نقل المعاملات إلى {LEDGER_FILE}: {e}")
+        
+        # 🧬 ترقية مخطط السجلات مرة واحدة (القراءات بعدها بدون ترقيع)
+        try:
+            migrate_schema()
+        except Exception as e:
+            logger.error(f"❌ فشل ترحيل مخطط البيانات إلى الإصدار {SCHEMA_VERSION}: {e}")
+            return
+        
         # 🔧 تحميل البيانات المحلية للتحقق
         try:
-            data = load_data()
-            users_data = load_users()
+            data = get_data_view()
+            users_data = get_users_view()
             logger.info(f"📊 تم تحميل {len(users_data)} مستخدم و {len(data.get('channels', {}))} قناة")
             
+            raw_users = _get_snapshot("users", force_reload=False)
+            indexed = username_index.rebuild(raw_users)
+            logger.info(f"🔎 تم فهرسة {indexed} يوزر")
+            
+            ranked = user_columns.rebuild(raw_users)
+            logger.info(f"🏆 تم بناء أعمدة التحليلات والتوب لـ {ranked} مستخدم")
+            
             # عرض معلومات الملفات المحلية
             users_size = os.path.getsize(USERS_FILE) if os.path.exists(USERS_FILE) else 0
             data_size = os.path.getsize(DATA_FILE) if os.path.exists(DATA_FILE) else 0
@@ -5195,6 +9530,12 @@ def main():
         # أزرار الكيبورد
         application.add_handler(CallbackQueryHandler(button_handler, pattern=".*"))
         
+        # تغير صلاحيات البوت في القنوات (سجل الإشراف)
+        application.add_handler(ChatMemberHandler(handle_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+        
+        # انضمام/مغادرة المستخدمين في القنوات (كشف المغادرة الفوري)
+        application.add_handler(ChatMemberHandler(handle_chat_member, ChatMemberHandler.CHAT_MEMBER))
+        
         # رسائل الأدمن
         try:
             if ADMIN_ID and str(ADMIN_ID).isdigit():
@@ -5238,7 +9579,7 @@ def main():
         
         # المهام الأساسية المضمونة العمل
         scheduled_tasks = [
-            ("فحص الاشتراكات", periodic_subscription_check, 30, 30),
+            ("فحص الاشتراكات", periodic_subscription_check, SUBSCRIPTION_RECONCILE_INTERVAL, 60),
             ("تنظيف الكتم المنتهي", cleanup_expired_mutes, 3600, 60),
             ("فحص اكتمال القنوات", auto_completion_check, 120, 60),
             ("تنظيف المعاملات القديمة", cleanup_old_transactions, 3600, 120),
@@ -5264,8 +9605,16 @@ def main():
             optional_tasks = [
                 ("تنظيف البيانات", periodic_cleanup, 86400, 600),
                 ("تصحيح بيانات القنوات", fix_channel_data_consistency, 1800, 300),
+                ("حفظ العدادات اليومية", save_daily_stats, DAILY_STATS_SAVE_INTERVAL, DAILY_STATS_SAVE_INTERVAL),
+                ("تحديث إشراف البوت", refresh_bot_admin_status, BOT_ADMIN_REFRESH_INTERVAL, 90),
+                ("حفظ كاش القنوات", save_chat_metadata, CHAT_METADATA_SAVE_INTERVAL, CHAT_METADATA_SAVE_INTERVAL),
             ]
             
+            if is_wal_active():
+                optional_tasks.append(
+                    ("ضغط سجل WAL", periodic_wal_compaction, WAL_COMPACT_INTERVAL, WAL_COMPACT_INTERVAL)
+                )
+            
             for task_name, task_func, interval, first_delay in optional_tasks:
                 try:
                     application.job_queue.run_repeating(
@@ -5288,6 +9637,8 @@ def main():
         logger.info(f"   • users.json: {USERS_FILE}")
         logger.info(f"   • data.json: {DATA_FILE}")
         logger.info(f"   • backups: {BACKUP_DIR}")
+        logger.info(f"🗄️ محرك التخزين: {STORAGE_ENGINE}")
+        logger.info(f"🛡️ متانة الكتابة: {DURABILITY_LEVEL}")
         
         # عرض الملفات المحلية الموجودة
         local_files = [f for f in os.listdir(current_dir) if f.endswith(('.json', '.py', '.log'))]
@@ -5323,6 +9674,8 @@ def main():
         except Exception as polling_error:
             logger.error(f"❌ خطأ في polling: {polling_error}")
             raise
+        finally:
+            save_on_shutdown()
         
     except Exception as e:
         logger.error(f"❌ خطأ غير متوقع في main: {e}")
@@ -5384,11 +9737,35 @@ if __name__ == "__main__":
     def signal_handler(signum, frame):
         print("\n\n⚠️ تم الضغط على Ctrl+C، جاري الإغلاق...")
         logger.info("⚠️ تم استقبال إشارة الإغلاق (Ctrl+C)")
+        if flush_pending_writes():
+            logger.info("💾 تم حفظ التغييرات المؤجلة قبل الإغلاق")
         raise KeyboardInterrupt
     
     # تسجيل معالج الإشارة
     signal.signal(signal.SIGINT, signal_handler)
     
+    # 📥 استيراد لمرة واحدة: python main.py --import-sqlite
+    if "--import-sqlite" in sys.argv:
+        users_count, channels_count = import_json_to_sqlite()
+        print(f"✅ تم استيراد {users_count} مستخدم و {channels_count} قناة إلى {SQLITE_FILE}")
+        print('💡 غيّر STORAGE_ENGINE إلى "sqlite" لاستخدام القاعدة')
+        sys.exit(0)
+    
+    # 🧩 تقسيم لمرة واحدة: python main.py --migrate-shards
+    if "--migrate-shards" in sys.argv:
+        users_count = migrate_users_to_shards()
+        print(f"✅ تم تقسيم {users_count} مستخدم على {USERS_SHARD_COUNT} جزء في {USERS_SHARD_DIR}")
+        print('💡 غيّر STORAGE_ENGINE إلى "sharded" لاستخدام الأجزاء')
+        sys.exit(0)
+    
+    # 📅 إعادة بناء العدادات اليومية من first_join / last_active: python main.py --rebuild-daily-stats
+    if "--rebuild-daily-stats" in sys.argv:
+        users_snapshot = _get_snapshot("users", force_reload=True)
+        days_count = daily_counters.rebuild(users_snapshot)
+        active_sketches.rebuild(users_snapshot)
+        print(f"✅ تمت إعادة بناء العدادات اليومية لـ {days_count} يوم في {DAILY_STATS_FILE}")
+        sys.exit(0)
+    
     # تشغيل البوت مع معالجة الأخطاء
     max_retries = 3
     retry_count = 0
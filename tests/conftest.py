@@ -0,0 +1,23 @@
+import importlib.util
+import json
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def bot_module(tmp_path):
+    """نسخة معزولة من main.py - كل ملفات البيانات داخل tmp_path"""
+    shutil.copy(ROOT / "main.py", tmp_path / "main.py")
+    (tmp_path / "users.json").write_text(json.dumps({}), encoding="utf-8")
+
+    spec = importlib.util.spec_from_file_location(f"bot_main_{tmp_path.name}", tmp_path / "main.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    yield module
+    sys.modules.pop(spec.name, None)
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def days_ago(n):
+    return (datetime.now() - timedelta(days=n)).strftime("%Y-%m-%d")
+
+
+@pytest.mark.parametrize("count", [100, 5000, 50000])
+def test_hyperloglog_error_within_bounds(bot_module, count):
+    main = bot_module
+    sketch = main.HyperLogLog(main.ACTIVE_SKETCH_PRECISION)
+    for user_id in range(count):
+        sketch.add(user_id)
+
+    # الخطأ المعياري 1.04/√m (~1.6% عند p=12) - الحد 3 أضعافه
+    bound = 3 * 1.04 / (1 << main.ACTIVE_SKETCH_PRECISION) ** 0.5
+    assert abs(sketch.count() - count) <= bound * count
+
+
+def test_hyperloglog_merge_counts_union(bot_module):
+    main = bot_module
+    first, second = main.HyperLogLog(10), main.HyperLogLog(10)
+    for user_id in range(0, 3000):
+        first.add(user_id)
+    for user_id in range(2000, 5000):
+        second.add(user_id)
+
+    before = bytes(first.registers)
+    merged = main.HyperLogLog(10, before).merge(second)
+    assert bytes(first.registers) == before
+    assert abs(merged.count() - 5000) <= 0.1 * 5000
+
+
+def test_sketches_merge_days_and_survive_reload(bot_module):
+    main = bot_module
+    sketches = main.active_sketches
+    for user_id in range(50):
+        sketches.add(user_id)
+    for user_id in range(25, 100):
+        sketches.add(user_id, day=days_ago(3))
+    sketches.add("old", day=days_ago(main.ACTIVE_SKETCH_RETENTION_DAYS + 1))
+
+    week = sketches.count(0, 6)
+    assert abs(sketches.count() - 50) <= 2
+    assert abs(week - 100) <= 3
+    sketches.save()
+
+    reloaded = main.ActiveUserSketches(
+        main.ACTIVE_SKETCHES_FILE, main.ACTIVE_SKETCH_PRECISION, main.ACTIVE_SKETCH_RETENTION_DAYS
+    )
+    assert set(reloaded.days) == {days_ago(0), days_ago(3)}
+    assert reloaded.count(0, 6) == week
+
+    # دقة مختلفة: المخططات القديمة لا تُحمّل
+    other = main.ActiveUserSketches(main.ACTIVE_SKETCHES_FILE, 10, main.ACTIVE_SKETCH_RETENTION_DAYS)
+    assert other.days == {}
@@ -0,0 +1,58 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+
+def my_chat_member(username, status):
+    return SimpleNamespace(my_chat_member=SimpleNamespace(
+        chat=SimpleNamespace(username=username),
+        new_chat_member=SimpleNamespace(status=status),
+    ))
+
+
+def test_my_chat_member_updates_registry_and_channels(bot_module):
+    main = bot_module
+    with main.edit_snapshot("data") as editor:
+        editor.container("channels")["c1"] = {"username": "@chan", "owner": "1", "completed": False}
+        editor.container("channels")["c2"] = {"username": "other", "owner": "1", "completed": False}
+
+    asyncio.run(main.handle_my_chat_member(my_chat_member("Chan", "administrator"), None))
+    channels = main.get_data_view()["channels"]
+    assert channels["c1"]["bot_is_admin"] is True
+    assert "bot_is_admin" not in channels["c2"]
+    assert main.bot_admin_registry.get("@CHAN")[0] is True
+
+    # إزالة البوت: السجل يتبع فوراً بدون فحص مباشر
+    asyncio.run(main.handle_my_chat_member(my_chat_member("chan", "left"), None))
+    assert main.get_data_view()["channels"]["c1"]["bot_is_admin"] is False
+    assert not main.bot_admin_registry.pending
+
+    class NoCallsBot:
+        async def get_chat_member(self, *args, **kwargs):
+            raise AssertionError("الحالة معروفة - لا حاجة لفحص مباشر")
+
+    assert asyncio.run(main.bot_admin_registry.is_admin(NoCallsBot(), "chan")) is False
+
+    # بعد إعادة التشغيل تُقرأ الحالة من سجلات القنوات
+    restarted = main.BotAdminRegistry()
+    assert restarted.get("chan") == main.bot_admin_registry.get("chan")
+
+
+def test_updates_without_username_are_ignored(bot_module):
+    main = bot_module
+    asyncio.run(main.handle_my_chat_member(my_chat_member(None, "administrator"), None))
+    assert main.bot_admin_registry.entries == {}
+
+
+def test_pending_states_survive_shutdown(bot_module):
+    main = bot_module
+    with main.edit_snapshot("data") as editor:
+        editor.container("channels")["c1"] = {"username": "chan", "owner": "1", "completed": False}
+
+    main.bot_admin_registry.record("chan", False)
+    assert main.bot_admin_registry.pending
+
+    main.save_on_shutdown()
+    with open(main.DATA_FILE, encoding="utf-8") as f:
+        assert json.load(f)["channels"]["c1"]["bot_is_admin"] is False
+    assert main.BotAdminRegistry().get("chan")[0] is False
@@ -0,0 +1,52 @@
+import os
+
+
+def count_loads(main, monkeypatch):
+    calls = []
+    original = main._load_users_from_file
+
+    def loader():
+        calls.append(1)
+        return original()
+
+    monkeypatch.setattr(main, "_load_users_from_file", loader)
+    return calls
+
+
+def test_unchanged_file_is_not_reread(bot_module, monkeypatch):
+    main = bot_module
+    first = main._get_snapshot("users", force_reload=False)
+    calls = count_loads(main, monkeypatch)
+
+    assert main._get_snapshot("users", force_reload=False) is first
+    assert calls == []
+
+
+def test_internal_writes_do_not_force_a_reload(bot_module, monkeypatch):
+    main = bot_module
+    main.update_user_data("1", {"points": 3})
+    calls = count_loads(main, monkeypatch)
+
+    assert main.get_user_data("1")["points"] == 3
+    assert calls == []
+
+
+def test_replaced_file_with_same_size_and_mtime_is_reloaded(bot_module, monkeypatch):
+    main = bot_module
+    main.update_user_data("1", {"points": 3})
+    main._get_snapshot("users", force_reload=False)
+    stat = os.stat(main.USERS_FILE)
+
+    # استبدال ذري من أداة خارجية: نفس الحجم والوقت، لكن inode جديد
+    with open(main.USERS_FILE, encoding="utf-8") as f:
+        text = f.read()
+    replacement = main.USERS_FILE + ".new"
+    with open(replacement, "w", encoding="utf-8") as f:
+        f.write(text.replace('"points": 3', '"points": 7'))
+    os.utime(replacement, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(replacement, main.USERS_FILE)
+    assert os.stat(main.USERS_FILE).st_size == stat.st_size
+
+    calls = count_loads(main, monkeypatch)
+    assert main._get_snapshot("users", force_reload=False)["1"]["points"] == 7
+    assert calls == [1]
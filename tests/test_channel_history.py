@@ -0,0 +1,42 @@
+def test_leave_history_is_capped_while_totals_keep_counting(bot_module, monkeypatch):
+    main = bot_module
+    monkeypatch.setattr(main, "CHANNEL_HISTORY_LIMIT", 5)
+    joined = {str(user_id): {} for user_id in range(8)}
+    with main.edit_snapshot("data") as editor:
+        editor.container("channels")["c1"] = {
+            "username": "chan", "owner": "1", "current": 8, "required": 10, "joined_users": joined
+        }
+
+    with main.edit_snapshot("data") as editor:
+        channel = editor.edit("channels", "c1")
+        for user_id in range(8):
+            main.apply_channel_leave(channel, str(user_id), 0)
+
+    channel = main.get_data_view()["channels"]["c1"]
+    # آخر 5 سجلات فقط (الأقدم يُحذف)، والإجمالي يعد كل المغادرات
+    assert [entry["user_id"] for entry in channel["leave_history"]] == ["3", "4", "5", "6", "7"]
+    assert channel["total_leaves"] == 8
+    assert channel["current"] == 0 and len(channel["joined_users"]) == 0
+
+    stats = main.get_channel_counter_stats("c1")
+    assert (stats["total_joins"], stats["total_leaves"], stats["net_change"]) == (8, 8, 0)
+
+
+def test_legacy_history_is_trimmed_and_totals_seeded(bot_module, monkeypatch):
+    main = bot_module
+    monkeypatch.setattr(main, "CHANNEL_HISTORY_LIMIT", 3)
+    channel = {
+        "joined_users": [{"user_id": 1, "joined_at": 10}, {"user_id": 2}],
+        "leave_history": [{"user_id": str(n)} for n in range(7)],
+    }
+
+    main.normalize_channel_history(channel)
+    assert channel["joined_users"] == {"1": {"joined_at": 10}, "2": {}}
+    assert (channel["total_joins"], channel["total_leaves"], channel["total_returns"]) == (2, 7, 0)
+    assert [entry["user_id"] for entry in channel["leave_history"]] == ["4", "5", "6"]
+
+    # التحويل مرة ثانية لا يغير الإجماليات
+    main.append_channel_history(channel, "leave_history", {"user_id": "7"})
+    main.normalize_channel_history(channel)
+    assert channel["total_leaves"] == 7
+    assert len(channel["leave_history"]) == 3
@@ -0,0 +1,82 @@
+import asyncio
+from types import SimpleNamespace
+
+
+class FakeBot:
+    def __init__(self, title="Chan"):
+        self.title = title
+        self.calls = []
+
+    async def get_chat(self, chat_id):
+        self.calls.append(chat_id)
+        if self.title is None:
+            raise RuntimeError("timed out")
+        return SimpleNamespace(id=-100, title=self.title, type="channel")
+
+
+def test_first_use_fetches_then_reads_from_cache(bot_module):
+    main = bot_module
+    cache = main.ChatMetadataCache(main.CHAT_METADATA_FILE, 3600)
+    bot = FakeBot()
+
+    async def scenario():
+        first = await cache.resolve(bot, "@Chan")
+        second = await cache.resolve(bot, "chan")
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert bot.calls == ["@chan"]
+    assert first is second and first["title"] == "Chan"
+
+
+def test_stale_entry_refreshes_in_background(bot_module):
+    main = bot_module
+    cache = main.ChatMetadataCache(main.CHAT_METADATA_FILE, 3600)
+    cache.entries["chan"] = {"id": -100, "title": "Old", "type": "channel", "resolved_at": main.now_ts() - 7200}
+    bot = FakeBot("New")
+
+    async def scenario():
+        # التحديث لا يُنتظر: القيمة القديمة تُعاد فوراً
+        entry = await cache.resolve(bot, "chan")
+        assert entry["title"] == "Old"
+        await asyncio.gather(*cache.tasks)
+
+    asyncio.run(scenario())
+    assert cache.entries["chan"]["title"] == "New"
+    assert not cache.refreshing and not cache.tasks
+
+
+def test_failed_refresh_keeps_old_entry(bot_module):
+    main = bot_module
+    cache = main.ChatMetadataCache(main.CHAT_METADATA_FILE, 3600)
+    cache.entries["chan"] = {"id": -100, "title": "Old", "type": "channel", "resolved_at": 0}
+
+    async def scenario():
+        await cache.resolve(FakeBot(None), "chan")
+        await asyncio.gather(*cache.tasks)
+
+    asyncio.run(scenario())
+    assert cache.entries["chan"]["title"] == "Old"
+    assert "chan" not in cache.refreshing
+
+
+def test_entries_persist_across_restarts(bot_module):
+    main = bot_module
+    cache = main.ChatMetadataCache(main.CHAT_METADATA_FILE, 3600)
+    asyncio.run(cache.resolve(FakeBot(), "chan"))
+    cache.save()
+
+    reloaded = main.ChatMetadataCache(main.CHAT_METADATA_FILE, 3600)
+    assert reloaded.entries == cache.entries
+
+    reloaded.invalidate("@CHAN")
+    reloaded.save()
+    assert main.ChatMetadataCache(main.CHAT_METADATA_FILE, 3600).entries == {}
+
+
+def test_shutdown_saves_resolved_chats(bot_module):
+    main = bot_module
+    asyncio.run(main.chat_metadata.resolve(FakeBot(), "chan"))
+
+    main.save_on_shutdown()
+    assert "chan" in main.ChatMetadataCache(main.CHAT_METADATA_FILE, 3600).entries
@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+DAY = 24 * 3600
+
+
+def days_ago(n):
+    return (datetime.now() - timedelta(days=n)).strftime("%Y-%m-%d")
+
+
+def test_new_and_active_users_roll_up_once_per_day(bot_module):
+    main = bot_module
+    counters = main.daily_counters
+
+    main.get_user_data("1")
+    assert counters.day() == {"new_users": 1, "active_users": 1}
+
+    # نشاط ثانٍ في نفس اليوم لا يُعد مرة أخرى
+    main.update_user_data("1", {"points": 1})
+    assert counters.day()["active_users"] == 1
+
+    # آخر نشاط كان أمس: يُعد نشطاً اليوم
+    counters.record_activity(main.now_ts() - DAY)
+    assert counters.day()["active_users"] == 2
+
+
+def test_totals_span_days_and_survive_reload(bot_module):
+    main = bot_module
+    counters = main.daily_counters
+    counters.bump("joins", 2)
+    counters.bump("joins", 3, day=days_ago(1))
+    counters.bump("joins", 5, day=days_ago(main.DAILY_STATS_RETENTION_DAYS + 1))
+
+    assert counters.total("joins", 0, 1) == 5
+    assert counters.total("joins", 1, 7) == 3
+
+    counters.save()
+    reloaded = main.DailyCounters(main.DAILY_STATS_FILE, main.DAILY_STATS_RETENTION_DAYS)
+    # الأيام الأقدم من مدة الاحتفاظ تُحذف عند الحفظ
+    assert reloaded.days == {main.DailyCounters.today(): {"joins": 2}, days_ago(1): {"joins": 3}}
+
+
+def test_rebuild_from_first_join_and_last_active(bot_module):
+    """ما يفعله --rebuild-daily-stats: الجدد/النشطون من السجلات، والباقي يُحفظ كما هو"""
+    main = bot_module
+    now = main.now_ts()
+    with main.edit_snapshot("users") as editor:
+        for user_id, (joined, active) in {"1": (2, 0), "2": (2, 1), "3": (1, 1)}.items():
+            record = main.create_default_user_data()
+            record["first_join"] = now - joined * DAY
+            record["last_active"] = now - active * DAY
+            editor.container()[user_id] = record
+
+    counters = main.daily_counters
+    counters.days = {days_ago(2): {"joins": 4, "new_users": 99}}
+
+    users = main._get_snapshot("users", force_reload=True)
+    assert counters.rebuild(users) == 3
+    assert counters.days == {
+        days_ago(2): {"new_users": 2, "joins": 4},
+        days_ago(1): {"new_users": 1, "active_users": 2},
+        days_ago(0): {"active_users": 1},
+    }
+
+    main.active_sketches.rebuild(users)
+    assert main.active_sketches.count(0, 1) == 3
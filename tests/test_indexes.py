@@ -0,0 +1,67 @@
+def seed(main, users):
+    with main.edit_snapshot("users") as editor:
+        for user_id, fields in users.items():
+            record = main.create_default_user_data()
+            record.update(fields)
+            editor.container()[user_id] = record
+
+
+def test_username_index_follows_changed_users(bot_module):
+    main = bot_module
+    seed(main, {"1": {"username": "Alice"}, "2": {"username": "bob"}})
+    assert main.username_index.get("@alice") == "1"
+
+    with main.edit_snapshot("users") as editor:
+        editor.edit("1")["username"] = "ALICE_2"
+        del editor.container()["2"]
+
+    assert main.username_index.get("alice") is None
+    assert main.username_index.get("alice_2") == "1"
+    assert main.username_index.get("bob") is None
+    assert main.username_index.count() == 1
+
+
+def test_channel_user_index_follows_joined_channels(bot_module):
+    main = bot_module
+    seed(main, {
+        "1": {"active_subscriptions": ["a"], "joined_channels": {"a": {}}},
+        "2": {"joined_channels": {"a": {}, "b": {"left_completed": True}}},
+    })
+    index = main.channel_user_index
+    assert index.users_of("a") == {"1", "2"}
+    assert dict(index.left_completed_users()) == {"b": {"2"}}
+
+    with main.edit_snapshot("users") as editor:
+        user = editor.edit("1")
+        user["active_subscriptions"] = ["c"]
+        user["joined_channels"] = {"c": {}}
+        del editor.container()["2"]
+
+    assert index.users_of("a") == set()
+    assert index.users_of("c") == {"1"}
+    assert index.left_completed_users() == []
+
+
+def test_leaderboard_follows_changed_users(bot_module):
+    main = bot_module
+    seed(main, {"1": {"points": 10}, "2": {"points": 30}, "3": {"points": 20}})
+    columns = main.user_columns
+    assert columns.top("points", 3)[1] == [("2", 30), ("3", 20), ("1", 10)]
+
+    with main.edit_snapshot("users") as editor:
+        editor.edit("1")["points"] = 50
+        del editor.container()["2"]
+
+    assert columns.top("points", 3)[1] == [("1", 50), ("3", 20)]
+    summary = columns.summary()
+    assert (summary["users"], summary["total_points"], summary["with_points"]) == (2, 70, 2)
+
+
+def test_membership_cache_keys_match_username_index(bot_module):
+    main = bot_module
+    cache = main.MembershipCache(60, 60, 60, 10)
+    cache.put("@Straße", 1, True)
+
+    # نفس توحيد UsernameIndex (casefold) - ß تطابق ss
+    assert cache.get("strasse", "1") == (True, True)
+    assert main.MembershipCache.key_of(" @ABC", 2) == (main.UsernameIndex.normalize("abc"), "2")
@@ -0,0 +1,132 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(bot_module, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot_module.time, "monotonic", clock)
+    return clock
+
+
+class MemberBot:
+    id = 42
+
+    def __init__(self, status):
+        self.status = status
+        self.member_calls = 0
+
+    async def get_chat(self, chat_id):
+        return SimpleNamespace(id=-100, title="Chan", type="channel")
+
+    async def get_chat_member(self, chat_id, user_id):
+        self.member_calls += 1
+        return SimpleNamespace(status=self.status)
+
+
+def test_each_result_expires_after_its_own_ttl(bot_module, clock):
+    cache = bot_module.MembershipCache(300, 60, 15, 10)
+    cache.put("chan", 1, True)
+    cache.put("chan", 2, False)
+    cache.put("chan", 3, None)
+
+    clock.now += 16
+    assert cache.get("chan", 3) == (False, None)
+    assert cache.get("chan", 2) == (True, False)
+
+    clock.now += 45
+    assert cache.get("chan", 2) == (False, None)
+    assert cache.get("chan", 1) == (True, True)
+
+    clock.now += 240
+    assert cache.get("chan", 1) == (False, None)
+    # النتائج المنتهية تُحذف عند قراءتها
+    assert cache.entries == {}
+
+
+def test_zero_ttl_is_not_cached(bot_module, clock):
+    cache = bot_module.MembershipCache(300, 60, 0, 10)
+    cache.put("chan", 1, None)
+    assert cache.entries == {}
+
+
+def test_hit_and_miss_counters(bot_module, clock):
+    cache = bot_module.MembershipCache(300, 60, 15, 10)
+    cache.put("chan", 1, True)
+    cache.put("chan", 2, False)
+
+    cache.get("chan", 1)
+    cache.get("chan", 1)
+    cache.get("chan", 2)
+    cache.get("chan", 3)
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (3, 1)
+    assert (stats["positive_hits"], stats["negative_hits"]) == (2, 1)
+    assert stats["hit_rate"] == 0.75
+
+
+def test_eviction_drops_expired_then_oldest(bot_module, clock):
+    cache = bot_module.MembershipCache(300, 60, 15, 3)
+    cache.put("chan", 1, None)
+    cache.put("chan", 2, True)
+    cache.put("chan", 3, True)
+
+    # الخطأ انتهى: يُحذف هو بدلاً من أقدم نتيجة صالحة
+    clock.now += 20
+    cache.put("chan", 4, True)
+    assert sorted(user for _, user in cache.entries) == ["2", "3", "4"]
+
+    # لا منتهٍ: تُحذف الأقدم إدخالاً
+    cache.put("chan", 5, False)
+    assert sorted(user for _, user in cache.entries) == ["3", "4", "5"]
+
+
+def test_force_sub_recheck_skips_and_refreshes_cache(bot_module, clock):
+    main = bot_module
+    with main.edit_snapshot("data") as editor:
+        editor.container("force_sub_channels").append("chan")
+    main.bot_admin_registry.record("chan", True)
+    main.membership_cache.put("chan", 1, True)
+    bot = MemberBot("left")
+
+    # المسار العادي يقرأ من الكاش
+    assert asyncio.run(main.check_force_subscription(bot, 1)) == (True, [])
+    assert bot.member_calls == 0
+
+    # زر "تحقق من الاشتراك" يفحص مباشرة ويحدّث النتيجة المخزنة
+    assert asyncio.run(main.check_force_subscription(bot, 1, fresh=True)) == (False, ["chan"])
+    assert bot.member_calls == 1
+    assert main.membership_cache.get("chan", 1) == (True, False)
+
+
+def test_verify_channel_skips_and_refreshes_cache(bot_module, clock):
+    main = bot_module
+    with main.edit_snapshot("data") as editor:
+        editor.container("channels")["c1"] = {"username": "chan", "owner": "9", "completed": False}
+    main.membership_cache.put("chan", 1, True)
+    bot = MemberBot("left")
+    edits = []
+
+    async def answer(*args, **kwargs):
+        pass
+
+    async def edit_message_text(text, **kwargs):
+        edits.append(text)
+
+    query = SimpleNamespace(data="verify_channel_c1", answer=answer, edit_message_text=edit_message_text)
+    asyncio.run(main.handle_verify_channel(query, "1", bot, None))
+
+    assert bot.member_calls == 1
+    assert "غير مشترك" in edits[-1]
+    assert main.membership_cache.get("chan", 1) == (True, False)
@@ -0,0 +1,100 @@
+import asyncio
+from types import SimpleNamespace
+
+BUYER_ID = 5550001
+
+
+class FakeBot:
+    id = 999
+
+    async def get_chat_member(self, chat_id, user_id):
+        return SimpleNamespace(status="administrator")
+
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.from_user = SimpleNamespace(id=BUYER_ID, username="buyer")
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def run_purchase(main, points=50, members=10, transaction_id="purchase_test_1"):
+    message = FakeMessage("@some_channel")
+    context = SimpleNamespace(
+        bot=FakeBot(),
+        user_data={"buying": {"points": points, "members": members, "transaction_id": transaction_id}},
+    )
+    asyncio.run(main.handle_channel_purchase(SimpleNamespace(message=message), context))
+    return message
+
+
+def test_new_purchase_saves_order_and_channel(bot_module):
+    main = bot_module
+    main.update_user_data(str(BUYER_ID), {"points": 100})
+
+    message = run_purchase(main)
+
+    user = main.get_user_data(str(BUYER_ID), force_reload=True)
+    assert user["points"] == 50
+    assert len(user["orders"]) == 1
+    assert user["orders"][0]["transaction_id"] == "purchase_test_1"
+
+    channels = main.get_data_view(force_reload=True)["channels"]
+    assert user["orders"][0]["order_id"] in channels
+    assert any("تم إنشاء الطلب" in reply for reply in message.replies)
+
+
+def test_replayed_purchase_is_not_charged_twice(bot_module):
+    main = bot_module
+    main.update_user_data(str(BUYER_ID), {"points": 100})
+
+    run_purchase(main)
+    run_purchase(main)
+
+    user = main.get_user_data(str(BUYER_ID), force_reload=True)
+    assert user["points"] == 50
+    assert len(user["orders"]) == 1
+
+
+def test_replayed_transaction_rejected_by_persistent_index(bot_module):
+    main = bot_module
+    user_id = str(BUYER_ID)
+    main.update_user_data(user_id, {"points": 10})
+
+    assert main.update_user_data(user_id, {"points": 20}, "admin_set", "tx_replay_1")
+    assert not main.update_user_data(user_id, {"points": 30}, "admin_set", "tx_replay_1")
+    assert main.get_user_data(user_id, force_reload=True)["points"] == 20
+
+    # فهرس التكرار الدائم يرفض المعاملة حتى بعد ضياع حالة المعاملات قيد التنفيذ
+    main.cooldown_manager.in_flight.clear()
+    allowed, _, reason = main.cooldown_manager.can_proceed(user_id, "general", "tx_replay_1")
+    assert not allowed and reason == "معاملة مكررة"
+
+
+def test_channel_username_index_follows_purchase_completion_and_removal(bot_module):
+    main = bot_module
+    main.update_user_data(str(BUYER_ID), {"points": 100})
+    index = main.channel_username_index
+
+    run_purchase(main)
+    channels = main.get_data_view()["channels"]
+    [channel_id] = index.find(channels, "@Some_Channel", owner=BUYER_ID, completed=False)
+    assert index.find(channels, "some_channel", owner="1") == []
+
+    with main.edit_snapshot("data") as editor:
+        editor.edit("channels", channel_id)["completed"] = True
+    channels = main.get_data_view()["channels"]
+    assert index.find(channels, "some_channel", completed=False) == []
+    assert index.find(channels, "some_channel", completed=True) == [channel_id]
+
+    # اكتمال العدد: القناة تُحذف ويُزال ربطها من الفهرس
+    with main.edit_snapshot("data") as editor:
+        channel = editor.edit("channels", channel_id)
+        channel["completed"] = False
+        channel["current"] = channel["required"]
+    assert main.check_and_mark_completed_channels() == 1
+    assert index.find(main.get_data_view()["channels"], "some_channel") == []
+    assert channel_id not in index.records and "some_channel" not in index.by_username
@@ -0,0 +1,103 @@
+import pytest
+
+
+def test_concurrent_edits_to_different_users_are_merged(bot_module):
+    main = bot_module
+    first = main.SnapshotEditor("users")
+    second = main.SnapshotEditor("users")
+    first.container()["1"] = main.create_default_user_data()
+    second.container()["2"] = main.create_default_user_data()
+
+    assert first.commit()
+    assert second.commit()
+
+    users = main.get_users_view()
+    assert "1" in users and "2" in users
+
+
+def test_concurrent_edits_to_same_user_conflict(bot_module):
+    main = bot_module
+    main.update_user_data("1", {"points": 5})
+    first = main.SnapshotEditor("users")
+    second = main.SnapshotEditor("users")
+    first.edit("1")["points"] = 10
+    second.edit("1")["points"] = 20
+
+    assert first.commit()
+    with pytest.raises(main.SnapshotConflict):
+        second.commit()
+    assert main.get_users_view()["1"]["points"] == 10
+
+
+def test_concurrent_edits_to_different_channels_are_merged(bot_module):
+    main = bot_module
+    with main.edit_snapshot("data") as editor:
+        editor.container("channels")["a"] = {"count": 0}
+        editor.container("channels")["b"] = {"count": 0}
+
+    first = main.SnapshotEditor("data")
+    second = main.SnapshotEditor("data")
+    first.edit("channels", "a")["count"] = 1
+    second.edit("channels", "b")["count"] = 2
+    assert first.commit()
+    assert second.commit()
+
+    channels = main.get_data_view()["channels"]
+    assert (channels["a"]["count"], channels["b"]["count"]) == (1, 2)
+
+
+def test_layered_dict_versions_are_independent(bot_module):
+    main = bot_module
+    base = main.LayeredDict({str(i): i for i in range(1000)})
+    changed = base.with_changes({"1": -1, "2": main._DELETED, "new": 7})
+
+    assert (base["1"], "2" in base, "new" in base, len(base)) == (1, True, False, 1000)
+    assert (changed["1"], "2" in changed, changed["new"], len(changed)) == (-1, False, 7, 1000)
+    assert list(changed) == [k for k in base if k != "2"] + ["new"]
+
+    # دمج الطبقة عندما تكبر لا يغير المحتوى
+    for i in range(200):
+        changed = changed.with_changes({f"x{i}": i})
+    assert len(changed) == 1200 and changed["x199"] == 199 and "2" not in changed
+
+
+
+def test_completed_channels_survive_user_conflict(bot_module, monkeypatch):
+    main = bot_module
+    with main.edit_snapshot("data") as editor:
+        editor.container("channels")["done"] = {"username": "d", "owner": "9", "current": 2, "required": 2}
+        editor.container("channels")["open"] = {"username": "o", "owner": "9", "current": 0, "required": 2}
+    main.update_user_data("1", {"joined_channels": {"done": {"verified": True}}})
+
+    commit = main.SnapshotEditor.commit
+
+    def users_conflict(self, backup=False):
+        if self.cache_key == "users":
+            raise main.SnapshotConflict("users")
+        return commit(self, backup)
+
+    monkeypatch.setattr(main.SnapshotEditor, "commit", users_conflict)
+    monkeypatch.setattr(main, "load_data", None)
+
+    assert main.check_and_mark_completed_channels() == 1
+    data = main.get_data_view()
+    assert list(data["channels"]) == ["open"]
+    assert data["deleted_channels_history"][0]["id"] == "done"
+
+
+def test_users_cache_holds_records_and_files_hold_json(bot_module):
+    main = bot_module
+    main.update_user_data("1", {"points": 5, "left_channels": ["c1"]})
+
+    cached = main._get_snapshot("users")["1"]
+    assert isinstance(cached, main.UserRecord)
+    assert isinstance(cached["left_channels"], main.MembershipSet)
+
+    # نسخة خاصة بدون المرور بـ JSON - تعديلها لا يمس الكاش
+    user = main.get_user_data("1")
+    user["left_channels"].append("c2")
+    assert "c2" not in cached["left_channels"]
+
+    with open(main.USERS_FILE, encoding="utf-8") as f:
+        saved = main.json.load(f)
+    assert saved["1"]["left_channels"] == ["c1"]
@@ -0,0 +1,212 @@
+import pytest
+
+
+def test_sharded_commit_writes_only_changed_users(bot_module, monkeypatch):
+    main = bot_module
+    monkeypatch.setattr(main, "STORAGE_ENGINE", "sharded")
+    store = main.get_sharded_store()
+    store.save_all_users({"1": main.create_default_user_data(), "2": main.create_default_user_data()})
+    assert store.count_users() == 2
+
+    written = []
+    original = store._write_shard
+    monkeypatch.setattr(store, "_write_shard", lambda index, shard: (written.append(index), original(index, shard)))
+
+    with main.edit_snapshot("users") as editor:
+        editor.edit("1")["points"] = 7
+        editor.container()["3"] = main.create_default_user_data()
+        del editor.container()["2"]
+
+    assert sorted(written) == sorted({store.shard_of(uid) for uid in ("1", "2", "3")})
+    assert store.get_user("1")["points"] == 7
+    assert store.get_user("2") is None
+    assert store.count_users() == 2
+
+
+def test_sqlite_commit_writes_only_changed_users(bot_module, monkeypatch):
+    main = bot_module
+    monkeypatch.setattr(main, "STORAGE_ENGINE", "sqlite")
+    storage = main.get_sqlite_storage()
+    storage.save_all_users({"1": main.create_default_user_data(), "2": main.create_default_user_data()})
+    monkeypatch.setattr(storage, "save_all_users", None)
+
+    with main.edit_snapshot("users") as editor:
+        editor.edit("1")["points"] = 7
+        del editor.container()["2"]
+
+    assert storage.get_user("1")["points"] == 7
+    assert storage.get_user("2") is None
+    assert storage.count_users() == 1
+
+
+def test_schema_v2_converts_legacy_times(bot_module):
+    main = bot_module
+    with main.edit_snapshot("data") as editor:
+        root = editor.container()
+        root["schema_version"] = root["users_schema_version"] = 1
+        editor.container("channels")["c1"] = {
+            "username": "chan", "current": 0, "joined_users": {},
+            "created_at": "2024-01-02 03:04:05",
+            "leave_history": [{"user_id": "1", "left_at": "2024-01-03 00:00:00"}],
+        }
+    with main.edit_snapshot("users") as editor:
+        editor.container()["1"] = dict(main.create_default_user_data(), joined_channels={
+            "c1": {"left": True, "left_at": "2024-01-03 00:00:00"}
+        })
+
+    assert main.migrate_schema()
+
+    channel = main.get_data_view(force_reload=True)["channels"]["c1"]
+    join_info = main.get_users_view(force_reload=True)["1"]["joined_channels"]["c1"]
+    assert channel["created_at"] == main.to_timestamp("2024-01-02 03:04:05")
+    assert isinstance(channel["leave_history"][0]["left_at"], int)
+    assert join_info["left_at"] == main.to_timestamp("2024-01-03 00:00:00")
+    assert main.format_timestamp(channel["created_at"]) == "2024-01-02 03:04:05"
+
+
+def test_ledger_compaction_drops_old_records(bot_module):
+    main = bot_module
+    ledger = main.get_ledger()
+    old = main.now_ts() - 10 * 86400
+    for i in range(3):
+        ledger.append("1", {"id": f"old_{i}", "action": "a", "timestamp": old, "updates": {}})
+    ledger.append("2", {"id": "old_3", "action": "a", "timestamp": old, "updates": {}})
+    ledger.append("1", {"id": "new_0", "action": "a", "timestamp": main.now_ts(), "updates": {}})
+
+    assert ledger.prune_tx_index(5 * 86400) == 4
+    assert not ledger.has("old_0") and ledger.has("new_0")
+
+    assert ledger.compact(5 * 86400) == 4
+    assert [t["id"] for t in ledger.page("1")] == ["new_0"]
+    assert ledger.count("2") == 0
+    assert ledger.get("new_0")["id"] == "new_0"
+
+    # الفهرس المحفوظ يطابق السجل الجديد بعد إعادة الفتح
+    main.close_ledger()
+    reopened = main.get_ledger()
+    assert reopened.size == ledger.size
+    assert [t["id"] for t in reopened.page("1")] == ["new_0"]
+
+
+def test_batched_writers_share_one_fsync(bot_module, monkeypatch, tmp_path):
+    main = bot_module
+    committer = main.GroupCommitter(50)
+    monkeypatch.setattr(main, "_group_committer", committer)
+    monkeypatch.setattr(main, "DURABILITY_LEVEL", "batched")
+    synced = []
+    monkeypatch.setattr(main, "_sync_files", lambda paths: (synced.append(set(paths)), {})[1])
+
+    paths = [str(tmp_path / f"f{i}.json") for i in range(8)]
+    threads = [main.threading.Thread(target=main.write_json_file, args=(path, {"i": i})) for i, path in enumerate(paths)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # كل الخيوط عادت بعد مزامنة ملفاتها، في دفعات أقل من عدد الكتّاب
+    assert set().union(*synced) == set(paths)
+    assert committer.total_batches < len(paths)
+    assert [main.json.loads(open(path).read())["i"] for path in paths] == list(range(8))
+
+
+def test_batched_write_never_waits_on_event_loop(bot_module, monkeypatch, tmp_path):
+    main = bot_module
+    committer = main.GroupCommitter(10_000)
+    monkeypatch.setattr(main, "_group_committer", committer)
+    monkeypatch.setattr(main, "DURABILITY_LEVEL", "batched")
+    monkeypatch.setattr(committer, "wait", lambda *ticket: (_ for _ in ()).throw(AssertionError("loop blocked")))
+
+    async def handler():
+        main.write_json_file(str(tmp_path / "a.json"), {"ok": True})
+
+    main.asyncio.run(handler())
+    assert committer.pending == {str(tmp_path / "a.json")}
+    assert committer.flush() == 1 and committer.done == 1
+
+
+def test_batched_fsync_error_reaches_only_its_batch(bot_module, monkeypatch, tmp_path):
+    main = bot_module
+    committer = main.GroupCommitter(10_000)
+    monkeypatch.setattr(main, "_group_committer", committer)
+    monkeypatch.setattr(main, "DURABILITY_LEVEL", "batched")
+    path = str(tmp_path / "a.json")
+    failure = OSError("fsync failed")
+    monkeypatch.setattr(main, "_sync_files", lambda paths: {path: failure})
+
+    ticket = main.atomic_write_json(path, {"i": 1})
+    committer.flush()
+    with pytest.raises(OSError):
+        main.wait_durable(ticket)
+
+    # دفعة تالية ناجحة تمسح الخطأ السابق
+    monkeypatch.setattr(main, "_sync_files", lambda paths: {})
+    ticket = main.atomic_write_json(path, {"i": 2})
+    committer.flush()
+    main.wait_durable(ticket)
+
+
+def test_buffered_writes_never_fsync(bot_module, monkeypatch, tmp_path):
+    main = bot_module
+    monkeypatch.setattr(main, "DURABILITY_LEVEL", "buffered")
+    monkeypatch.setattr(main.os, "fsync", lambda fd: (_ for _ in ()).throw(AssertionError("fsync")))
+
+    assert main.atomic_write_json(str(tmp_path / "a.json"), {"ok": True}) is None
+    assert main.json.loads((tmp_path / "a.json").read_text()) == {"ok": True}
+
+
+def test_sqlite_data_commit_writes_only_changed_rows(bot_module, monkeypatch):
+    main = bot_module
+    monkeypatch.setattr(main, "STORAGE_ENGINE", "sqlite")
+    storage = main.get_sqlite_storage()
+    data = main.create_initial_data()
+    data["channels"] = {"a": {"current": 0}, "b": {"current": 0}}
+    storage.save_data(data)
+    monkeypatch.setattr(storage, "_replace_data", None)
+    monkeypatch.setattr(storage, "_replace_table", None)
+
+    statements = []
+    storage.conn.set_trace_callback(statements.append)
+    with main.edit_snapshot("data") as editor:
+        editor.edit("channels", "a")["current"] = 3
+        del editor.container("channels")["b"]
+        editor.container("muted_users")["7"] = {"reason": "x"}
+        editor.container("stats")["total_mutes"] = 1
+        editor.container("banned_users").append("9")
+    storage.conn.set_trace_callback(None)
+
+    assert not any(sql.startswith("DELETE FROM channels") and "WHERE" not in sql for sql in statements)
+    loaded = storage.load_data()
+    assert loaded["channels"] == {"a": {"current": 3}}
+    assert loaded["muted_users"] == {"7": {"reason": "x"}}
+    assert loaded["stats"]["total_mutes"] == 1
+    assert loaded["banned_users"] == ["9"]
+
+
+def test_users_file_restored_alone_is_migrated(bot_module):
+    main = bot_module
+    # data.json يقول إن المستخدمين مرحَّلون، لكن users.json أُعيد من نسخة v1
+    with main.edit_snapshot("users") as editor:
+        editor.container()["1"] = dict(main.create_default_user_data(), joined_channels={
+            "c1": {"left": True, "left_at": "2024-01-03 00:00:00"}
+        })
+    assert main.get_data_view()["users_schema_version"] == main.SCHEMA_VERSION
+    assert main._users_shape_version(main.get_users_view()) == 1
+
+    assert main.migrate_schema()
+    join_info = main.get_users_view(force_reload=True)["1"]["joined_channels"]["c1"]
+    assert join_info["left_at"] == main.to_timestamp("2024-01-03 00:00:00")
+
+    # سجلات بشكل حالي: لا ترحيل ولا إعادة كتابة
+    assert not main.migrate_schema()
+
+
+def test_users_with_missing_fields_are_version_zero(bot_module):
+    main = bot_module
+    with main.edit_snapshot("users") as editor:
+        editor.container()["1"] = {"points": 5, "last_active": "2024-01-02 03:04:05"}
+    assert main._users_shape_version(main.get_users_view()) == 0
+
+    assert main.migrate_schema()
+    user = main.get_users_view(force_reload=True)["1"]
+    assert user["last_active"] == main.to_timestamp("2024-01-02 03:04:05")
+    assert user["invites"] == 0
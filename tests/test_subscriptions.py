@@ -0,0 +1,93 @@
+def setup_channel(main, user_id, channel_id="c1"):
+    with main.edit_snapshot("data") as editor:
+        editor.container("channels")[channel_id] = {
+            "username": "chan", "owner": str(main.ADMIN_ID), "current": 1, "required": 5,
+            "joined_users": {user_id: {}}, "completed": False
+        }
+    main.update_user_data(user_id, {
+        "points": 10, "active_subscriptions": [channel_id],
+        "joined_channels": {channel_id: {"left": False}}
+    })
+
+
+def test_sweep_penalty_goes_through_points_batch(bot_module):
+    main = bot_module
+    setup_channel(main, "7")
+    stats_before = main.get_data_view()["stats"].get("total_points", 0)
+
+    penalties, _ = main.apply_subscription_sweep([("7", "c1")], {}, penalty_amount=5)
+
+    user = main.get_user_data("7", force_reload=True)
+    assert penalties == 1
+    assert user["points"] == 5 and user["total_spent"] == 5
+    assert "c1" not in user["active_subscriptions"]
+
+    # سجل المعاملات وفهرس التكرار والإحصائيات من نفس المسار المشترك
+    [transaction] = main.get_ledger().page("7")
+    assert transaction["action"] == "subscription_check_penalty"
+    assert transaction["updates"]["points"] == 5
+    assert transaction["updates"]["channel_id"] == "c1"
+    assert main.is_duplicate_transaction(transaction["id"], "subscription_check_penalty")
+    assert main.get_data_view()["stats"]["total_points"] == stats_before - 5
+    assert main.get_data_view()["channels"]["c1"]["current"] == 0
+
+    # المغادرة لا تُطبق مرتين
+    assert main.apply_subscription_sweep([("7", "c1")], {}, penalty_amount=5) == (0, [])
+    assert main.get_user_data("7", force_reload=True)["points"] == 5
+
+
+def test_safe_add_points_records_once(bot_module):
+    main = bot_module
+    main.update_user_data("8", {"points": 0})
+
+    assert main.safe_add_points("8", 4, "add", "bonus", "tx_bonus_1")[0]
+    assert not main.safe_add_points("8", 4, "add", "bonus", "tx_bonus_1")[0]
+
+    assert main.get_user_data("8", force_reload=True)["points"] == 4
+    assert main.get_ledger().count("8") == 1
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+
+
+def leave_update(user_id, username="chan"):
+    from types import SimpleNamespace
+
+    return SimpleNamespace(chat_member=SimpleNamespace(
+        chat=SimpleNamespace(username=username),
+        old_chat_member=SimpleNamespace(status="member"),
+        new_chat_member=SimpleNamespace(status="left", user=SimpleNamespace(id=int(user_id))),
+    ))
+
+
+def test_chat_member_leaves_are_batched(bot_module, monkeypatch):
+    import asyncio
+    from types import SimpleNamespace
+
+    main = bot_module
+    monkeypatch.setattr(main, "MEMBERSHIP_EVENT_BATCH_DELAY", 0)
+    setup_channel(main, "7")
+    setup_channel(main, "9", channel_id="c1")
+    calls = []
+    original = main.apply_subscription_sweep
+    monkeypatch.setattr(main, "apply_subscription_sweep", lambda *a, **k: calls.append(a[0]) or original(*a, **k))
+    context = SimpleNamespace(bot=FakeBot())
+
+    async def scenario():
+        await main.handle_chat_member(leave_update("7"), context)
+        await main.handle_chat_member(leave_update("9"), context)
+        await main._leave_batch_task
+        await main.notification_queue.worker
+
+    asyncio.run(scenario())
+
+    # مغادرتان = حفظ واحد
+    assert calls == [[("7", "c1"), ("9", "c1")]]
+    assert main.get_user_data("7", force_reload=True)["points"] == 5
+    assert main.get_user_data("9", force_reload=True)["points"] == 5
+    assert sorted(context.bot.sent) == [7, 9]
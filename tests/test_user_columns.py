@@ -0,0 +1,70 @@
+import pytest
+
+DAY = 24 * 3600
+NOW = 1_700_000_000
+
+
+def seed(main, users):
+    with main.edit_snapshot("users") as editor:
+        for user_id, fields in users.items():
+            record = main.create_default_user_data()
+            record.update(fields)
+            editor.container()[user_id] = record
+
+
+def test_reports_follow_user_updates(bot_module):
+    main = bot_module
+    seed(main, {
+        "1": {"points": 10, "total_earned": 20, "total_spent": 0, "first_join": NOW - 2 * DAY, "last_active": NOW - 3600},
+        "2": {"points": 30, "total_earned": 10, "total_spent": 15, "first_join": NOW - 9 * DAY, "last_active": NOW - 10 * DAY},
+        "3": {"points": 50, "total_earned": 40, "total_spent": 10, "first_join": NOW - 9 * DAY, "last_active": NOW - 2 * DAY},
+    })
+    columns = main.user_columns
+
+    assert columns.percentiles("points", (50, 100)) == {50: 30, 100: 50}
+    assert columns.distribution("points", [20, 40]) == [1, 1, 1]
+
+    balance = columns.balance()
+    assert (balance["users"], balance["total_earned"], balance["total_spent"]) == (3, 70, 25)
+    assert (balance["overspent"], balance["never_spent"]) == (1, 1)
+
+    assert columns.activity_buckets(now=NOW) == [1, 1, 1, 0]
+    assert columns.cohort_retention(weeks=2, now=NOW) == [(0, 1, 1), (1, 2, 1)]
+
+    # تحديث مستخدم وحذف آخر - الأعمدة تتبع اللقطة الجديدة
+    main.update_user_data("1", {"points": 70})
+    with main.edit_snapshot("users") as editor:
+        del editor.container()["2"]
+
+    assert columns.percentiles("points", (100,)) == {100: 70}
+    assert columns.balance()["users"] == 2
+
+
+def test_top_and_summary_follow_updates(bot_module):
+    main = bot_module
+    seed(main, {"1": {"points": 10, "invites": 1}, "2": {"points": 20}})
+    assert main.user_columns.top("invites", 2)[1] == [("1", 1), ("2", 0)]
+
+    main.update_user_data("2", {"invites": 4})
+    assert main.user_columns.top("invites", 1)[1] == [("2", 4)]
+    assert main.user_columns.summary()["total_invites"] == 5
+
+
+@pytest.mark.parametrize("has_numpy", [False, True])
+def test_sorted_column_is_cached_per_version(bot_module, monkeypatch, has_numpy):
+    main = bot_module
+    if has_numpy:
+        pytest.importorskip("numpy")
+    monkeypatch.setattr(main, "HAS_NUMPY", has_numpy)
+    seed(main, {"1": {"points": 10, "total_earned": 5}, "2": {"points": 30, "total_spent": 3}})
+    columns = main.user_columns
+
+    ordered = columns.sorted_column("points")
+    assert list(ordered) == [10, 30]
+    assert columns.sorted_column("points") is ordered
+    assert columns.balance()["never_spent"] == 1
+
+    # صف متغير يبطل الترتيب المحفوظ
+    main.update_user_data("1", {"points": 50})
+    assert list(columns.sorted_column("points")) == [30, 50]
+    assert columns.percentiles("points", (50,)) == {50: 30}
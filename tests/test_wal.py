@@ -0,0 +1,128 @@
+import json
+
+
+def replay(main, records):
+    """إعادة تطبيق السجلات على آخر لقطة مكتوبة (كما بعد انقطاع)"""
+    users = json.load(open(main.USERS_FILE, encoding="utf-8"))
+    data = main._load_data_from_file()
+    for record in records:
+        main._apply_wal_record(users, data, record)
+    return users, data
+
+
+def test_editor_commits_append_wal_records(bot_module, monkeypatch):
+    main = bot_module
+    monkeypatch.setattr(main, "WAL_ENABLED", True)
+    try:
+        with main.edit_snapshot("data") as editor:
+            editor.container("channels")["c1"] = {"username": "chan", "current": 0, "joined_users": {}}
+        users_file_before = open(main.USERS_FILE, encoding="utf-8").read()
+        with main.edit_snapshot("users") as editor:
+            editor.container()["1"] = main.create_default_user_data()
+            editor.edit("1")["points"] = 9
+
+        # لا لقطة كاملة لكل حفظ: التغييرات في WAL فقط
+        assert open(main.USERS_FILE, encoding="utf-8").read() == users_file_before
+        records = main.get_wal().read_records()
+        assert {(r["t"], r["k"], tuple(r["p"])) for r in records} == {
+            ("p", "data", ("channels", "c1")), ("p", "users", ("1",))
+        }
+
+        users, data = replay(main, records)
+        assert users["1"]["points"] == 9
+        assert data["channels"]["c1"]["username"] == "chan"
+    finally:
+        main.stop_write_behind()
+
+
+def test_channel_records_are_applied_once(bot_module, monkeypatch):
+    main = bot_module
+    monkeypatch.setattr(main, "WAL_ENABLED", True)
+    try:
+        with main.edit_snapshot("data") as editor:
+            editor.container("channels")["c1"] = {"current": 0, "joined_users": {}}
+        main.compact_wal()
+
+        channel = main.get_data_view()["channels"]["c1"].copy()
+        channel["current"] = 1
+        main.save_channel_counter_change("c1", channel, push={"leave_history": {"user_id": "5"}})
+        records = main.get_wal().read_records()
+
+        # السجل يُطبق مرتين (ذيل WAL فوق لقطة تحتويه) - الإضافة تظهر مرة واحدة
+        _, data = replay(main, records + records)
+        assert data["channels"]["c1"]["leave_history"] == [{"user_id": "5"}]
+        assert data["channels"]["c1"]["current"] == 1
+    finally:
+        main.stop_write_behind()
+
+
+def test_wal_counters_publish_new_versions(bot_module, monkeypatch):
+    main = bot_module
+    monkeypatch.setattr(main, "WAL_ENABLED", True)
+    try:
+        with main.edit_snapshot("data") as editor:
+            editor.container("channels")["c1"] = {"current": 0, "joined_users": {}}
+        before = main.get_data_view()
+
+        assert main.update_system_stats("total_joins", 2)
+        channel = before["channels"]["c1"].copy()
+        channel["current"] = 1
+        assert main.save_channel_counter_change("c1", channel)
+
+        # القارئ الذي يحمل الإصدار السابق لا يرى التغيير تحته
+        assert before["stats"]["total_joins"] == 0 and before["channels"]["c1"]["current"] == 0
+        after = main.get_data_view()
+        assert after["stats"]["total_joins"] == 2 and after["channels"]["c1"]["current"] == 1
+    finally:
+        main.stop_write_behind()
+
+
+def test_failed_wal_append_publishes_nothing(bot_module, monkeypatch):
+    main = bot_module
+    monkeypatch.setattr(main, "WAL_ENABLED", True)
+    try:
+        version = main.get_snapshot_version("data")
+
+        def broken(record):
+            raise OSError("disk full")
+        monkeypatch.setattr(main.get_wal(), "append", broken)
+
+        assert not main.update_system_stats("total_joins", 1)
+        assert main.get_snapshot_version("data") == version
+        assert main.get_data_view()["stats"]["total_joins"] == 0
+    finally:
+        main.stop_write_behind()
+
+
+def test_compaction_waits_for_appended_records_to_publish(bot_module, monkeypatch):
+    main = bot_module
+    monkeypatch.setattr(main, "WAL_ENABLED", True)
+    try:
+        main.compact_wal()
+        appended, release = main.threading.Event(), main.threading.Event()
+        publish = main.publish_write_behind_changes
+
+        def slow_publish(cache_key, changes):
+            # السجل في WAL ولم يُنشر بعد
+            appended.set()
+            release.wait(5)
+            return publish(cache_key, changes)
+        monkeypatch.setattr(main, "publish_write_behind_changes", slow_publish)
+
+        writer = main.threading.Thread(target=main.update_system_stats, args=("total_joins", 3))
+        writer.start()
+        assert appended.wait(5)
+        compactor = main.threading.Thread(target=main.compact_wal)
+        compactor.start()
+        compactor.join(0.2)
+        assert compactor.is_alive()
+
+        release.set()
+        writer.join(5)
+        compactor.join(5)
+
+        # انقطاع بعد الضغط: اللقطة المكتوبة + ما بقي في WAL يحتويان التحديث
+        _, data = replay(main, main.get_wal().read_records())
+        assert data["stats"]["total_joins"] == 3
+    finally:
+        main.stop_write_behind()
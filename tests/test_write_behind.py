@@ -0,0 +1,71 @@
+import json
+import time
+
+import pytest
+
+
+def read_users(main):
+    with open(main.USERS_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def write_behind(bot_module, monkeypatch):
+    main = bot_module
+    monkeypatch.setattr(main, "WRITE_BEHIND_ENABLED", True)
+    monkeypatch.setattr(main, "WRITE_BEHIND_INTERVAL", 60)
+    yield main
+    main.stop_write_behind()
+
+
+def test_updates_are_batched_into_one_flush(write_behind):
+    main = write_behind
+    for points in range(1, 6):
+        main.update_user_data("1", {"points": points})
+
+    # الملف لم يُكتب بعد - القراءة من الذاكرة
+    assert "1" not in read_users(main)
+    assert main.get_user_data("1")["points"] == 5
+
+    store = main.get_write_behind_store()
+    assert store.flush() == 1
+    assert read_users(main)["1"]["points"] == 5
+    assert store.flush() == 0
+
+
+def test_max_dirty_wakes_the_flusher(bot_module):
+    main = bot_module
+    store = main.WriteBehindStore(interval=60, max_dirty=3)
+    store.start()
+    try:
+        store.put("users", {"1": main.create_default_user_data()})
+        store.touch("users")
+        assert "1" not in read_users(main)
+        store.touch("users")
+
+        deadline = time.monotonic() + 5
+        while "1" not in read_users(main) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert "1" in read_users(main)
+    finally:
+        store.stop()
+    assert store.total_flushes == 1
+
+
+def test_failed_flush_keeps_changes_dirty(bot_module, monkeypatch):
+    main = bot_module
+    store = main.WriteBehindStore(interval=60, max_dirty=100)
+    store.put("users", {"1": main.create_default_user_data()})
+
+    def fail(path, payload):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(main, "atomic_write_text", fail)
+        with pytest.raises(OSError):
+            store.flush()
+    assert store.dirty["users"] == 1
+
+    # الإيقاف يكتب ما تبقى
+    store.stop()
+    assert "1" in read_users(main)